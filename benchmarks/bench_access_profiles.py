@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Benchmark SQLite access profiles (default / read_only / immutable)
+
+Runs the same analytical queries under each profile, then measures reader
+latency while a writer keeps updating column_metadata, with and without WAL.
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from sqlite_access import ACCESS_PROFILES, apply_journal_mode, connect
+
+QUERIES = [
+    "SELECT department_id, AVG(salary), COUNT(*) FROM employees GROUP BY department_id",
+    "SELECT * FROM employees WHERE id = 4242",
+    "SELECT name FROM employees WHERE age > 50 ORDER BY salary DESC LIMIT 20",
+]
+
+
+def build_database(path: str, rows: int):
+    """Create an employees table and a column_metadata table"""
+    with sqlite3.connect(path) as conn:
+        conn.executescript("""
+            CREATE TABLE employees (
+                id INTEGER PRIMARY KEY, name TEXT, age INTEGER,
+                department_id INTEGER, salary REAL, hire_date DATE
+            );
+            CREATE TABLE column_metadata (
+                table_name TEXT NOT NULL, column_name TEXT NOT NULL, business_name TEXT,
+                PRIMARY KEY (table_name, column_name)
+            );
+        """)
+        conn.executemany(
+            "INSERT INTO employees VALUES (?, ?, ?, ?, ?, ?)",
+            ((i, f"Employee {i}", 20 + i % 45, i % 20, 40000.0 + i % 60000, '2020-01-15')
+             for i in range(rows))
+        )
+
+
+def bench_queries(path: str, profile: str, repeat: int) -> float:
+    """Average seconds per round of QUERIES, with a fresh connection per query"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for sql in QUERIES:
+            with connect(path, profile) as conn:
+                conn.execute(sql).fetchall()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_concurrent_reads(path: str, profile: str, duration: float) -> dict:
+    """Reader latency while another thread writes metadata in short transactions"""
+    stop = threading.Event()
+
+    def writer():
+        conn = sqlite3.connect(path, timeout=30)
+        i = 0
+        while not stop.is_set():
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO column_metadata VALUES ('employees', ?, 'x')",
+                             (f"c{i % 100}",))
+                time.sleep(0.005)  # hold the write transaction open briefly
+            i += 1
+        conn.close()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            with connect(path, profile, timeout=30) as conn:
+                conn.execute(QUERIES[1]).fetchall()
+            latencies.append(time.perf_counter() - start)
+        except sqlite3.OperationalError:
+            errors += 1
+    stop.set()
+    thread.join()
+
+    latencies.sort()
+    return {
+        "reads": len(latencies),
+        "errors": errors,
+        "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else None,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=500_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=3.0)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, "bench.db")
+        build_database(path, args.rows)
+
+        print("Query latency (fresh connection per query):")
+        for profile in ACCESS_PROFILES:
+            bench_queries(path, profile, 1)  # warm the OS page cache
+            print(f"  {profile:<10} {bench_queries(path, profile, args.repeat) * 1000:8.1f} ms/round")
+
+        print("\nReads during concurrent metadata writes:")
+        for journal, profile in (("rollback", "default"), ("wal", "read_only")):
+            if journal == "wal":
+                apply_journal_mode(path, profile)
+            stats = bench_concurrent_reads(path, profile, args.duration)
+            print(f"  {journal:<8} ({profile:<9}) reads={stats['reads']:>6} errors={stats['errors']} "
+                  f"p50={stats['p50_ms']:.2f} ms p99={stats['p99_ms']:.2f} ms")
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
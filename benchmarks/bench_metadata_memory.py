@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark: dict-of-dicts column metadata vs MetadataStore records
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from metadata_store import MetadataStore
+
+
+def build_database(path: str, tables: int, columns: int):
+    """Fill column_metadata with tables * columns rows"""
+    with sqlite3.connect(path) as conn:
+        conn.execute("""
+            CREATE TABLE column_metadata (
+                table_name TEXT NOT NULL,
+                column_name TEXT NOT NULL,
+                business_name TEXT,
+                description TEXT,
+                data_type TEXT,
+                example_value TEXT,
+                is_sensitive BOOLEAN DEFAULT 0,
+                business_rules TEXT,
+                PRIMARY KEY (table_name, column_name)
+            )
+        """)
+        conn.executemany(
+            "INSERT INTO column_metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((f"table_{t}", f"col_{c}", f"业务字段{c}", f"表{t}的第{c}列", ('INTEGER', 'TEXT', 'REAL')[c % 3],
+              str(c), c % 10 == 0, None if c % 2 else '不能为空')
+             for t in range(tables) for c in range(columns))
+        )
+
+
+def measure(label: str, func):
+    """Run func and report elapsed time and peak traced memory"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<22} time={elapsed * 1000:9.1f} ms  "
+          f"retained={retained / 1e6:8.1f} MB  peak={peak / 1e6:8.1f} MB")
+    return result
+
+
+def load_dicts(path: str):
+    """The previous get_column_metadata(): every row as a dict, nested by table"""
+    metadata = {}
+    with sqlite3.connect(path) as conn:
+        for row in conn.execute("SELECT * FROM column_metadata"):
+            table_name, column_name, business_name, description, data_type, example_value, is_sensitive, \
+                business_rules = row
+            metadata.setdefault(table_name, {})[column_name] = {
+                'business_name': business_name,
+                'description': description,
+                'data_type': data_type,
+                'example_value': example_value,
+                'is_sensitive': bool(is_sensitive),
+                'business_rules': business_rules
+            }
+    return metadata
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tables", type=int, default=1000)
+    parser.add_argument("--columns", type=int, default=100, help="Columns per table")
+    parser.add_argument("--lookup", type=int, default=5, help="Tables touched by the lazy lookup")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        build_database(path, args.tables, args.columns)
+        print(f"{args.tables * args.columns} metadata rows")
+
+        dicts = measure("dict-of-dicts (all)", lambda: load_dicts(path))
+        del dicts
+        records = measure("records (all)", lambda: MetadataStore(path).all())
+        del records
+        names = [f"table_{t}" for t in range(args.lookup)]
+        measure(f"records ({args.lookup} tables)", lambda: MetadataStore(path).tables(names))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Time to first rows: execute_query() (every row materialized) vs preview()
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from text_to_sql import TextToSQL
+
+
+def build_database(path: str, rows: int):
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE events (id INTEGER PRIMARY KEY, kind INTEGER, amount REAL, note TEXT)")
+        conn.executemany("INSERT INTO events VALUES (?, ?, ?, ?)",
+                         ((i, i % 10, i * 0.25, f"event {i}") for i in range(1, rows + 1)))
+
+
+class NoModel:
+    def generate_content(self, prompt, **kwargs):
+        raise RuntimeError("the benchmark only runs SQL")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--preview-rows", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        build_database(path, args.rows)
+        text_to_sql = TextToSQL(path, model=NoModel(), seed_sample_data=False)
+
+        for sql_query in ("SELECT * FROM events", "SELECT id, amount FROM events WHERE kind = 3"):
+            print(sql_query)
+            start = time.perf_counter()
+            rows = text_to_sql.execute_query(sql_query)
+            print(f"  execute_query   {(time.perf_counter() - start) * 1000:9.1f} ms  {len(rows)} rows")
+            del rows
+
+            start = time.perf_counter()
+            preview = text_to_sql.preview(sql_query, rows=args.preview_rows)
+            first = time.perf_counter() - start
+            print(f"  preview         {first * 1000:9.1f} ms  {len(preview.rows)} rows, "
+                  f"~{preview.estimate['rows']} total ({preview.estimate['method']})")
+            total = preview.total()
+            print(f"  exact count     {(time.perf_counter() - start) * 1000:9.1f} ms  {total} total")
+            preview.close()
+        text_to_sql.close()
+
+
+if __name__ == "__main__":
+    main()
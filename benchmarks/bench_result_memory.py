@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark: list-of-dicts results vs ColumnarResult
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from result_set import ColumnarResult
+
+
+def build_database(path: str, rows: int):
+    """Create a table shaped like the sample employees table"""
+    with sqlite3.connect(path) as conn:
+        conn.execute("""
+            CREATE TABLE employees (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                age INTEGER,
+                department_id INTEGER,
+                salary REAL,
+                hire_date DATE
+            )
+        """)
+        conn.executemany(
+            "INSERT INTO employees (id, name, age, department_id, salary, hire_date) VALUES (?, ?, ?, ?, ?, ?)",
+            ((i, f"Employee {i}", 20 + i % 40, 1 + i % 3, 50000.0 + i % 50000, '2020-01-15')
+             for i in range(rows))
+        )
+
+
+def measure(label: str, func):
+    """Run func and report elapsed time and peak traced memory"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"{label:<16} rows={len(result):>9}  time={elapsed:7.2f}s  "
+          f"retained={retained / 1e6:8.1f} MB  peak={peak / 1e6:8.1f} MB")
+    return result
+
+
+def load_dicts(path: str):
+    with sqlite3.connect(path) as conn:
+        conn.row_factory = sqlite3.Row
+        return [dict(row) for row in conn.execute("SELECT * FROM employees").fetchall()]
+
+
+def load_columnar(path: str):
+    with sqlite3.connect(path) as conn:
+        return ColumnarResult.from_cursor(conn.execute("SELECT * FROM employees"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        build_database(path, args.rows)
+
+        dicts = measure("list-of-dicts", lambda: load_dicts(path))
+        del dicts
+        measure("columnar", lambda: load_columnar(path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Scan benchmark: sharded fan-out vs one connection over attached shards
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from sharding import ShardedTextToSQL
+
+QUERIES = [
+    "SELECT kind, COUNT(*) AS n, AVG(amount) AS mean_amount FROM events GROUP BY kind ORDER BY n DESC",
+    "SELECT user_id, SUM(amount) AS total FROM events GROUP BY user_id ORDER BY total DESC LIMIT 10",
+    "SELECT * FROM events WHERE amount > 99.9 ORDER BY amount DESC LIMIT 20",
+]
+
+
+class NoModel:
+    def generate_content(self, prompt, **kwargs):
+        raise RuntimeError("The benchmark only executes SQL")
+
+
+def build_shards(directory: str, shards: int, rows: int):
+    """One events table per monthly shard"""
+    paths = []
+    for month in range(shards):
+        path = os.path.join(directory, f"events_{month + 1:02d}.db")
+        with sqlite3.connect(path) as conn:
+            conn.execute("CREATE TABLE events (id INTEGER PRIMARY KEY, kind TEXT, user_id INTEGER, amount REAL)")
+            conn.executemany("INSERT INTO events (kind, user_id, amount) VALUES (?, ?, ?)",
+                             ((random.choice(('click', 'view', 'buy')), random.randint(1, 10000),
+                               random.random() * 100) for _ in range(rows)))
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--shards", type=int, default=8)
+    parser.add_argument("--rows", type=int, default=500_000, help="Rows per shard")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = build_shards(tmp, args.shards, args.rows)
+        sharded = ShardedTextToSQL(paths, model=NoModel(), workers=args.workers)
+        sharded.execute_query("SELECT COUNT(*) FROM events")  # start the worker processes
+        for sql_query in QUERIES:
+            start = time.perf_counter()
+            sharded._execute_attached(sql_query)
+            attached = time.perf_counter() - start
+
+            start = time.perf_counter()
+            sharded.execute_query(sql_query)
+            fanout = time.perf_counter() - start
+            print(f"attached={attached * 1000:8.1f} ms  fan-out={fanout * 1000:8.1f} ms  "
+                  f"({attached / fanout:4.1f}x)  {sql_query}")
+        sharded.close()
+
+
+if __name__ == "__main__":
+    main()
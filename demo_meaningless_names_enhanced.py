@@ -1,20 +1,25 @@
 import os
+import sys
 import sqlite3
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Union
 from sqlalchemy import create_engine, inspect
-import google.generativeai as genai
 from langchain.prompts import PromptTemplate
 from dotenv import load_dotenv
 
+sys.path.append('src')
+
+from comparison import Variant, compare_variants, print_comparison
+from model_routing import GeminiBackend
+from result_set import ColumnarResult
+
 load_dotenv()
 
 class TextToSQLEnhanced:
-    def __init__(self, db_path: str = "demo_meaningless_enhanced.db"):
+    def __init__(self, db_path: str = "demo_meaningless_enhanced.db", model=None):
         self.db_path = db_path
 
-        # Configure Gemini
-        genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-        self.model = genai.GenerativeModel('gemini-1.5-flash')
+        # Gemini, configured on first use, unless another model is passed in
+        self.model = model or GeminiBackend('gemini-1.5-flash')
 
         # Initialize database with meaningless column names
         self._init_database()
@@ -235,18 +240,22 @@ SQL query:"""
         except Exception as e:
             return f"Error generating SQL: {str(e)}"
 
-    def execute_query(self, sql_query: str) -> List[Dict[str, Any]]:
-        """Execute SQL query and return results"""
+    def execute_query(self, sql_query: str, columnar: bool = False) -> Union[List[Dict[str, Any]], ColumnarResult]:
+        """Execute SQL query and return results (a ColumnarResult with columnar=True)"""
         try:
             with sqlite3.connect(self.db_path) as conn:
+                if columnar:
+                    return ColumnarResult.from_cursor(conn.execute(sql_query))
                 conn.row_factory = sqlite3.Row
                 cursor = conn.execute(sql_query)
                 results = [dict(row) for row in cursor.fetchall()]
                 return results
         except Exception as e:
+            if columnar:
+                return ColumnarResult.from_error(str(e))
             return [{"error": str(e)}]
 
-    def show_comparison(self):
+    def show_comparison(self, requests_per_minute: Optional[float] = 15):
         """Show comparison between basic and enhanced schema"""
         print("=== 基础Schema (无元数据) ===")
         print(self.get_basic_schema())
@@ -256,30 +265,35 @@ SQL query:"""
 
         print("\n=== 对比测试 ===")
 
-        test_questions = [
-            "Show me all employees",
-            "Find employees older than 30",
-            "Show employees in the Engineering department",
-            "What is the average salary by department?"
+        test_cases = [
+            {"id": "all", "question": "Show me all employees",
+             "gold_sql": "SELECT * FROM t01"},
+            {"id": "age", "question": "Find employees older than 30",
+             "gold_sql": "SELECT * FROM t01 WHERE c003 > 30"},
+            {"id": "dept", "question": "Show employees in the Engineering department",
+             "gold_sql": "SELECT t01.* FROM t01 JOIN t02 ON t01.c004 = t02.c001 WHERE t02.c002 = 'Engineering'"},
+            {"id": "avg", "question": "What is the average salary by department?",
+             "gold_sql": "SELECT t02.c002, AVG(t01.c005) FROM t01 JOIN t02 ON t01.c004 = t02.c001 "
+                         "GROUP BY t02.c002"},
+        ]
+        variants = [
+            Variant("without_metadata", schema=lambda _: self.get_basic_schema(), template=self.prompt_template),
+            Variant("with_metadata", schema=lambda _: self.get_enhanced_schema(), template=self.prompt_template),
         ]
 
-        for question in test_questions:
-            print(f"\n问题: {question}")
-
-            # Without metadata
-            print("Without metadata:")
-            sql_without = self.generate_sql(question, use_metadata=False)
-            print(f"  SQL: {sql_without}")
+        # Both variants run concurrently, by default within the free tier's request rate
+        report = compare_variants(self, variants, test_cases, concurrency=4,
+                                  requests_per_minute=requests_per_minute)
 
-            # With metadata
-            print("With metadata:")
-            sql_with = self.generate_sql(question, use_metadata=True)
-            print(f"  SQL: {sql_with}")
+        for index, case in enumerate(test_cases):
+            print(f"\n问题: {case['question']}")
+            for name, summary in report["variants"].items():
+                outcome = summary["results"][index]
+                print(f"  {name}: {'✓' if outcome['correct'] else '✗'} {outcome['sql_query'] or outcome['error']}")
 
-            # Execute the better query
-            if sql_with and not sql_with.startswith("Error"):
-                results = self.execute_query(sql_with)
-                print(f"  Results: {results}")
+        print()
+        print_comparison(report)
+        return report
 
 if __name__ == "__main__":
     demo = TextToSQLEnhanced()
@@ -9,6 +9,7 @@ sys.path.append('src')
 from text_to_sql import TextToSQL
 from sql_validator import SQLValidator
 from database_utils import DatabaseUtils
+from session import Session
 
 def main():
     print("=== Text-to-SQL PoC Demo ===\n")
@@ -60,9 +61,12 @@ def main():
 
     # Interactive mode
     print("\n" + "=" * 50)
-    print("Interactive Mode (type 'quit' to exit)")
+    print("Interactive Mode (type 'quit' to exit, 'new' to start over)")
     print("=" * 50)
 
+    # Follow-up questions build on the previous ones
+    session = Session(text_to_sql)
+
     while True:
         user_question = input("\nAsk a question about the database: ").strip()
 
@@ -72,7 +76,12 @@ def main():
         if not user_question:
             continue
 
-        result = text_to_sql.query(user_question)
+        if user_question.lower() == 'new':
+            session.reset()
+            print("🔄 Started a new conversation")
+            continue
+
+        result = session.ask(user_question)
 
         if result['error']:
             print(f"❌ Error: {result['error']}")
@@ -85,6 +94,7 @@ def main():
             else:
                 print("📊 No results found")
 
+    session.close()
     print("\nThank you for using Text-to-SQL!")
 
 if __name__ == "__main__":
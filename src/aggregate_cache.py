@@ -0,0 +1,336 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+try:
+    from .query_stats import canonicalize
+    from .sqlite_access import SUMMARY_TABLE_PREFIX, connect, connect_writable, read_tables
+except ImportError:
+    from query_stats import canonicalize
+    from sqlite_access import SUMMARY_TABLE_PREFIX, connect, connect_writable, read_tables
+
+_AGGREGATE_PATTERN = re.compile(r'\b(count|sum|avg|min|max|total|group_concat)\s*\(|\bgroup by\b')
+
+# Results that differ between executions with unchanged data: random values,
+# connection state and the current date/time ('now', or a date function
+# called without a time value)
+_NONDETERMINISTIC_PATTERN = re.compile(r"""
+    \b(random|randomblob|changes|total_changes|last_insert_rowid)\(
+  | \bcurrent_(date|time|timestamp)\b
+  | '\s*now\s*'
+  | \b(date|time|datetime|julianday|unixepoch)\(\s*\)
+  | \bstrftime\('(?:[^']|'')*'\)
+""", re.VERBOSE | re.IGNORECASE)
+
+
+def is_aggregate_query(canonical_sql: str) -> bool:
+    """Check whether a canonicalized SELECT computes aggregates"""
+    return canonical_sql.startswith(('select ', 'with ')) and bool(_AGGREGATE_PATTERN.search(canonical_sql))
+
+
+def is_deterministic(canonical_sql: str) -> bool:
+    """Check that a canonicalized query calls no random, date('now')-style or connection-state functions"""
+    return not _NONDETERMINISTIC_PATTERN.search(canonical_sql)
+
+
+def is_cacheable(canonical_sql: str) -> bool:
+    return is_aggregate_query(canonical_sql) and is_deterministic(canonical_sql)
+
+
+def _quote(identifier: str) -> str:
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+class AggregateCache:
+    """Materialize frequently repeated aggregate queries into summary tables.
+
+    Once the same aggregate query (compared by canonical text, literals
+    included) has run min_calls times its result is stored in a summary
+    table and later executions read from that table instead. Triggers on
+    every base table the query reads mark its summaries dirty on INSERT,
+    UPDATE or DELETE; a dirty summary is recomputed on its next use unless
+    it was refreshed less than max_staleness seconds ago. At most
+    max_tables summaries of at most max_rows rows each are kept, least
+    recently used first out. Queries calling random(), date('now') and the
+    like are never cached. Summary columns are untyped, so values keep
+    their storage class, and are read back under the column names of the
+    spelling being served: canonical text ignores the case of aliases and
+    the layout of expressions, which SQLite's result names keep, so a
+    spelling is served from the summary once one of its executions has
+    shown its names (observe(sql, columns)). Hit counts, recency and
+    result names live in this process's memory; lookups only read the
+    database. Requires a writable database.
+    """
+
+    def __init__(self, db_path: str, min_calls: int = 3, max_staleness: float = 0.0,
+                 max_tables: int = 20, max_rows: int = 10000, max_tracked: int = 10000):
+        self.db_path = db_path
+        self.min_calls = min_calls
+        self.max_staleness = max_staleness
+        self.max_tables = max_tables
+        self.max_rows = max_rows
+        self.max_tracked = max_tracked
+        self.stats = {"hits": 0, "refreshes": 0, "materialized": 0, "evicted": 0, "too_large": 0}
+        self._calls = OrderedDict()  # canonical sql -> executions seen, most recent last
+        self._too_large = set()
+        self._usage = {}  # summary key -> [hits, last used]
+        self._names = OrderedDict()  # (summary key, statement text) -> result column names
+        self._lock = threading.RLock()
+        self._create_registry()
+
+    def _connect(self, writable: bool = True) -> sqlite3.Connection:
+        if writable:
+            conn = connect_writable(self.db_path, timeout=30)
+            if isinstance(conn, sqlite3.Connection):
+                conn.isolation_level = None  # transactions are managed explicitly
+        else:
+            conn = connect(self.db_path, 'read_only', timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _create_registry(self):
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS aggregate_cache (
+                    key TEXT PRIMARY KEY,
+                    sql TEXT NOT NULL,
+                    summary_table TEXT NOT NULL,
+                    base_tables TEXT NOT NULL,
+                    dirty INTEGER NOT NULL DEFAULT 0,
+                    refreshed_at REAL NOT NULL,
+                    row_count INTEGER NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    last_used REAL NOT NULL,
+                    columns TEXT
+                )
+            """)
+            if 'columns' not in {row["name"] for row in conn.execute("PRAGMA table_info(aggregate_cache)")}:
+                # Registries from before column names were kept; their rows are rematerialized
+                conn.execute("ALTER TABLE aggregate_cache ADD COLUMN columns TEXT")
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _key(canonical_sql: str) -> str:
+        return hashlib.sha1(canonical_sql.encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def _spelling(sql_query: str) -> str:
+        return sql_query.strip().rstrip(';').rstrip()
+
+    def _result_names(self, row: sqlite3.Row, sql_query: str) -> Optional[List[str]]:
+        """Column names sql_query's own result has, if known"""
+        names = self._names.get((row["key"], self._spelling(sql_query)))
+        if names is None and self._spelling(sql_query) == self._spelling(row["sql"]):
+            names = json.loads(row["columns"])
+        return names
+
+    def _install_triggers(self, conn: sqlite3.Connection, table: str):
+        for operation in ('INSERT', 'UPDATE', 'DELETE'):
+            name = _quote(f"{SUMMARY_TABLE_PREFIX}dirty_{table}_{operation.lower()}")
+            pattern = '%' + json.dumps(table).replace("'", "''") + '%'
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {name} AFTER {operation} ON {_quote(table)}
+                BEGIN
+                    UPDATE aggregate_cache SET dirty = 1 WHERE dirty = 0 AND base_tables LIKE '{pattern}';
+                END
+            """)
+
+    def _drop_unused_triggers(self, conn: sqlite3.Connection, tables: List[str]):
+        used = set()
+        for row in conn.execute("SELECT base_tables FROM aggregate_cache"):
+            used.update(json.loads(row["base_tables"]))
+        for table in tables:
+            if table not in used:
+                for operation in ('insert', 'update', 'delete'):
+                    conn.execute(f"DROP TRIGGER IF EXISTS {_quote(f'{SUMMARY_TABLE_PREFIX}dirty_{table}_{operation}')}")
+
+    def _materialize(self, conn: sqlite3.Connection, canonical_sql: str, sql_query: str):
+        key = self._key(canonical_sql)
+        summary_table = f"{SUMMARY_TABLE_PREFIX}{key}"
+        base_tables = read_tables(conn, sql_query)
+        if not base_tables:
+            return
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.execute(sql_query)
+            columns = [description[0] for description in cursor.description]
+            rows = cursor.fetchmany(self.max_rows + 1)
+            cursor.close()
+            if len(rows) > self.max_rows:
+                conn.execute("ROLLBACK")
+                self._too_large.add(canonical_sql)
+                self.stats["too_large"] += 1
+                return
+            # Positional, untyped columns: duplicate names survive and values keep their storage class
+            positions = [f"c{i}" for i in range(len(columns))]
+            conn.execute(f"DROP TABLE IF EXISTS {_quote(summary_table)}")
+            conn.execute(f"CREATE TABLE {_quote(summary_table)} ({', '.join(positions)})")
+            conn.executemany(f"INSERT INTO {_quote(summary_table)} VALUES ({', '.join('?' * len(columns))})",
+                             rows)
+            for table in base_tables:
+                self._install_triggers(conn, table)
+            now = time.time()
+            conn.execute("""
+                INSERT OR REPLACE INTO aggregate_cache
+                (key, sql, summary_table, base_tables, dirty, refreshed_at, row_count, hits, last_used, columns)
+                VALUES (?, ?, ?, ?, 0, ?, ?, 0, ?, ?)
+            """, (key, sql_query, summary_table, json.dumps(base_tables), now, len(rows), now,
+                  json.dumps(columns)))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._usage[key] = [0, now]
+        self.stats["materialized"] += 1
+        self._enforce_limits(conn)
+
+    def _last_used(self, row: sqlite3.Row) -> float:
+        usage = self._usage.get(row["key"])
+        return usage[1] if usage is not None else row["last_used"]
+
+    def _enforce_limits(self, conn: sqlite3.Connection):
+        """Drop least recently used summaries beyond max_tables"""
+        rows = conn.execute("SELECT key, summary_table, base_tables, last_used FROM aggregate_cache").fetchall()
+        rows.sort(key=self._last_used, reverse=True)
+        for row in rows[self.max_tables:]:
+            self._drop(conn, row)
+            self.stats["evicted"] += 1
+
+    def _drop(self, conn: sqlite3.Connection, row: sqlite3.Row):
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(f"DROP TABLE IF EXISTS {_quote(row['summary_table'])}")
+        conn.execute("DELETE FROM aggregate_cache WHERE key = ?", (row["key"],))
+        self._drop_unused_triggers(conn, json.loads(row["base_tables"]))
+        conn.execute("COMMIT")
+        self._usage.pop(row["key"], None)
+
+    def _refresh(self, conn: sqlite3.Connection, row: sqlite3.Row) -> bool:
+        """Recompute a dirty summary; writers are blocked meanwhile so no change is missed
+
+        Returns False if the summary outgrew max_rows and was dropped.
+        """
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            summary_table = _quote(row["summary_table"])
+            conn.execute(f"DELETE FROM {summary_table}")
+            conn.execute(f"INSERT INTO {summary_table} {row['sql']}")
+            row_count = conn.execute(f"SELECT COUNT(*) FROM {summary_table}").fetchone()[0]
+            if row_count > self.max_rows:
+                conn.execute("ROLLBACK")
+                self._drop(conn, row)
+                self._too_large.add(canonicalize(row["sql"]))
+                self.stats["too_large"] += 1
+                return False
+            conn.execute("UPDATE aggregate_cache SET dirty = 0, refreshed_at = ?, row_count = ? WHERE key = ?",
+                         (time.time(), row_count, row["key"]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self.stats["refreshes"] += 1
+        return True
+
+    def rewrite(self, sql_query: str) -> str:
+        """Return SQL reading from a summary table if one covers sql_query, else sql_query itself"""
+        canonical_sql = canonicalize(sql_query)
+        if not is_cacheable(canonical_sql):
+            return sql_query
+
+        with self._lock:
+            try:
+                conn = self._connect(writable=False)
+                try:
+                    row = conn.execute("SELECT * FROM aggregate_cache WHERE key = ?",
+                                       (self._key(canonical_sql),)).fetchone()
+                finally:
+                    conn.close()
+                if row is None or row["columns"] is None:
+                    return sql_query
+                names = self._result_names(row, sql_query)
+                if names is None:
+                    return sql_query  # run once as written; observe() learns this spelling's names
+                if row["dirty"] and time.time() - row["refreshed_at"] > self.max_staleness:
+                    conn = self._connect()
+                    try:
+                        if not self._refresh(conn, row):
+                            return sql_query
+                    finally:
+                        conn.close()
+            except sqlite3.Error:
+                # The summary is unusable (e.g. a base table changed shape); fall back to the base query
+                return sql_query
+            usage = self._usage.setdefault(row["key"], [0, 0.0])
+            usage[0] += 1
+            usage[1] = time.time()
+            self.stats["hits"] += 1
+            columns = ", ".join(f"c{i} AS {_quote(name)}" for i, name in enumerate(names))
+            return f"SELECT {columns} FROM {_quote(row['summary_table'])} ORDER BY rowid"
+
+    def observe(self, sql_query: str, columns: Optional[List[str]] = None):
+        """Count a successful execution and materialize the query once it is frequent
+
+        columns are the result column names of the execution, which let
+        later executions of this exact spelling be served from a summary.
+        """
+        canonical_sql = canonicalize(sql_query)
+        if not is_cacheable(canonical_sql) or canonical_sql in self._too_large:
+            return
+
+        with self._lock:
+            if columns is not None:
+                spelling = (self._key(canonical_sql), self._spelling(sql_query))
+                self._names.pop(spelling, None)
+                self._names[spelling] = list(columns)
+                if len(self._names) > self.max_tracked:
+                    self._names.popitem(last=False)
+            calls = self._calls.pop(canonical_sql, 0) + 1
+            self._calls[canonical_sql] = calls
+            if len(self._calls) > self.max_tracked:
+                self._calls.popitem(last=False)
+            if calls < self.min_calls:
+                return
+            del self._calls[canonical_sql]
+
+            conn = self._connect()
+            try:
+                self._materialize(conn, canonical_sql, sql_query)
+            except sqlite3.Error:
+                self._too_large.add(canonical_sql)  # e.g. read-only database; don't retry
+            finally:
+                conn.close()
+
+    def summaries(self) -> List[Dict[str, Any]]:
+        """Registered summary tables with their freshness and this process's usage"""
+        conn = self._connect(writable=False)
+        try:
+            rows = conn.execute("SELECT * FROM aggregate_cache").fetchall()
+        finally:
+            conn.close()
+        summaries = []
+        for row in rows:
+            summary = dict(row)
+            summary["hits"], summary["last_used"] = self._usage.get(row["key"], (0, row["last_used"]))
+            summaries.append(summary)
+        return sorted(summaries, key=lambda summary: -summary["last_used"])
+
+    def clear(self):
+        """Drop every summary table and its triggers"""
+        with self._lock:
+            conn = self._connect()
+            try:
+                for row in conn.execute("SELECT key, summary_table, base_tables FROM aggregate_cache").fetchall():
+                    self._drop(conn, row)
+            finally:
+                conn.close()
+            self._calls.clear()
+            self._too_large.clear()
+            self._usage.clear()
+            self._names.clear()
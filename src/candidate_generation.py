@@ -0,0 +1,231 @@
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+try:
+    from .prompt_builder import PromptPrefix, send_prompt
+    from .sql_validator import SQLValidator
+    from .sqlite_access import connect
+    from .evaluation import result_multiset
+except ImportError:
+    from prompt_builder import PromptPrefix, send_prompt
+    from sql_validator import SQLValidator
+    from sqlite_access import connect
+    from evaluation import result_multiset
+
+SELECTION_MODES = ('first_valid', 'majority')
+
+
+def clean_sql(text: str) -> str:
+    """Strip markdown code fences and whitespace from a model answer"""
+    text = text.strip()
+    match = re.match(r'^```(?:sql)?\s*(.*?)\s*```$', text, re.DOTALL | re.IGNORECASE)
+    return match.group(1).strip() if match else text
+
+
+class CandidateGenerator:
+    """Generate several SQL candidates concurrently and pick one.
+
+    Up to n generations are issued, either all at once or, with hedge_after
+    set, one at a time with another launched whenever hedge_after seconds
+    pass without an answer, a candidate fails, or ('majority') a result
+    arrives without a majority yet. Every candidate is checked with
+    SQLValidator and executed in parallel under execution_timeout seconds,
+    and its execution is recorded in the TextToSQL's query statistics. The answer is the first candidate that
+    executes successfully ('first_valid') or the result most candidates
+    agree on ('majority', which stops early once a strict majority agrees).
+    Outstanding generations are cancelled and running executions are
+    interrupted as soon as the answer is known.
+    """
+
+    def __init__(self, text_to_sql, n: int = 3, temperatures: Optional[Sequence[Optional[float]]] = None,
+                 hedge_after: Optional[float] = None, selection: str = 'first_valid',
+                 execution_timeout: float = 5.0, validator: Optional[SQLValidator] = None):
+        if selection not in SELECTION_MODES:
+            raise ValueError(f"Unknown selection mode: {selection} (expected one of {', '.join(SELECTION_MODES)})")
+        self.text_to_sql = text_to_sql
+        self.n = n
+        self.temperatures = list(temperatures) if temperatures else [None]
+        self.hedge_after = hedge_after
+        self.selection = selection
+        self.execution_timeout = execution_timeout
+        self.validator = validator or SQLValidator(text_to_sql.db_path, access_profile=text_to_sql.access_profile)
+
+    def _generate_one(self, prompt_parts: Tuple[PromptPrefix, str], temperature: Optional[float]) -> str:
+        kwargs = {} if temperature is None else {"generation_config": {"temperature": temperature}}
+        prefix, suffix = prompt_parts
+        response = send_prompt(self.text_to_sql.model, prefix, suffix, self.text_to_sql.token_usage, **kwargs)
+        return clean_sql(response.text)
+
+    def _execute_one(self, sql_query: str, cancel: threading.Event) -> List[Dict[str, Any]]:
+        """Execute a candidate, aborting when the budget runs out or the race is decided"""
+        start = time.perf_counter()
+        deadline = start + self.execution_timeout
+        try:
+            with connect(self.text_to_sql.db_path, self.text_to_sql.access_profile) as conn:
+                conn.set_progress_handler(
+                    lambda: 1 if cancel.is_set() or time.perf_counter() > deadline else 0, 1000)
+                cursor = conn.execute(sql_query)
+                columns = [description[0] for description in cursor.description or ()]
+                results = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        except Exception:
+            if not cancel.is_set():  # an execution cut short because the race was decided is no error
+                self.text_to_sql.query_stats.record(sql_query, time.perf_counter() - start, error=True)
+            raise
+        self.text_to_sql.query_stats.record(sql_query, time.perf_counter() - start, rows=len(results))
+        return results
+
+    def generate(self, question: str) -> Dict[str, Any]:
+        """Run the candidate race for a question and return a query()-style result"""
+        prompt_parts = self.text_to_sql.build_prompt_parts(question)
+        generation_pool = ThreadPoolExecutor(max_workers=self.n)
+        execution_pool = ThreadPoolExecutor(max_workers=self.n)
+        cancel = threading.Event()
+        start = time.perf_counter()
+
+        candidates = []
+        pending = {}  # future -> (stage, candidate)
+        executed = {}  # sql -> candidate already executed with that SQL
+        votes = defaultdict(list)  # result multiset -> candidates
+        winner = None
+
+        def launch():
+            candidate = {
+                "index": len(candidates),
+                "temperature": self.temperatures[len(candidates) % len(self.temperatures)],
+                "sql_query": None,
+                "status": "generating",
+                "errors": [],
+                "generation_seconds": None,
+                "results": None,
+            }
+            candidates.append(candidate)
+            future = generation_pool.submit(self._generate_one, prompt_parts, candidate["temperature"])
+            pending[future] = ("generate", candidate)
+
+        def accept(candidate) -> bool:
+            """Record a successful execution; return True if it decides the race"""
+            candidate["status"] = "ok"
+            if self.selection == 'first_valid':
+                return True
+            group = votes[frozenset(result_multiset(candidate["results"]).items())]
+            group.append(candidate)
+            return len(group) > self.n // 2
+
+        for _ in range(self.n if self.hedge_after is None else 1):
+            launch()
+        next_hedge = start + (self.hedge_after or 0)
+
+        try:
+            while pending and winner is None:
+                timeout = None
+                if self.hedge_after is not None and len(candidates) < self.n:
+                    timeout = max(0.0, next_hedge - time.perf_counter())
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                if not done:
+                    # Hedge: the outstanding calls are slow, issue another
+                    launch()
+                    next_hedge = time.perf_counter() + self.hedge_after
+                    continue
+
+                for future in done:
+                    stage, candidate = pending.pop(future)
+                    failed = undecided = False
+
+                    if stage == "generate":
+                        candidate["generation_seconds"] = time.perf_counter() - start
+                        try:
+                            sql_query = future.result()
+                        except Exception as e:
+                            candidate.update(status="error", errors=[f"Error generating SQL: {str(e)}"])
+                            failed = True
+                        else:
+                            candidate["sql_query"] = sql_query
+                            is_valid, errors = self.validator.validate_query(sql_query)
+                            if is_valid and not self.validator.is_read_only_query(sql_query):
+                                is_valid, errors = False, ["Only read-only queries are allowed"]
+                            if not is_valid:
+                                candidate.update(status="invalid", errors=errors)
+                                failed = True
+                            elif sql_query in executed:
+                                # Same SQL as an earlier candidate: reuse its execution
+                                previous = executed[sql_query]
+                                if previous["status"] == "ok":
+                                    candidate["results"] = previous["results"]
+                                    if not accept(candidate):
+                                        undecided = True
+                                    elif winner is None:
+                                        winner = candidate
+                                else:
+                                    candidate.update(status=previous["status"], errors=previous["errors"])
+                                    failed = previous["status"] != "executing"
+                            else:
+                                executed[sql_query] = candidate
+                                candidate["status"] = "executing"
+                                pending[execution_pool.submit(self._execute_one, sql_query, cancel)] = \
+                                    ("execute", candidate)
+                    else:
+                        # Candidates that repeated this SQL while it was running share the outcome
+                        sharing = [candidate] + [
+                            other for other in candidates
+                            if other is not candidate and other["sql_query"] == candidate["sql_query"]
+                            and other["status"] == "executing"
+                        ]
+                        try:
+                            results = future.result()
+                        except Exception as e:
+                            for member in sharing:
+                                member.update(status="failed", errors=[str(e)])
+                            failed = True
+                        else:
+                            for member in sharing:
+                                member["results"] = results
+                                if not accept(member):
+                                    undecided = True
+                                elif winner is None:
+                                    winner = member
+
+                    # A failed candidate, or a vote short of a majority, needs a successor now
+                    if ((failed or undecided) and winner is None and self.hedge_after is not None
+                            and len(candidates) < self.n):
+                        launch()
+                        next_hedge = time.perf_counter() + self.hedge_after
+
+            if winner is None and self.selection == 'majority' and votes:
+                # No strict majority: take the largest group, earliest finisher on ties
+                winner = max(votes.values(), key=len)[0]
+        finally:
+            cancel.set()
+            for future, (_, candidate) in pending.items():
+                future.cancel()
+                if candidate["status"] in ("generating", "executing"):
+                    candidate["status"] = "cancelled"
+            generation_pool.shutdown(wait=False, cancel_futures=True)
+            execution_pool.shutdown(wait=False, cancel_futures=True)
+
+        report = [{key: value for key, value in candidate.items() if key != "results"}
+                  for candidate in candidates]
+        elapsed = time.perf_counter() - start
+        if winner is None:
+            errors = [error for candidate in candidates for error in candidate["errors"]]
+            return {
+                "question": question,
+                "sql_query": None,
+                "results": [],
+                "error": "No valid SQL candidate: " + "; ".join(errors) if errors else "No valid SQL candidate",
+                "candidates": report,
+                "seconds": elapsed,
+            }
+        return {
+            "question": question,
+            "sql_query": winner["sql_query"],
+            "results": winner["results"],
+            "error": None,
+            "candidates": report,
+            "selected": winner["index"],
+            "seconds": elapsed,
+        }
@@ -0,0 +1,264 @@
+import json
+import mmap
+import os
+import re
+import struct
+import time
+import zlib
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    from .metadata_store import ColumnMetadata
+    from .sqlite_access import SharedDatabase, connect, is_memory_database
+except ImportError:
+    from metadata_store import ColumnMetadata
+    from sqlite_access import SharedDatabase, connect, is_memory_database
+
+# Catalog artifact layout (integers little-endian):
+#   b"T2SK" | u8 version | u32 header length | JSON header | body
+# The header records the catalog version the artifact was built from and,
+# for every table, [offset, length] (relative to the body) of its schema
+# text, metadata rows and column statistics, plus [offset, length] of the
+# retrieval index section:
+#   u32 bucket count | per bucket: u32 offset, u32 length | bucket payloads
+# Each bucket payload is a JSON object {term: [table names]} holding the
+# terms whose crc32 falls in that bucket, so a lookup decodes one bucket.
+ARTIFACT_MAGIC = b"T2SK"
+ARTIFACT_VERSION = 2
+ARTIFACT_SUFFIX = ".catalog"
+
+_PREFIX = struct.Struct("<4sBI")
+_U32 = struct.Struct("<I")
+_BUCKET = struct.Struct("<II")
+_TERMS_PER_BUCKET = 16
+_WORD = re.compile(r'[a-z0-9]+|[\u4e00-\u9fff]+')
+
+
+def index_terms(text: str) -> List[str]:
+    """Retrieval terms of a text: lowercase words (split on _), CJK character bigrams"""
+    terms = []
+    for word in _WORD.findall((text or "").lower()):
+        if '\u4e00' <= word[0] <= '\u9fff':
+            terms.extend(word[i:i + 2] for i in range(max(1, len(word) - 1)))
+        else:
+            terms.append(word)
+    return terms
+
+
+def artifact_path_for(db_path) -> str:
+    """Default artifact location next to the database file"""
+    if isinstance(db_path, SharedDatabase) or is_memory_database(db_path):
+        raise ValueError("Catalog artifacts need a database file")
+    if db_path.startswith('file:'):
+        db_path = db_path[len('file:'):].partition('?')[0]
+    return db_path + ARTIFACT_SUFFIX
+
+
+def _bucket_of(term: str, buckets: int) -> int:
+    return zlib.crc32(term.encode('utf-8')) % buckets
+
+
+def _index_section(index: Dict[str, set]) -> bytes:
+    """Encode a term -> tables index as hash buckets (see the layout above)"""
+    count = max(1, -(-len(index) // _TERMS_PER_BUCKET))
+    buckets = [{} for _ in range(count)]
+    for term, names in sorted(index.items()):
+        buckets[_bucket_of(term, count)][term] = sorted(names)
+
+    payloads = [json.dumps(bucket, ensure_ascii=False).encode('utf-8') for bucket in buckets]
+    directory = bytearray(_U32.pack(count))
+    offset = _U32.size + _BUCKET.size * count
+    for payload in payloads:
+        directory.extend(_BUCKET.pack(offset, len(payload)))
+        offset += len(payload)
+    return bytes(directory) + b"".join(payloads)
+
+
+def _jsonable(value: Any) -> Any:
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex()
+    return value
+
+
+def _column_stats(conn, table_name: str, columns: List[str], max_rows: int) -> Dict[str, Any]:
+    """Row count and per-column null/distinct counts and min/max (skipped above max_rows rows)"""
+    quoted = '"' + table_name.replace('"', '""') + '"'
+    row_count = conn.execute(f"SELECT COUNT(*) FROM {quoted}").fetchone()[0]
+    stats = {"rows": row_count, "columns": {}}
+    if row_count > max_rows or not columns:
+        return stats
+
+    expressions = []
+    for column in columns:
+        name = '"' + column.replace('"', '""') + '"'
+        expressions.append(f"COUNT({name}), COUNT(DISTINCT {name}), MIN({name}), MAX({name})")
+    values = conn.execute(f"SELECT {', '.join(expressions)} FROM {quoted}").fetchone()
+    for i, column in enumerate(columns):
+        non_null, distinct, minimum, maximum = values[i * 4:i * 4 + 4]
+        stats["columns"][column] = {
+            "nulls": row_count - non_null,
+            "distinct": distinct,
+            "min": _jsonable(minimum),
+            "max": _jsonable(maximum),
+        }
+    return stats
+
+
+def compile_catalog(text_to_sql, path: Optional[str] = None, column_stats: bool = True,
+                    stats_max_rows: int = 1_000_000) -> str:
+    """Build the catalog artifact for a TextToSQL's database and atomically install it.
+
+    The artifact holds the enhanced schema text of every table, the column
+    metadata, column statistics and an inverted index from terms of table,
+    column and business names to tables. It is written to a temporary file
+    and moved into place with os.replace, so readers never see a partial
+    artifact. Returns the artifact path.
+    """
+    path = path or artifact_path_for(text_to_sql.db_path)
+    version = text_to_sql.get_catalog_version()
+    tables = text_to_sql.get_table_names()
+    metadata = text_to_sql.metadata.tables(tables)
+
+    body = bytearray()
+    index = defaultdict(set)
+    header_tables = {}
+
+    def section(payload: bytes) -> List[int]:
+        offset = len(body)
+        body.extend(payload)
+        return [offset, len(payload)]
+
+    with connect(text_to_sql.db_path, text_to_sql.access_profile) as conn:
+        for table_name in tables:
+            columns = [row[1] for row in conn.execute(
+                f"PRAGMA table_info(\"{table_name.replace(chr(34), chr(34) * 2)}\")")]
+            rows = [[meta.column_name, meta.business_name, meta.description, meta.data_type,
+                     meta.example_value, meta.is_sensitive, meta.business_rules]
+                    for meta in metadata[table_name].values()]
+            stats = _column_stats(conn, table_name, columns, stats_max_rows) if column_stats else {}
+
+            header_tables[table_name] = {
+                "schema": section(text_to_sql.get_enhanced_schema(tables=[table_name]).encode('utf-8')),
+                "metadata": section(json.dumps(rows, ensure_ascii=False).encode('utf-8')),
+                "stats": section(json.dumps(stats, ensure_ascii=False).encode('utf-8')),
+            }
+
+            texts = [table_name] + columns + [text for row in rows for text in (row[1], row[2])]
+            for text in texts:
+                for term in index_terms(text):
+                    index[term].add(table_name)
+
+    header = json.dumps({
+        "schema_version": version[0],
+        "metadata_generation": version[1],
+        "created_at": time.time(),
+        "tables": header_tables,
+        "index": section(_index_section(index)),
+    }, ensure_ascii=False).encode('utf-8')
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_PREFIX.pack(ARTIFACT_MAGIC, ARTIFACT_VERSION, len(header)))
+        f.write(header)
+        f.write(body)
+    os.replace(tmp_path, path)
+    return path
+
+
+class CatalogArtifact:
+    """A compiled catalog, memory-mapped read-only.
+
+    Only the header is decoded on open; schema text, metadata and column
+    statistics are sliced out of the mapping per table when first asked
+    for, and find_tables() decodes only the index buckets of the question's
+    terms, so worker processes opening the same file share its pages.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_length = _PREFIX.unpack_from(self._map, 0)
+        if magic != ARTIFACT_MAGIC or version != ARTIFACT_VERSION:
+            self._map.close()
+            raise ValueError(f"{path} is not a version {ARTIFACT_VERSION} catalog artifact")
+        header = json.loads(self._map[_PREFIX.size:_PREFIX.size + header_length].decode('utf-8'))
+        self._body = _PREFIX.size + header_length
+        self.version = (header["schema_version"], header["metadata_generation"])
+        self.created_at = header["created_at"]
+        self._tables = header["tables"]
+        self._index_offset = self._body + header["index"][0]
+        self._buckets = _U32.unpack_from(self._map, self._index_offset)[0]
+        self._metadata = {}
+
+    def _section(self, table_name: str, name: str) -> bytes:
+        offset, length = self._tables[table_name][name]
+        return self._map[self._body + offset:self._body + offset + length]
+
+    def _postings(self, term: str) -> List[str]:
+        """Tables indexed under a term, read from its bucket of the index section"""
+        position = self._index_offset + _U32.size + _BUCKET.size * _bucket_of(term, self._buckets)
+        offset, length = _BUCKET.unpack_from(self._map, position)
+        start = self._index_offset + offset
+        return json.loads(self._map[start:start + length]).get(term, [])
+
+    @property
+    def table_names(self) -> List[str]:
+        return list(self._tables)
+
+    def schema(self, tables: Optional[List[str]] = None) -> str:
+        """Schema text for all tables, or for the given ones, as get_enhanced_schema() renders it"""
+        names = self._tables if tables is None else [name for name in self._tables if name in tables]
+        return "\n".join(self._section(name, "schema").decode('utf-8') for name in names)
+
+    def table_metadata(self, table_name: str) -> Dict[str, ColumnMetadata]:
+        """Metadata records of one table's columns"""
+        if table_name not in self._tables:
+            return {}
+        records = self._metadata.get(table_name)
+        if records is None:
+            rows = json.loads(self._section(table_name, "metadata"))
+            records = self._metadata[table_name] = {row[0]: ColumnMetadata(table_name, *row) for row in rows}
+        return records
+
+    def column_stats(self, table_name: str) -> Dict[str, Any]:
+        """{"rows": n, "columns": {name: {nulls, distinct, min, max}}} for a table"""
+        if table_name not in self._tables:
+            return {}
+        return json.loads(self._section(table_name, "stats"))
+
+    def find_tables(self, question: str, limit: Optional[int] = None) -> List[str]:
+        """Tables whose names, columns or business metadata share terms with question, best first"""
+        scores = defaultdict(int)
+        for term in set(index_terms(question)):
+            for table_name in self._postings(term):
+                scores[table_name] += 1
+        ranked = sorted(scores, key=lambda name: (-scores[name], name))
+        return ranked[:limit] if limit else ranked
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self) -> 'CatalogArtifact':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def load_catalog(text_to_sql, path: Optional[str] = None, current: Optional[Tuple[int, int]] = None,
+                 **compile_options) -> CatalogArtifact:
+    """Open the artifact for a TextToSQL, (re)compiling it if missing or stale"""
+    path = path or artifact_path_for(text_to_sql.db_path)
+    current = current or text_to_sql.get_catalog_version()
+    try:
+        artifact = CatalogArtifact(path)
+    except (OSError, ValueError, struct.error):
+        artifact = None
+    if artifact is not None and artifact.version == current:
+        return artifact
+    if artifact is not None:
+        artifact.close()
+    compile_catalog(text_to_sql, path, **compile_options)
+    return CatalogArtifact(path)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Command line tools for Text-to-SQL databases
+
+    python src/cli.py top-queries --db example.db -n 10 --sort mean_time
+    python src/cli.py compile-catalog --db example.db
+    python src/cli.py trace --db example.db --sql "SELECT * FROM orders" --folded trace.folded
+"""
+import argparse
+import sys
+from typing import List, Optional
+
+try:
+    from .query_stats import QueryStatsTable, SORT_KEYS
+    from .catalog_artifact import CatalogArtifact, compile_catalog
+    from .tracing import Tracer, print_trace
+except ImportError:
+    from query_stats import QueryStatsTable, SORT_KEYS
+    from catalog_artifact import CatalogArtifact, compile_catalog
+    from tracing import Tracer, print_trace
+
+
+def top_queries(args) -> int:
+    """Print the top-N query fingerprints from the query_stats table"""
+    entries = QueryStatsTable(args.stats_db or args.db).top(args.n, args.sort)
+    if not entries:
+        print("No query statistics recorded")
+        return 0
+
+    print(f"{'calls':>7} {'total ms':>10} {'mean ms':>9} {'max ms':>9} {'rows':>9} {'errors':>6}  query")
+    for entry in entries:
+        query = entry["query"]
+        if len(query) > args.width:
+            query = query[:args.width - 3] + "..."
+        print(f"{entry['calls']:>7} {entry['total_time'] * 1000:>10.1f} {entry['mean_time'] * 1000:>9.2f} "
+              f"{entry['max_time'] * 1000:>9.2f} {entry['rows']:>9} {entry['errors']:>6}  {query}")
+    return 0
+
+
+def compile_catalog_command(args) -> int:
+    """Build the precompiled catalog artifact workers memory-map on start"""
+    try:
+        from .text_to_sql import TextToSQL
+    except ImportError:
+        from text_to_sql import TextToSQL
+
+    text_to_sql = TextToSQL(args.db, seed_sample_data=False, access_profile=args.access_profile)
+    try:
+        path = compile_catalog(text_to_sql, args.output, column_stats=not args.no_column_stats,
+                               stats_max_rows=args.stats_max_rows)
+    finally:
+        text_to_sql.close()
+
+    with CatalogArtifact(path) as artifact:
+        print(f"Wrote {path}: {len(artifact.table_names)} tables, "
+              f"schema_version={artifact.version[0]}, metadata_generation={artifact.version[1]}")
+    return 0
+
+
+def trace_command(args) -> int:
+    """Run one question (or statement) with every library-issued statement traced"""
+    try:
+        from .text_to_sql import TextToSQL
+    except ImportError:
+        from text_to_sql import TextToSQL
+
+    text_to_sql = TextToSQL(args.db, seed_sample_data=False, access_profile=args.access_profile)
+    try:
+        with Tracer(progress_steps=args.progress_steps, profile=bool(args.folded)) as tracer:
+            if args.sql:
+                text_to_sql.execute_query(args.query)
+            else:
+                text_to_sql.query(args.query)
+    finally:
+        text_to_sql.close()
+
+    print_trace(tracer.report(args.n))
+    if args.folded:
+        stacks = tracer.export_folded(args.folded)
+        print(f"Wrote {stacks} folded stacks to {args.folded}")
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Text-to-SQL command line tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    top = subparsers.add_parser("top-queries", help="List the most expensive query fingerprints")
+    top.add_argument("--db", default="example.db", help="Database the statistics were flushed to, "
+                                                        "if it was its own stats_db_path")
+    top.add_argument("--stats-db", help="Statistics database (the stats_db_path that was configured)")
+    top.add_argument("-n", type=int, default=10, help="Number of fingerprints to show")
+    top.add_argument("--sort", choices=SORT_KEYS, default="total_time")
+    top.add_argument("--width", type=int, default=100, help="Truncate queries to this many characters")
+    top.set_defaults(handler=top_queries)
+
+    warm = subparsers.add_parser("compile-catalog", aliases=["warm"],
+                                 help="Precompile schema, metadata, column stats and indexes into one file")
+    warm.add_argument("--db", default="example.db", help="Database to compile")
+    warm.add_argument("--output", help="Artifact path (default: <db>.catalog)")
+    warm.add_argument("--access-profile", default=None)
+    warm.add_argument("--no-column-stats", action="store_true", help="Skip per-column statistics")
+    warm.add_argument("--stats-max-rows", type=int, default=1_000_000,
+                      help="Only row counts for tables larger than this")
+    warm.set_defaults(handler=compile_catalog_command)
+
+    trace = subparsers.add_parser("trace", help="Trace the SQL statements one question issues")
+    trace.add_argument("query", help="Natural language question, or SQL with --sql")
+    trace.add_argument("--db", default="example.db", help="Database to query")
+    trace.add_argument("--sql", action="store_true", help="The query is SQL: only execute it")
+    trace.add_argument("--access-profile", default=None)
+    trace.add_argument("--progress-steps", type=int, default=1000, help="VM steps between progress callbacks")
+    trace.add_argument("-n", type=int, default=10, help="Number of statement fingerprints to show")
+    trace.add_argument("--folded", help="Also profile and write folded stacks (flamegraph.pl input) here")
+    trace.set_defaults(handler=trace_command)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+A/B comparison of prompt and schema-serialization variants
+
+Runs every case of an evaluation suite through each variant concurrently,
+under request and token rate limits, and reports accuracy, prompt tokens
+and latency distributions per variant, plus the differences from the
+first (baseline) variant.
+
+    python src/comparison.py --db example.db --suite suite.jsonl --recordings recordings.json --record --rpm 15
+    python src/comparison.py --db example.db --suite suite.jsonl --variants variants.json \\
+        --recordings recordings.json --report comparison.json
+
+A variants file is a JSON list of {"name", "schema", "template" or
+"template_file"} objects; schema is one of SCHEMA_SERIALIZERS.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+try:
+    from .evaluation import ReplayModel, estimate_tokens, evaluate_case, load_suite, summarize
+    from .model_routing import GeminiBackend
+    from .prompt_builder import PromptBuilder, PromptPrefix
+    from .text_to_sql import TextToSQL
+except ImportError:
+    from evaluation import ReplayModel, estimate_tokens, evaluate_case, load_suite, summarize
+    from model_routing import GeminiBackend
+    from prompt_builder import PromptBuilder, PromptPrefix
+    from text_to_sql import TextToSQL
+
+SCHEMA_SERIALIZERS: Dict[str, Callable[[Any], str]] = {
+    'enhanced': lambda text_to_sql: text_to_sql.get_database_schema(),
+    'basic': lambda text_to_sql: text_to_sql.get_enhanced_schema(include_metadata=False),
+}
+
+
+class Variant:
+    """One configuration under comparison: a schema serialization and a prompt template
+
+    schema is a SCHEMA_SERIALIZERS name or a callable taking the TextToSQL;
+    template uses {schema} and then {question} and defaults to the
+    TextToSQL's own prompt. model, if given, replaces the TextToSQL's model.
+    """
+
+    def __init__(self, name: str, schema: Union[str, Callable[[Any], str]] = 'enhanced',
+                 template: Optional[str] = None, model=None):
+        if isinstance(schema, str) and schema not in SCHEMA_SERIALIZERS:
+            raise ValueError(f"Unknown schema serialization {schema!r}; "
+                             f"expected one of {', '.join(SCHEMA_SERIALIZERS)}")
+        self.name = name
+        self.schema = schema
+        self.template = template
+        self.model = model
+        self._builder = PromptBuilder(template) if template is not None else None
+
+    @classmethod
+    def from_dict(cls, spec: Dict[str, Any], base_dir: str = ".") -> 'Variant':
+        template = spec.get("template")
+        if spec.get("template_file"):
+            with open(os.path.join(base_dir, spec["template_file"]), encoding='utf-8') as f:
+                template = f.read()
+        return cls(spec["name"], spec.get("schema", 'enhanced'), template)
+
+    def render_schema(self, text_to_sql) -> str:
+        serializer = SCHEMA_SERIALIZERS[self.schema] if isinstance(self.schema, str) else self.schema
+        return serializer(text_to_sql)
+
+    def build_prompt_parts(self, text_to_sql, question: str, schema: str) -> Tuple[PromptPrefix, str]:
+        if self._builder is None:
+            return text_to_sql.build_prompt_parts(question, schema)
+        return self._builder.build(schema, question)
+
+    def build_prompt(self, text_to_sql, question: str, schema: str) -> str:
+        prefix, suffix = self.build_prompt_parts(text_to_sql, question, schema)
+        return prefix.text + suffix
+
+
+DEFAULT_VARIANTS = [Variant("without_metadata", 'basic'), Variant("with_metadata", 'enhanced')]
+
+
+class RateLimiter:
+    """Token bucket refilled at per_minute units a minute, holding at most burst units
+
+    With the default burst of one unit, requests are spaced evenly.
+    """
+
+    def __init__(self, per_minute: float, burst: float = 1.0):
+        self.rate = per_minute / 60.0
+        self.capacity = burst
+        self._available = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1.0) -> float:
+        """Block until amount units are available; returns the seconds waited"""
+        # Requests larger than the bucket are let through once it is full
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._available = min(self.capacity, self._available + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._available >= amount:
+                    self._available -= amount
+                    return waited
+                delay = (amount - self._available) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class RateLimitedModel:
+    """Wraps a model so each call first takes a request and its prompt tokens from the limiters
+
+    The time spent waiting is kept per thread in last_wait so it can be
+    reported apart from the model's own latency.
+    """
+
+    def __init__(self, model, requests: Optional[RateLimiter] = None, tokens: Optional[RateLimiter] = None):
+        self.model = model
+        self.requests = requests
+        self.tokens = tokens
+        self._local = threading.local()
+
+    @property
+    def last_wait(self) -> float:
+        return getattr(self._local, 'wait', 0.0)
+
+    def _acquire(self, prompt_tokens: int):
+        wait = 0.0
+        if self.requests is not None:
+            wait += self.requests.acquire()
+        if self.tokens is not None:
+            wait += self.tokens.acquire(prompt_tokens)
+        self._local.wait = wait
+
+    def generate_content(self, prompt: str, **kwargs):
+        self._acquire(estimate_tokens(prompt))
+        return self.model.generate_content(prompt, **kwargs)
+
+    def generate_with_prefix(self, prefix: PromptPrefix, suffix: str, **kwargs):
+        self._acquire(prefix.tokens + estimate_tokens(suffix))
+        if hasattr(self.model, 'generate_with_prefix'):
+            return self.model.generate_with_prefix(prefix, suffix, **kwargs)
+        return self.model.generate_content(prefix.text + suffix, **kwargs)
+
+    def __getattr__(self, name):
+        # usage(), new_records etc. of the wrapped model
+        return getattr(self.model, name)
+
+
+def _distribution(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def percentile(fraction: float) -> float:
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+    return {"mean": sum(ordered) / len(ordered), "min": ordered[0], "p50": percentile(0.50),
+            "p95": percentile(0.95), "max": ordered[-1]}
+
+
+def compare_variants(text_to_sql, variants: List[Variant], cases: List[Dict[str, Any]],
+                     concurrency: int = 4, requests_per_minute: Optional[float] = None,
+                     tokens_per_minute: Optional[float] = None) -> Dict[str, Any]:
+    """Run every case through every variant concurrently and compare them
+
+    The first variant is the baseline. Cases are interleaved across
+    variants, so rate limiting and load affect all of them alike. Rate
+    limits are shared by all variants; time spent waiting for them is
+    reported as queue_ms and excluded from the generate stage.
+    text_to_sql needs model and execute_query (with columnar=True), and get_database_schema /
+    get_enhanced_schema / build_prompt_parts for the variants that use
+    them; its token_usage is updated if it has one.
+    """
+    names = [variant.name for variant in variants]
+    if len(set(names)) != len(names):
+        raise ValueError("Variant names must be unique")
+
+    requests = RateLimiter(requests_per_minute) if requests_per_minute else None
+    tokens = RateLimiter(tokens_per_minute, burst=tokens_per_minute / 60.0 * 10) if tokens_per_minute else None
+    models = {variant.name: RateLimitedModel(variant.model or text_to_sql.model, requests, tokens)
+              for variant in variants}
+
+    # Gold results do not depend on the variant
+    gold = {case["id"]: text_to_sql.execute_query(case["gold_sql"], columnar=True) for case in cases}
+
+    def run(variant: Variant, case: Dict[str, Any]) -> Dict[str, Any]:
+        model = models[variant.name]
+        start = time.perf_counter()
+        outcome = evaluate_case(text_to_sql, case, variant=variant, model=model, gold=gold[case["id"]])
+        wait = model.last_wait
+        outcome["timings"]["generate"] -= wait
+        outcome["queue_ms"] = wait * 1000
+        outcome["latency_ms"] = (time.perf_counter() - start - wait) * 1000
+        return outcome
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="comparison") as pool:
+        futures = [(variant.name, pool.submit(run, variant, case)) for case in cases for variant in variants]
+        outcomes = {name: [] for name in names}
+        for name, future in futures:
+            outcomes[name].append(future.result())
+    wall_seconds = time.perf_counter() - start
+
+    report_variants = {}
+    for name in names:
+        summary = summarize(outcomes[name], wall_seconds)
+        summary["prompt_tokens"] = _distribution([o["prompt_tokens"] for o in outcomes[name]])
+        summary["latency_ms"] = _distribution([o["latency_ms"] for o in outcomes[name]])
+        summary["generate_ms"] = _distribution([o["timings"]["generate"] * 1000 for o in outcomes[name]])
+        summary["queue_ms"] = _distribution([o["queue_ms"] for o in outcomes[name]])
+        report_variants[name] = summary
+
+    baseline = report_variants[names[0]]
+    deltas = {}
+    for name in names[1:]:
+        summary = report_variants[name]
+        deltas[name] = {
+            "accuracy": summary["accuracy"] - baseline["accuracy"],
+            "prompt_tokens_mean": summary["prompt_tokens"]["mean"] - baseline["prompt_tokens"]["mean"],
+            "latency_p50_ms": summary["latency_ms"]["p50"] - baseline["latency_ms"]["p50"],
+            "latency_p95_ms": summary["latency_ms"]["p95"] - baseline["latency_ms"]["p95"],
+        }
+
+    # Cases on which the variants do not all agree
+    disagreements = []
+    for index, case in enumerate(cases):
+        correct = {name: outcomes[name][index]["correct"] for name in names}
+        if len(set(correct.values())) > 1:
+            disagreements.append({"id": case["id"], "question": case["question"], "correct": correct,
+                                  "sql": {name: outcomes[name][index]["sql_query"] for name in names}})
+
+    return {
+        "cases": len(cases),
+        "concurrency": concurrency,
+        "requests_per_minute": requests_per_minute,
+        "tokens_per_minute": tokens_per_minute,
+        "wall_seconds": wall_seconds,
+        "baseline": names[0],
+        "variants": report_variants,
+        "deltas": deltas,
+        "disagreements": disagreements,
+    }
+
+
+def print_comparison(report: Dict[str, Any]):
+    print(f"Cases: {report['cases']}  Variants: {len(report['variants'])}  "
+          f"Wall time: {report['wall_seconds']:.2f}s")
+    print(f"{'variant':<20} {'accuracy':>9} {'errors':>7} {'tokens':>8} {'p50 ms':>9} {'p95 ms':>9} {'queue ms':>9}")
+    for name, summary in report["variants"].items():
+        print(f"{name:<20} {summary['accuracy']:>9.1%} {summary['errors']:>7} "
+              f"{summary['prompt_tokens']['mean']:>8.0f} {summary['latency_ms']['p50']:>9.1f} "
+              f"{summary['latency_ms']['p95']:>9.1f} {summary['queue_ms']['mean']:>9.1f}")
+    for name, delta in report["deltas"].items():
+        print(f"  {name} vs {report['baseline']}: accuracy {delta['accuracy']:+.1%}, "
+              f"prompt tokens {delta['prompt_tokens_mean']:+.0f}, p50 {delta['latency_p50_ms']:+.1f} ms")
+    for case in report["disagreements"]:
+        marks = "  ".join(f"{name}={'✓' if ok else '✗'}" for name, ok in case["correct"].items())
+        print(f"  [{case['id']}] {case['question']}: {marks}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Compare prompt/schema variants on an evaluation suite")
+    parser.add_argument("--db", default="example.db", help="SQLite database to evaluate against")
+    parser.add_argument("--suite", required=True, help="JSON/JSONL file of {question, gold_sql} cases")
+    parser.add_argument("--variants", help="JSON list of variants (default: without vs with metadata)")
+    parser.add_argument("--recordings", required=True, help="Recorded model responses (JSON)")
+    parser.add_argument("--record", action="store_true", help="Call the live model for unrecorded prompts")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rpm", type=float, default=None, help="Model requests per minute")
+    parser.add_argument("--tpm", type=float, default=None, help="Prompt tokens per minute")
+    parser.add_argument("--access-profile", default=None)
+    parser.add_argument("--report", help="Write the full report as JSON to this path")
+    args = parser.parse_args(argv)
+
+    variants = DEFAULT_VARIANTS
+    if args.variants:
+        with open(args.variants, encoding='utf-8') as f:
+            variants = [Variant.from_dict(spec, os.path.dirname(args.variants)) for spec in json.load(f)]
+
+    model = GeminiBackend('gemini-1.5-flash') if args.record else None
+    replay = ReplayModel(args.recordings, model=model, record=args.record)
+    text_to_sql = TextToSQL(args.db, model=replay, seed_sample_data=False, access_profile=args.access_profile)
+    try:
+        report = compare_variants(text_to_sql, variants, load_suite(args.suite), concurrency=args.concurrency,
+                                  requests_per_minute=args.rpm, tokens_per_minute=args.tpm)
+    finally:
+        replay.save()
+        text_to_sql.close()
+
+    print_comparison(report)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
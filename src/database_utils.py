@@ -1,54 +1,78 @@
 import sqlite3
-from typing import List, Dict, Any
-from sqlalchemy import create_engine, inspect, text
+from typing import List, Dict, Any, Optional, Union
+from sqlalchemy import inspect, text
+
+try:
+    from .sqlite_access import is_internal_table, connect, create_sqlite_engine, get_access_profile, AccessProfile, \
+        as_database, keep_alive
+    from .tracing import explain, stage
+except ImportError:
+    from sqlite_access import is_internal_table, connect, create_sqlite_engine, get_access_profile, AccessProfile, \
+        as_database, keep_alive
+    from tracing import explain, stage
 
 class DatabaseUtils:
-    def __init__(self, db_path: str = "example.db"):
-        self.db_path = db_path
-        self.engine = create_engine(f"sqlite:///{db_path}")
+    def __init__(self, db_path: str = "example.db", access_profile: Union[str, AccessProfile, None] = None,
+                 connection: Optional[sqlite3.Connection] = None, engine=None):
+        self.db_path = as_database(db_path, connection=connection, engine=engine)
+        self.access_profile = get_access_profile(access_profile)
+        self._keeper = keep_alive(self.db_path)
+        self.engine = create_sqlite_engine(self.db_path, self.access_profile)
+
+    def close(self):
+        """Release connections; an in-memory database no one else holds is discarded"""
+        if self.engine is not getattr(self.db_path, 'engine', None):
+            self.engine.dispose()
+        if self._keeper is not None:
+            self._keeper.close()
+            self._keeper = None
 
     def get_table_info(self) -> List[Dict[str, Any]]:
         """Get detailed information about all tables"""
-        inspector = inspect(self.engine)
-        tables_info = []
-
-        for table_name in inspector.get_table_names():
-            columns = inspector.get_columns(table_name)
-            foreign_keys = inspector.get_foreign_keys(table_name)
-            primary_keys = inspector.get_pk_constraint(table_name)
-
-            table_info = {
-                "name": table_name,
-                "columns": [],
-                "primary_keys": primary_keys.get("constrained_columns", []),
-                "foreign_keys": []
-            }
-
-            for column in columns:
-                table_info["columns"].append({
-                    "name": column["name"],
-                    "type": str(column["type"]),
-                    "nullable": column["nullable"],
-                    "primary_key": column["primary_key"],
-                    "default": column.get("default")
-                })
-
-            for fk in foreign_keys:
-                table_info["foreign_keys"].append({
-                    "name": fk["name"],
-                    "constrained_columns": fk["constrained_columns"],
-                    "referred_table": fk["referred_table"],
-                    "referred_columns": fk["referred_columns"]
-                })
-
-            tables_info.append(table_info)
+        with stage('table_info'):
+            inspector = inspect(self.engine)
+            tables_info = []
+
+            for table_name in inspector.get_table_names():
+                if is_internal_table(table_name):
+                    continue  # Skip the library's metadata tables
+
+                columns = inspector.get_columns(table_name)
+                foreign_keys = inspector.get_foreign_keys(table_name)
+                primary_keys = inspector.get_pk_constraint(table_name)
+
+                table_info = {
+                    "name": table_name,
+                    "columns": [],
+                    "primary_keys": primary_keys.get("constrained_columns", []),
+                    "foreign_keys": []
+                }
+
+                for column in columns:
+                    table_info["columns"].append({
+                        "name": column["name"],
+                        "type": str(column["type"]),
+                        "nullable": column["nullable"],
+                        "primary_key": column["primary_key"],
+                        "default": column.get("default")
+                    })
+
+                for fk in foreign_keys:
+                    table_info["foreign_keys"].append({
+                        "name": fk["name"],
+                        "constrained_columns": fk["constrained_columns"],
+                        "referred_table": fk["referred_table"],
+                        "referred_columns": fk["referred_columns"]
+                    })
+
+                tables_info.append(table_info)
 
         return tables_info
 
     def get_sample_data(self, table_name: str, limit: int = 5) -> List[Dict[str, Any]]:
         """Get sample data from a table"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with stage('sample_data'), connect(self.db_path, self.access_profile) as conn:
                 conn.row_factory = sqlite3.Row
                 cursor = conn.execute(f"SELECT * FROM {table_name} LIMIT {limit}")
                 return [dict(row) for row in cursor.fetchall()]
@@ -58,15 +82,16 @@ class DatabaseUtils:
     def validate_sql(self, sql_query: str) -> bool:
         """Validate if SQL query is syntactically correct"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute(f"EXPLAIN {sql_query}")
+            with stage('validate'), connect(self.db_path, self.access_profile) as conn:
+                explain(conn, sql_query)
                 return True
         except:
             return False
 
     def format_schema_for_llm(self) -> str:
         """Format database schema in LLM-friendly format"""
-        tables_info = self.get_table_info()
+        with stage('format_schema'):
+            tables_info = self.get_table_info()
         schema_parts = []
 
         for table in tables_info:
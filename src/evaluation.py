@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+Offline evaluation harness for the Text-to-SQL pipeline
+
+Runs a suite of question / gold-SQL pairs through TextToSQL against a
+record/replay model, scores execution-match accuracy and reports per-stage
+latency, throughput and token counts.
+
+    python src/evaluation.py --db example.db --suite suite.jsonl --recordings recordings.json --record
+    python src/evaluation.py --db example.db --suite suite.jsonl --recordings recordings.json --report report.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.util import Finalize
+from typing import Any, Dict, List, Optional, Union
+
+try:
+    from .model_routing import GeminiBackend
+    from .prompt_builder import PromptPrefix, estimate_tokens, send_prompt
+    from .result_set import ColumnarResult
+    from .text_to_sql import TextToSQL
+except ImportError:
+    from model_routing import GeminiBackend
+    from prompt_builder import PromptPrefix, estimate_tokens, send_prompt
+    from result_set import ColumnarResult
+    from text_to_sql import TextToSQL
+
+STAGES = ('schema', 'prompt', 'generate', 'execute')
+
+
+def prompt_key(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+
+class ReplayMiss(KeyError):
+    """No response was recorded for a prompt"""
+
+
+class ReplayResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class ReplayModel:
+    """Model stand-in that answers from recorded responses.
+
+    In replay mode every prompt must have been recorded before; unknown
+    prompts raise ReplayMiss. In record mode the wrapped model is called
+    for unknown prompts (through send_prompt, so a backend's context cache
+    still applies) and its answer is kept in new_records until save() is
+    called.
+    """
+
+    def __init__(self, recordings_path: Optional[str] = None, model=None, record: bool = False):
+        self.recordings_path = recordings_path
+        self.model = model
+        self.record = record
+        self.records = {}
+        self.new_records = {}
+        if recordings_path and os.path.exists(recordings_path):
+            with open(recordings_path, encoding='utf-8') as f:
+                self.records = json.load(f)
+
+    def generate_content(self, prompt: str, **kwargs) -> ReplayResponse:
+        return self._replay(prompt, lambda: self.model.generate_content(prompt, **kwargs))
+
+    def generate_with_prefix(self, prefix: PromptPrefix, suffix: str, **kwargs) -> ReplayResponse:
+        return self._replay(prefix.text + suffix, lambda: send_prompt(self.model, prefix, suffix, **kwargs))
+
+    def _replay(self, prompt: str, generate) -> ReplayResponse:
+        key = prompt_key(prompt)
+        entry = self.records.get(key) or self.new_records.get(key)
+        if entry is None:
+            if not self.record or self.model is None:
+                raise ReplayMiss(f"No recorded response for prompt {key[:12]}")
+            start = time.perf_counter()
+            response = generate()
+            entry = {
+                "text": response.text,
+                "prompt_tokens": estimate_tokens(prompt),
+                "output_tokens": estimate_tokens(response.text),
+                "latency": time.perf_counter() - start,
+            }
+            self.new_records[key] = entry
+        return ReplayResponse(entry["text"])
+
+    def usage(self, prompt: str) -> Dict[str, int]:
+        """Token counts for a prompt, recorded if available, otherwise estimated"""
+        entry = self.records.get(prompt_key(prompt)) or self.new_records.get(prompt_key(prompt)) or {}
+        return {
+            "prompt_tokens": entry.get("prompt_tokens", estimate_tokens(prompt)),
+            "output_tokens": entry.get("output_tokens", estimate_tokens(entry.get("text", ""))),
+        }
+
+    def merge(self, records: Dict[str, Any]):
+        self.new_records.update(records)
+
+    def save(self):
+        """Write recorded responses back to the recordings file"""
+        if not self.recordings_path or not self.new_records:
+            return
+        self.records.update(self.new_records)
+        self.new_records = {}
+        with open(self.recordings_path, 'w', encoding='utf-8') as f:
+            json.dump(self.records, f, ensure_ascii=False, indent=1, sort_keys=True)
+
+
+def load_suite(path: str) -> List[Dict[str, Any]]:
+    """Load question/gold-SQL cases from a JSON list or a JSONL file"""
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    if text.lstrip().startswith('['):
+        cases = json.loads(text)
+    else:
+        cases = [json.loads(line) for line in text.splitlines() if line.strip()]
+    for index, case in enumerate(cases):
+        case.setdefault("id", str(index))
+    return cases
+
+
+def _normalize_value(value: Any) -> Any:
+    return round(value, 6) if isinstance(value, float) else value
+
+
+def result_multiset(rows: Union[ColumnarResult, List[Dict[str, Any]]]) -> Counter:
+    """Rows as a multiset of value tuples (column names and order ignored)"""
+    values = rows.to_tuples() if isinstance(rows, ColumnarResult) else (row.values() for row in rows)
+    return Counter(tuple(_normalize_value(value) for value in row) for row in values)
+
+
+def execution_match(predicted: Union[ColumnarResult, List[Dict[str, Any]]],
+                    gold: Union[ColumnarResult, List[Dict[str, Any]]]) -> bool:
+    """Check whether two results contain the same rows, ignoring order
+
+    A ColumnarResult carrying an error (see execute_query(..., columnar=True))
+    never matches; plain row lists are compared as data.
+    """
+    if getattr(predicted, 'error', None) is not None or getattr(gold, 'error', None) is not None:
+        return False
+    return result_multiset(predicted) == result_multiset(gold)
+
+
+# Per-process state for worker processes
+_worker = None
+
+
+def _start_worker(db_path: str, recordings_path: Optional[str], record: bool,
+                  access_profile: Optional[str]):
+    global _worker
+    model = GeminiBackend('gemini-1.5-flash') if record else None
+    replay = ReplayModel(recordings_path, model=model, record=record)
+    _worker = TextToSQL(db_path, model=replay, seed_sample_data=False, access_profile=access_profile)
+
+
+def _close_worker():
+    global _worker
+    if _worker is not None:
+        _worker.close()
+        _worker = None
+
+
+def _init_worker(*args):
+    """Process pool initializer; the worker's TextToSQL is closed when the process exits"""
+    _start_worker(*args)
+    Finalize(None, _close_worker, exitpriority=10)
+
+
+def evaluate_case(text_to_sql: TextToSQL, case: Dict[str, Any], variant=None, model=None,
+                  gold: Optional[ColumnarResult] = None) -> Dict[str, Any]:
+    """Run one case through the pipeline, timing every stage
+
+    variant (see comparison.Variant) replaces the schema serialization and
+    prompt, model the TextToSQL's model; gold is the gold SQL's columnar
+    result if already known.
+    """
+    model = model or text_to_sql.model
+    timings = {}
+    outcome = {"id": case["id"], "question": case["question"], "gold_sql": case["gold_sql"],
+               "sql_query": None, "correct": False, "error": None, "replay_miss": False}
+
+    start = time.perf_counter()
+    schema = variant.render_schema(text_to_sql) if variant else text_to_sql.get_database_schema()
+    timings["schema"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if variant:
+        prefix, suffix = variant.build_prompt_parts(text_to_sql, case["question"], schema)
+    else:
+        prefix, suffix = text_to_sql.build_prompt_parts(case["question"], schema)
+    prompt = prefix.text + suffix
+    timings["prompt"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    try:
+        # Stand-ins for TextToSQL (e.g. the demos) may not account tokens
+        usage = getattr(text_to_sql, 'token_usage', None)
+        sql_query = send_prompt(model, prefix, suffix, usage).text.strip()
+    except ReplayMiss as e:
+        sql_query = None
+        outcome.update(error=e.args[0], replay_miss=True)
+    except Exception as e:
+        sql_query = None
+        outcome["error"] = f"Error generating SQL: {str(e)}"
+    timings["generate"] = time.perf_counter() - start
+
+    usage = model.usage(prompt) if hasattr(model, 'usage') else {
+        "prompt_tokens": estimate_tokens(prompt), "output_tokens": estimate_tokens(sql_query or "")}
+    outcome.update(usage)
+
+    if sql_query is not None:
+        outcome["sql_query"] = sql_query
+        start = time.perf_counter()
+        predicted = text_to_sql.execute_query(sql_query, columnar=True)
+        timings["execute"] = time.perf_counter() - start
+
+        if gold is None:
+            gold = text_to_sql.execute_query(case["gold_sql"], columnar=True)
+        if gold.error is not None:
+            outcome["error"] = f"Gold SQL failed: {gold.error}"
+        elif predicted.error is not None:
+            outcome["error"] = predicted.error
+        else:
+            outcome["correct"] = execution_match(predicted, gold)
+
+    outcome["timings"] = timings
+    return outcome
+
+
+def _run_case(case: Dict[str, Any]) -> Dict[str, Any]:
+    outcome = evaluate_case(_worker, case)
+    model = _worker.model
+    outcome["new_records"] = dict(model.new_records)
+    model.new_records.clear()
+    return outcome
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarize(outcomes: List[Dict[str, Any]], wall_seconds: float) -> Dict[str, Any]:
+    """Aggregate per-case outcomes into an accuracy / latency / token report"""
+    stages = {}
+    for stage in STAGES:
+        values = [o["timings"][stage] * 1000 for o in outcomes if stage in o["timings"]]
+        if values:
+            stages[stage] = {
+                "count": len(values),
+                "mean_ms": sum(values) / len(values),
+                "p50_ms": _percentile(values, 0.50),
+                "p95_ms": _percentile(values, 0.95),
+                "max_ms": max(values),
+            }
+
+    correct = sum(o["correct"] for o in outcomes)
+    prompt_tokens = sum(o["prompt_tokens"] for o in outcomes)
+    return {
+        "cases": len(outcomes),
+        "correct": correct,
+        "accuracy": correct / len(outcomes) if outcomes else 0.0,
+        "errors": sum(1 for o in outcomes if o["error"]),
+        "replay_misses": sum(o["replay_miss"] for o in outcomes),
+        "wall_seconds": wall_seconds,
+        "throughput_qps": len(outcomes) / wall_seconds if wall_seconds else 0.0,
+        "stages": stages,
+        "tokens": {
+            "prompt_total": prompt_tokens,
+            "prompt_mean": prompt_tokens / len(outcomes) if outcomes else 0.0,
+            "output_total": sum(o["output_tokens"] for o in outcomes),
+        },
+        "results": outcomes,
+    }
+
+
+def run_suite(db_path: str, cases: List[Dict[str, Any]], recordings_path: Optional[str] = None,
+              record: bool = False, workers: int = 1,
+              access_profile: Optional[str] = None) -> Dict[str, Any]:
+    """Evaluate every case, across a process pool when workers > 1"""
+    start = time.perf_counter()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(db_path, recordings_path, record, access_profile)) as pool:
+            outcomes = list(pool.map(_run_case, cases))
+    else:
+        _start_worker(db_path, recordings_path, record, access_profile)
+        try:
+            outcomes = [_run_case(case) for case in cases]
+        finally:
+            _close_worker()
+    wall_seconds = time.perf_counter() - start
+
+    # Recordings made in worker processes are merged and saved once here
+    if record:
+        replay = ReplayModel(recordings_path)
+        for outcome in outcomes:
+            replay.merge(outcome["new_records"])
+        replay.save()
+    for outcome in outcomes:
+        del outcome["new_records"]
+
+    return summarize(outcomes, wall_seconds)
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"Cases: {report['cases']}  Correct: {report['correct']}  "
+          f"Accuracy: {report['accuracy']:.1%}  Errors: {report['errors']}  "
+          f"Replay misses: {report['replay_misses']}")
+    print(f"Wall time: {report['wall_seconds']:.2f}s  Throughput: {report['throughput_qps']:.1f} q/s")
+    print(f"Prompt tokens: {report['tokens']['prompt_total']} "
+          f"(mean {report['tokens']['prompt_mean']:.0f})  Output tokens: {report['tokens']['output_total']}")
+    for stage, stats in report["stages"].items():
+        print(f"  {stage:<9} mean={stats['mean_ms']:8.2f} ms  p50={stats['p50_ms']:8.2f} ms  "
+              f"p95={stats['p95_ms']:8.2f} ms  max={stats['max_ms']:8.2f} ms")
+    for outcome in report["results"]:
+        if not outcome["correct"]:
+            print(f"  ✗ [{outcome['id']}] {outcome['question']}: {outcome['error'] or outcome['sql_query']}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Offline Text-to-SQL evaluation")
+    parser.add_argument("--db", default="example.db", help="SQLite database to evaluate against")
+    parser.add_argument("--suite", required=True, help="JSON/JSONL file of {question, gold_sql} cases")
+    parser.add_argument("--recordings", required=True, help="Recorded model responses (JSON)")
+    parser.add_argument("--record", action="store_true", help="Call the live model for unrecorded prompts")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--access-profile", default=None)
+    parser.add_argument("--report", help="Write the full report as JSON to this path")
+    args = parser.parse_args(argv)
+
+    report = run_suite(args.db, load_suite(args.suite), args.recordings, record=args.record,
+                       workers=args.workers, access_profile=args.access_profile)
+    print_report(report)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import sqlite3
+import sys
+import threading
+from typing import Any, Dict, Iterable, Optional, Union
+
+try:
+    from .sqlite_access import catalog_version, connect, get_access_profile, AccessProfile
+    from .tracing import stage
+except ImportError:
+    from sqlite_access import catalog_version, connect, get_access_profile, AccessProfile
+    from tracing import stage
+
+_COLUMNS = """table_name, column_name, business_name, description,
+              data_type, example_value, is_sensitive, business_rules"""
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class ColumnMetadata:
+    """Business metadata of one column.
+
+    A __slots__ record rather than a dict; table, column and type names are
+    interned since they repeat across the catalog. Supports meta['key']
+    lookups so code written against the old dict shape keeps working.
+    """
+
+    __slots__ = ('table_name', 'column_name', 'business_name', 'description', 'data_type',
+                 'example_value', 'is_sensitive', 'business_rules')
+
+    def __init__(self, table_name: str, column_name: str, business_name: Optional[str] = None,
+                 description: Optional[str] = None, data_type: Optional[str] = None,
+                 example_value: Optional[str] = None, is_sensitive: bool = False,
+                 business_rules: Optional[str] = None):
+        self.table_name = _intern(table_name)
+        self.column_name = _intern(column_name)
+        self.business_name = business_name
+        self.description = description
+        self.data_type = _intern(data_type)
+        self.example_value = example_value
+        self.is_sensitive = bool(is_sensitive)
+        self.business_rules = business_rules
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The per-column dict returned by TextToSQL.get_column_metadata()"""
+        return {
+            'business_name': self.business_name,
+            'description': self.description,
+            'data_type': self.data_type,
+            'example_value': self.example_value,
+            'is_sensitive': self.is_sensitive,
+            'business_rules': self.business_rules
+        }
+
+    def __repr__(self) -> str:
+        return f"ColumnMetadata({self.table_name!r}, {self.column_name!r}, {self.business_name!r})"
+
+
+class MetadataStore:
+    """Column metadata loaded lazily, one table at a time.
+
+    A table's rows are read from column_metadata (through its primary key
+    index) the first time the table is asked for and kept until the catalog
+    version changes, so building a schema only touches the tables it shows.
+    """
+
+    def __init__(self, db_path, access_profile: Union[str, AccessProfile, None] = None):
+        self.db_path = db_path
+        self.access_profile = get_access_profile(access_profile)
+        self._tables = {}  # table name -> {column name -> ColumnMetadata}
+        self._complete = False  # whether _tables holds every table
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _sync(self, conn: sqlite3.Connection):
+        """Drop everything loaded if the catalog changed since it was read"""
+        version = catalog_version(conn)
+        if version != self._version:
+            self._tables = {}
+            self._complete = False
+            self._version = version
+
+    @staticmethod
+    def _load(conn: sqlite3.Connection, where: str = "", parameters=()) -> Dict[str, Dict[str, ColumnMetadata]]:
+        tables = {}
+        try:
+            cursor = conn.execute(f"SELECT {_COLUMNS} FROM column_metadata {where}", parameters)
+        except sqlite3.OperationalError:
+            return tables  # no metadata table, e.g. an immutable snapshot without one
+        for row in cursor:
+            record = ColumnMetadata(*row)
+            tables.setdefault(record.table_name, {})[record.column_name] = record
+        return tables
+
+    def tables(self, table_names: Iterable[str]) -> Dict[str, Dict[str, ColumnMetadata]]:
+        """Metadata for several tables, loading the missing ones in one query"""
+        table_names = list(table_names)
+        with stage('metadata'), self._lock:
+            with connect(self.db_path, self.access_profile) as conn:
+                self._sync(conn)
+                missing = [name for name in table_names if name not in self._tables]
+                if missing and not self._complete:
+                    loaded = self._load(conn, f"WHERE table_name IN ({', '.join('?' * len(missing))})", missing)
+                    for name in missing:
+                        self._tables[_intern(name)] = loaded.get(name, {})
+            return {name: self._tables.get(name, {}) for name in table_names}
+
+    def table(self, table_name: str) -> Dict[str, ColumnMetadata]:
+        """Metadata of one table's columns, keyed by column name"""
+        return self.tables([table_name])[table_name]
+
+    def get(self, table_name: str, column_name: str) -> Optional[ColumnMetadata]:
+        """Metadata of one column, or None"""
+        return self.table(table_name).get(column_name)
+
+    def all(self) -> Dict[str, Dict[str, ColumnMetadata]]:
+        """Metadata of every table that has any"""
+        with stage('metadata'), self._lock:
+            with connect(self.db_path, self.access_profile) as conn:
+                self._sync(conn)
+                if not self._complete:
+                    self._tables = self._load(conn)
+                    self._complete = True
+            return {name: columns for name, columns in self._tables.items() if columns}
+
+    def invalidate(self):
+        """Forget everything loaded"""
+        with self._lock:
+            self._tables = {}
+            self._complete = False
+            self._version = None
@@ -0,0 +1,470 @@
+import abc
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+try:
+    from .catalog_artifact import index_terms
+    from .prompt_builder import PromptPrefix, estimate_tokens, send_prompt
+except ImportError:
+    from catalog_artifact import index_terms
+    from prompt_builder import PromptPrefix, estimate_tokens, send_prompt
+
+ROUTES = ('template', 'fast', 'strong')
+
+# Cheap lexical cues, English and Chinese
+_AGGREGATION_CUES = re.compile(
+    r"\b(how many|number of|count|total|sum|average|avg|mean|maximum|max|minimum|min|highest|lowest)\b"
+    r"|平均|总|数量|多少|最高|最低|最大|最小", re.IGNORECASE)
+_GROUPING_CUES = re.compile(r"\b(per|each|by|group(ed)? by|breakdown)\b|每个|每|各", re.IGNORECASE)
+_JOIN_CUES = re.compile(r"\b(join|along with|together with|with their|and their|corresponding)\b|以及|对应|所在",
+                        re.IGNORECASE)
+_RANKING_CUES = re.compile(r"\b(top|rank(ed|ing)?|order(ed)? by|sort(ed)?|first|last|most|least)\b|前\d|排名|排序",
+                           re.IGNORECASE)
+_NESTING_CUES = re.compile(
+    r"\b(than (the )?average|above average|below average|not in|without|never|except|compared|"
+    r"percentage|ratio|share of|growth|year over year|median)\b|超过平均|低于平均|没有|占比|增长|同比|环比",
+    re.IGNORECASE)
+
+
+class ModelBackend(abc.ABC):
+    """A text generation backend.
+
+    Implementations provide generate_content(prompt, **kwargs) returning an
+    object with a .text attribute, the interface of google.generativeai
+    models, so a backend can also be passed anywhere a model is expected.
+    """
+
+    name = "backend"
+
+    @abc.abstractmethod
+    def generate_content(self, prompt: str, **kwargs):
+        """Generate a response for prompt"""
+
+    def generate_with_prefix(self, prefix: PromptPrefix, suffix: str, **kwargs):
+        """Generate for prefix.text + suffix; backends with context caching send only the suffix"""
+        return self.generate_content(prefix.text + suffix, **kwargs)
+
+
+class GeminiBackend(ModelBackend):
+    """A Gemini model, configured on first use
+
+    With cache_ttl set, a prompt prefix of at least min_cache_tokens is
+    registered once as cached content and later requests reference it,
+    sending only the question. Context caching needs a google-generativeai
+    release with the caching module and a versioned model name (e.g.
+    gemini-1.5-flash-001); otherwise whole prompts are sent.
+    """
+
+    def __init__(self, model_name: str = 'gemini-1.5-flash', api_key: Optional[str] = None,
+                 cache_ttl: Optional[float] = 3600, min_cache_tokens: int = 32768, max_contexts: int = 16):
+        self.name = model_name
+        self.api_key = api_key
+        self.cache_ttl = cache_ttl
+        self.min_cache_tokens = min_cache_tokens
+        self.max_contexts = max_contexts
+        self._model = None
+        self._genai = None
+        self._contexts = OrderedDict()  # prefix digest -> (model bound to cached content or None, expiry)
+        self._lock = threading.Lock()
+
+    def _client(self):
+        with self._lock:
+            if self._model is None:
+                import google.generativeai as genai
+                genai.configure(api_key=self.api_key or os.getenv("GOOGLE_API_KEY"))
+                self._genai = genai
+                self._model = genai.GenerativeModel(self.name)
+            return self._model
+
+    def generate_content(self, prompt: str, **kwargs):
+        return self._client().generate_content(prompt, **kwargs)
+
+    def _cached_model(self, prefix: PromptPrefix):
+        """A model bound to the prefix's cached content, or None if it cannot be cached"""
+        if self.cache_ttl is None or prefix.tokens < self.min_cache_tokens:
+            return None
+        self._client()
+        caching = getattr(self._genai, 'caching', None)
+        if caching is None:
+            return None
+
+        with self._lock:
+            entry = self._contexts.get(prefix.digest)
+            if entry is not None and entry[1] > time.monotonic():
+                self._contexts.move_to_end(prefix.digest)
+                return entry[0]
+            try:
+                content = caching.CachedContent.create(
+                    model=self.name if self.name.startswith('models/') else f"models/{self.name}",
+                    display_name=f"text-to-sql-{prefix.digest[:16]}", contents=[prefix.text],
+                    ttl=timedelta(seconds=self.cache_ttl))
+                model = self._genai.GenerativeModel.from_cached_content(cached_content=content)
+            except Exception:
+                # Model or prefix not cacheable: remember, and send whole prompts until the TTL passes
+                content, model = None, None
+            # Stop using an entry a little before the provider expires it
+            self._contexts[prefix.digest] = (model, time.monotonic() + self.cache_ttl * 0.9)
+            while len(self._contexts) > self.max_contexts:
+                self._contexts.popitem(last=False)
+            return model
+
+    def generate_with_prefix(self, prefix: PromptPrefix, suffix: str, **kwargs):
+        model = self._cached_model(prefix)
+        if model is None:
+            return self.generate_content(prefix.text + suffix, **kwargs)
+        return model.generate_content(suffix, **kwargs)
+
+
+class StubUsage:
+    def __init__(self, prompt_token_count: int, cached_content_token_count: int = 0):
+        self.prompt_token_count = prompt_token_count
+        self.cached_content_token_count = cached_content_token_count
+
+
+class StubResponse:
+    def __init__(self, text: str, usage_metadata: Optional[StubUsage] = None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class StubBackend(ModelBackend):
+    """Local backend for tests: answers from (substring, sql) rules, optionally slowly or failing
+
+    With context_cache=True it imitates provider context caching: a prefix
+    is registered on first use (in cached_prefixes) and later calls report
+    its tokens as cached in usage_metadata.
+    """
+
+    def __init__(self, name: str = "stub", rules: Sequence[Tuple[str, str]] = (), default: str = "SELECT 1",
+                 delay: float = 0.0, error: Optional[Exception] = None, context_cache: bool = False):
+        self.name = name
+        self.rules = list(rules)
+        self.default = default
+        self.delay = delay
+        self.error = error
+        self.context_cache = context_cache
+        self.cached_prefixes = {}
+        self.prompts = []
+
+    def generate_content(self, prompt: str, **kwargs) -> StubResponse:
+        self.prompts.append(prompt)
+        if self.delay:
+            time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        for needle, sql in self.rules:
+            if needle.lower() in prompt.lower():
+                return StubResponse(sql)
+        return StubResponse(self.default)
+
+    def generate_with_prefix(self, prefix: PromptPrefix, suffix: str, **kwargs) -> StubResponse:
+        if not self.context_cache:
+            return super().generate_with_prefix(prefix, suffix, **kwargs)
+        cached = prefix.digest in self.cached_prefixes
+        self.cached_prefixes.setdefault(prefix.digest, prefix.text)
+        response = self.generate_content(prefix.text + suffix, **kwargs)
+        tokens = prefix.tokens + estimate_tokens(suffix)
+        response.usage_metadata = StubUsage(tokens, prefix.tokens if cached else 0)
+        return response
+
+
+class TemplateRoute:
+    """Answer trivial single-table questions locally, without a model"""
+
+    _LIST = re.compile(r"^(show|list|display|get|give)( me)?( all| every)?( the)? (?P<table>[\w ]+?)\??$",
+                       re.IGNORECASE)
+    _COUNT = re.compile(r"^how many (?P<table>[\w ]+?)( are there| do we have| exist)?\??$", re.IGNORECASE)
+
+    @staticmethod
+    def _table(phrase: str, tables: Sequence[str]) -> Optional[str]:
+        phrase = phrase.strip().lower().replace(' ', '_')
+        for table in tables:
+            if phrase in (table.lower(), table.lower().rstrip('s'), table.lower() + 's'):
+                return table
+        return None
+
+    def sql_for(self, question: str, tables: Sequence[str]) -> Optional[str]:
+        """SQL for a templated question, or None if no template applies"""
+        question = question.strip()
+        for pattern, template in ((self._COUNT, 'SELECT COUNT(*) AS count FROM "{}"'),
+                                  (self._LIST, 'SELECT * FROM "{}"')):
+            match = pattern.match(question)
+            if match:
+                table = self._table(match.group('table'), tables)
+                if table is not None:
+                    return template.format(table.replace('"', '""'))
+        return None
+
+
+class _RouteStats:
+    def __init__(self, slo: float, window: int):
+        self.slo = slo
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.fallbacks = 0
+        self.slo_violations = 0
+        self.skipped = 0
+        self.judged = 0
+        self.correct = 0
+        self.latencies = deque(maxlen=window)
+        self.abandoned = set()  # timed-out calls still occupying a worker thread
+
+    def snapshot(self) -> Dict[str, Any]:
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction: float) -> Optional[float]:
+            return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000 if latencies else None
+
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "fallbacks": self.fallbacks,
+            "abandoned": len(self.abandoned),
+            "skipped": self.skipped,
+            "slo_ms": self.slo * 1000,
+            "slo_violations": self.slo_violations,
+            "slo_attainment": 1 - self.slo_violations / self.calls if self.calls else None,
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "accuracy": self.correct / self.judged if self.judged else None,
+        }
+
+
+class SchemaLinker:
+    """Links the words of a question to the tables they name.
+
+    The term index over table, column and business names is rebuilt only
+    when the catalog version of the TextToSQL changes.
+    """
+
+    def __init__(self):
+        self._index = None  # (catalog version, (table terms, column terms), table names)
+
+    def _terms(self, text_to_sql) -> Tuple[Tuple[Dict[str, set], Dict[str, set]], List[str]]:
+        version = (id(text_to_sql), text_to_sql.get_catalog_version())
+        cached = self._index
+        if cached is not None and cached[0] == version:
+            return cached[1], cached[2]
+
+        # Table-name terms and column/business-name terms are kept apart:
+        # "departments" names a table even though employees.department_id
+        # mentions it too
+        table_terms, column_terms = {}, {}
+        tables = text_to_sql.get_table_names()
+        for table in tables:
+            columns = [text for meta in text_to_sql.get_table_metadata(table).values()
+                       for text in (meta.column_name, meta.business_name)]
+            for index, texts in ((table_terms, [table]), (column_terms, columns)):
+                for text in texts:
+                    for term in index_terms(text):
+                        index.setdefault(term, set()).add(table)
+                        if len(term) > 3 and term.endswith('s'):
+                            index.setdefault(term[:-1], set()).add(table)
+        self._index = (version, (table_terms, column_terms), tables)
+        return (table_terms, column_terms), tables
+
+    def table_names(self, text_to_sql) -> List[str]:
+        return self._terms(text_to_sql)[1]
+
+    def link(self, question: str, text_to_sql) -> List[str]:
+        """Tables a question refers to by table, column or business name"""
+        (table_terms, column_terms), _ = self._terms(text_to_sql)
+        linked = set()
+        for term in index_terms(question):
+            for form in {term, term.rstrip('s')}:
+                # A term naming a table links that table only, not every table with a
+                # column named after it; column names shared by several tables (id,
+                # name) say nothing about which table is meant
+                tables = table_terms.get(form) or column_terms.get(form, set())
+                if form in table_terms or len(tables) == 1:
+                    linked |= tables
+        return sorted(linked)
+
+
+class ModelRouter:
+    """Send each question to the cheapest route likely to answer it.
+
+    Complexity is scored from local features only: how many tables the
+    question links to (by table, column and business names) and cues for
+    aggregation, grouping, joins, ranking and nesting. Questions matching
+    a template ("show all X", "how many X") are answered locally; scores
+    of at least strong_threshold go to the strong backend, everything else
+    to the fast one. A backend that errors or exceeds its timeout falls back to the
+    next route (template -> fast -> strong, strong -> fast). Per-route
+    calls, latency percentiles, SLO violations and accuracy (fed by
+    record_outcome) are available from stats().
+
+    The timeout is also passed to the backend call as
+    request_options={"timeout": ...}. A call that ignores it keeps its
+    worker thread after the router stops waiting; such abandoned calls
+    are counted per route, and a route with max_abandoned of them still
+    running is skipped until they finish.
+    """
+
+    def __init__(self, fast: ModelBackend, strong: Optional[ModelBackend] = None,
+                 template: Union[TemplateRoute, bool] = True, strong_threshold: int = 3,
+                 timeouts: Optional[Dict[str, float]] = None, slos: Optional[Dict[str, float]] = None,
+                 window: int = 1000, max_abandoned: int = 3):
+        self.backends = {'fast': fast, 'strong': strong}
+        # True for the built-in templates, False/None to always use a model
+        self.template = TemplateRoute() if template is True else template or None
+        self.strong_threshold = strong_threshold
+        self.timeouts = {'fast': 10.0, 'strong': 30.0, **(timeouts or {})}
+        slos = {'template': 0.05, 'fast': 2.0, 'strong': 8.0, **(slos or {})}
+        self._stats = {route: _RouteStats(slos[route], window) for route in ROUTES}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.linker = SchemaLinker()
+        self.max_abandoned = max_abandoned
+        self._pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="model-router")
+
+    @property
+    def fast(self) -> ModelBackend:
+        return self.backends['fast']
+
+    def features(self, question: str, text_to_sql) -> Dict[str, Any]:
+        """Local complexity features of a question"""
+        return {
+            "linked_tables": self.linker.link(question, text_to_sql),
+            "aggregation": len(_AGGREGATION_CUES.findall(question)),
+            "grouping": len(_GROUPING_CUES.findall(question)),
+            "join": len(_JOIN_CUES.findall(question)),
+            "ranking": len(_RANKING_CUES.findall(question)),
+            "nesting": len(_NESTING_CUES.findall(question)),
+            "words": len(question.split()),
+        }
+
+    def score(self, features: Dict[str, Any]) -> int:
+        joins = features["join"] + max(0, len(features["linked_tables"]) - 1)
+        return (min(features["aggregation"], 2) + min(features["grouping"], 1) + 2 * min(joins, 2)
+                + min(features["ranking"], 1) + 3 * min(features["nesting"], 1) + int(features["words"] > 25))
+
+    def classify(self, question: str, text_to_sql) -> Tuple[str, Dict[str, Any]]:
+        """Pick a route for a question; returns (route, features)"""
+        features = self.features(question, text_to_sql)
+        features["score"] = self.score(features)
+        if self.template is not None:
+            # Template patterns only match trivial single-table questions
+            tables = self.linker.table_names(text_to_sql)
+            if self.template.sql_for(question, tables) is not None:
+                return 'template', features
+        if features["score"] >= self.strong_threshold and self.backends['strong'] is not None:
+            return 'strong', features
+        return 'fast', features
+
+    def _chain(self, route: str) -> List[str]:
+        chain = {'template': ['template', 'fast', 'strong'], 'fast': ['fast', 'strong'],
+                 'strong': ['strong', 'fast']}[route]
+        return [name for name in chain if name == 'template' or self.backends[name] is not None]
+
+    def _call(self, route: str, question: str, text_to_sql,
+              prompt_parts: Optional[Tuple[PromptPrefix, str]] = None) -> str:
+        if route == 'template':
+            tables = self.linker.table_names(text_to_sql)
+            sql_query = self.template.sql_for(question, tables)
+            if sql_query is None:
+                raise LookupError("No template matches the question")
+            return sql_query
+        prefix, suffix = prompt_parts or text_to_sql.build_prompt_parts(question)
+        timeout = self.timeouts[route]
+        future = self._pool.submit(send_prompt, self.backends[route], prefix, suffix, text_to_sql.token_usage,
+                                   request_options={"timeout": timeout})
+        try:
+            return future.result(timeout=timeout).text.strip()
+        except FutureTimeoutError:
+            if not future.cancel():
+                abandoned = self._stats[route].abandoned
+                with self._lock:
+                    abandoned.add(future)
+                future.add_done_callback(lambda done: self._release(abandoned, done))
+            raise
+
+    def _saturated(self, route: str) -> Optional[int]:
+        """Abandoned calls of a route that has max_abandoned of them running (counted as a skip), else None"""
+        if route == 'template':
+            return None
+        with self._lock:
+            stats = self._stats[route]
+            if len(stats.abandoned) < self.max_abandoned:
+                return None
+            stats.skipped += 1
+            stats.fallbacks += 1
+            return len(stats.abandoned)
+
+    def _release(self, abandoned: set, future):
+        with self._lock:
+            abandoned.discard(future)
+
+    def generate_sql(self, text_to_sql, question: str,
+                     prompt_parts: Optional[Tuple[PromptPrefix, str]] = None) -> str:
+        """Generate SQL for a question through its route, falling back on errors and timeouts
+
+        prompt_parts, if given, is sent to model routes instead of the default prompt.
+        """
+        route, features = self.classify(question, text_to_sql)
+        errors = []
+        for attempt in self._chain(route):
+            running = self._saturated(attempt)
+            if running is not None:
+                errors.append(f"{attempt}: skipped, {running} timed-out calls still running")
+                continue
+            start = time.perf_counter()
+            try:
+                sql_query = self._call(attempt, question, text_to_sql, prompt_parts)
+            except FutureTimeoutError:
+                self._account(attempt, time.perf_counter() - start, timeout=True)
+                errors.append(f"{attempt}: timed out after {self.timeouts[attempt]}s")
+                continue
+            except Exception as e:
+                self._account(attempt, time.perf_counter() - start, error=True)
+                errors.append(f"{attempt}: {e}")
+                continue
+            self._account(attempt, time.perf_counter() - start)
+            self._local.decision = {"route": route, "served_by": attempt, "features": features,
+                                    "errors": errors}
+            return sql_query
+
+        self._local.decision = {"route": route, "served_by": None, "features": features, "errors": errors}
+        raise RuntimeError("All routes failed: " + "; ".join(errors))
+
+    def _account(self, route: str, seconds: float, error: bool = False, timeout: bool = False):
+        with self._lock:
+            stats = self._stats[route]
+            stats.calls += 1
+            stats.latencies.append(seconds)
+            stats.errors += int(error)
+            stats.timeouts += int(timeout)
+            stats.fallbacks += int(error or timeout)
+            stats.slo_violations += int(timeout or seconds > stats.slo)
+
+    @property
+    def last_decision(self) -> Optional[Dict[str, Any]]:
+        """Routing decision of this thread's last generate_sql call"""
+        return getattr(self._local, 'decision', None)
+
+    def record_outcome(self, correct: bool, route: Optional[str] = None):
+        """Count whether the SQL of the last decision (or of route) turned out right"""
+        if route is None:
+            decision = self.last_decision
+            route = decision and decision["served_by"]
+        if route is None:
+            return
+        with self._lock:
+            self._stats[route].judged += 1
+            self._stats[route].correct += int(bool(correct))
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per-route latency, SLO and accuracy statistics"""
+        with self._lock:
+            return {route: stats.snapshot() for route, stats in self._stats.items()}
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
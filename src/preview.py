@@ -0,0 +1,261 @@
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Union
+
+try:
+    from .query_stats import tokenize
+    from .result_set import ColumnarResult
+    from .sqlite_access import SharedDatabase, attach_uri, connect, read_tables
+    from .tracing import explain, instrument, stage
+except ImportError:
+    from query_stats import tokenize
+    from result_set import ColumnarResult
+    from sqlite_access import SharedDatabase, attach_uri, connect, read_tables
+    from tracing import explain, instrument, stage
+
+# Rowid blocks read to estimate a filtered query's selectivity
+SAMPLE_BLOCKS = 16
+SAMPLE_BLOCK_ROWS = 64
+
+_ROW_CHANGING_WORDS = {'where', 'group', 'having', 'limit', 'distinct', 'join', 'union', 'intersect', 'except'}
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _table_rows(conn: sqlite3.Connection, table: str) -> Optional[tuple]:
+    """(row count estimate, method) from sqlite_stat1, else max(rowid)"""
+    try:
+        row = conn.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = ? ORDER BY idx IS NOT NULL LIMIT 1",
+                           (table,)).fetchone()
+    except sqlite3.OperationalError:
+        row = None  # ANALYZE never ran
+    if row is not None:
+        return int(row[0].split()[0]), 'stat1'
+    try:
+        # Upper bound: deleted rows leave gaps
+        max_rowid = conn.execute(f"SELECT max(rowid) FROM {_quote(table)}").fetchone()[0]
+    except sqlite3.OperationalError:
+        return None  # WITHOUT ROWID table
+    return (max_rowid or 0), 'rowid'
+
+
+def _is_plain_scan(conn: sqlite3.Connection, sql_query: str) -> bool:
+    """Whether a single-table query returns one row per table row (no filter, grouping or limit)"""
+    plan = [row[-1] for row in explain(conn, sql_query, query_plan=True)
+            if not row[-1].startswith("USE TEMP B-TREE")]  # sorting keeps every row
+    words = {text.lower() for kind, text, _, _ in tokenize(sql_query) if kind == 'word'}
+    return len(plan) == 1 and plan[0].startswith("SCAN") and not words & _ROW_CHANGING_WORDS
+
+
+def _sample_estimate(db_path, profile, sql_query: str, table: str, table_rows: int) -> Optional[int]:
+    """Run the query over rowid blocks spread across table and scale the count up
+
+    The blocks are copied into a temp table of the same name, which shadows
+    the real one for unqualified references, so only a few hundred rows are
+    read. Grouped queries scale poorly; this is a first guess only.
+    """
+    conn = instrument(sqlite3.connect(attach_uri(db_path, profile), uri=True))
+    try:
+        max_rowid = conn.execute(f"SELECT max(rowid) FROM {_quote(table)}").fetchone()[0] or 0
+        step = max(1, max_rowid // SAMPLE_BLOCKS)
+        ranges = " OR ".join(f"rowid BETWEEN {start} AND {start + SAMPLE_BLOCK_ROWS - 1}"
+                             for start in range(1, max_rowid + 1, step)[:SAMPLE_BLOCKS])
+        conn.execute(f"CREATE TEMP TABLE {_quote(table)} AS SELECT * FROM main.{_quote(table)} WHERE {ranges}")
+        sampled = conn.execute(f"SELECT COUNT(*) FROM temp.{_quote(table)}").fetchone()[0]
+        if not sampled:
+            return 0
+        matched = conn.execute(f"SELECT COUNT(*) FROM ({sql_query})").fetchone()[0]
+        return round(matched * table_rows / sampled)
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
+
+
+class PreviewResult:
+    """The first rows of a query, an approximate total and the rest on demand
+
+    rows holds at most the requested number of rows; the cursor stays open
+    until fetch_all() or close(). estimate is available at once: exact when
+    the preview saw every row, otherwise from sqlite_stat1 or max(rowid)
+    for plain table scans, or from a small rowid sample for other
+    single-table queries. With count=True an exact COUNT(*) runs in the
+    background; total() waits for it and cancel() interrupts it.
+    """
+
+    def __init__(self, text_to_sql, sql_query: Optional[str], limit: int = 20, count: bool = True,
+                 question: Optional[str] = None, error: Optional[str] = None):
+        self.question = question
+        self.sql_query = sql_query
+        self.columns: List[str] = []
+        self.rows: List[Dict[str, Any]] = []
+        self.has_more = False
+        self.error: Optional[str] = None
+        self.estimate: Dict[str, Any] = {"rows": None, "method": None}
+        self._db_path = text_to_sql.db_path
+        self._profile = text_to_sql.access_profile
+        self._conn = None
+        self._cursor = None
+        self._preview_rows = []
+        self._pending = []
+        self._total: Optional[int] = None
+        self._counter: Optional[threading.Thread] = None
+        self._count_conn = None
+        self._cancelled = False
+        self._lock = threading.Lock()
+        if sql_query is None:
+            self.error = error  # no SQL could be generated
+            return
+
+        try:
+            self._conn = connect(self._db_path, self._profile)
+            self._cursor = self._conn.execute(sql_query)
+            self.columns = [description[0] for description in self._cursor.description or ()]
+            fetched = self._cursor.fetchmany(limit + 1)
+        except sqlite3.Error as e:
+            self.error = str(e)
+            self.close()
+            return
+
+        self.has_more = len(fetched) > limit
+        self._preview_rows = fetched[:limit]
+        self.rows = [dict(zip(self.columns, row)) for row in self._preview_rows]
+        self._pending = fetched[limit:]
+        if not self.has_more:
+            self._total = len(self.rows)
+            self.estimate = {"rows": self._total, "method": 'exact'}
+            self.close()
+            return
+
+        with stage('estimate'):
+            self.estimate = self._estimate()
+        if count and not isinstance(self._db_path, SharedDatabase):
+            # Injected connections are not shared with a second thread
+            self._counter = threading.Thread(target=self._count, name="preview-count", daemon=True)
+            self._counter.start()
+
+    def _estimate(self) -> Dict[str, Any]:
+        try:
+            tables = read_tables(self._conn, self.sql_query)
+            if len(tables) != 1:
+                return {"rows": None, "method": None}
+            table = tables[0]
+            table_rows = _table_rows(self._conn, table)
+            if table_rows is None:
+                return {"rows": None, "method": None}
+            if _is_plain_scan(self._conn, self.sql_query):
+                return {"rows": table_rows[0], "method": table_rows[1]}
+        except sqlite3.Error:
+            return {"rows": None, "method": None}
+        if isinstance(self._db_path, SharedDatabase):
+            return {"rows": None, "method": None}
+        estimate = _sample_estimate(self._db_path, self._profile, self.sql_query, table, table_rows[0])
+        # The preview itself is a lower bound
+        if estimate is not None:
+            estimate = max(estimate, len(self.rows) + 1)
+        return {"rows": estimate, "method": 'sample' if estimate is not None else None}
+
+    def _count(self):
+        try:
+            conn = connect(self._db_path, self._profile, check_same_thread=False)
+        except sqlite3.Error:
+            return
+        with self._lock:
+            if self._cancelled:
+                conn.close()
+                return
+            self._count_conn = conn
+        try:
+            with stage('count'):
+                total = conn.execute(f"SELECT COUNT(*) FROM ({self.sql_query})").fetchone()[0]
+        except sqlite3.Error:
+            total = None  # interrupted or failed
+        with self._lock:
+            self._count_conn = None
+            if total is not None and not self._cancelled:
+                self._total = total
+        conn.close()
+
+    @property
+    def approximate_total(self) -> Optional[int]:
+        """The exact total if already known, otherwise the estimate"""
+        return self._total if self._total is not None else self.estimate["rows"]
+
+    def total(self, timeout: Optional[float] = None) -> Optional[int]:
+        """The exact number of rows, waiting up to timeout seconds for the background count
+
+        Without a background count (count=False or an injected connection)
+        the count runs here. Returns None on timeout or after cancel().
+        """
+        if self._total is not None or self._cancelled or self.error:
+            return self._total
+        if self._counter is None:
+            if isinstance(self._db_path, SharedDatabase):
+                self._count()
+                return self._total
+            self._counter = threading.Thread(target=self._count, name="preview-count", daemon=True)
+            self._counter.start()
+        self._counter.join(timeout)
+        return self._total
+
+    def cancel(self):
+        """Stop the background count"""
+        with self._lock:
+            self._cancelled = True
+            if self._count_conn is not None:
+                self._count_conn.interrupt()
+
+    def fetch_all(self, columnar: bool = False) -> Union[List[Dict[str, Any]], ColumnarResult]:
+        """Every row of the query: the preview rows plus the rest of the open cursor
+
+        Once the cursor is closed the query is run again.
+        """
+        if self.error:
+            return ColumnarResult.from_error(self.error) if columnar else [{"error": self.error}]
+        if self._cursor is not None:
+            rows = self._preview_rows + self._pending + self._cursor.fetchall()
+            self._pending = []
+            self.close()
+        elif self.has_more:
+            conn = connect(self._db_path, self._profile)
+            try:
+                rows = conn.execute(self.sql_query).fetchall()
+            finally:
+                conn.close()
+        else:
+            rows = list(self._preview_rows)
+        if self._total is None:
+            self._total = len(rows)
+        if columnar:
+            return ColumnarResult.from_rows(self.columns, rows)
+        return [dict(zip(self.columns, row)) for row in rows]
+
+    def close(self):
+        """Release the cursor's connection; a background count keeps running until cancel()"""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = self._cursor = None
+
+    def __enter__(self) -> 'PreviewResult':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cancel()
+        self.close()
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Shaped like TextToSQL.query(), plus has_more and approximate_total"""
+        if self.sql_query is None:
+            return {"question": self.question, "sql_query": None, "results": [], "error": self.error,
+                    "has_more": False, "approximate_total": None, "estimate_method": None}
+        return {
+            "question": self.question,
+            "sql_query": self.sql_query,
+            "results": [{"error": self.error}] if self.error else self.rows,
+            "error": None,
+            "has_more": self.has_more,
+            "approximate_total": self.approximate_total,
+            "estimate_method": 'exact' if self._total is not None else self.estimate["method"],
+        }
@@ -0,0 +1,111 @@
+import hashlib
+import threading
+from typing import Any, Dict, Tuple
+
+QUESTION_FIELD = "{question}"
+
+
+def content_hash(text: str) -> str:
+    """SHA-256 of a prompt part, the identity of a cacheable prefix"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token)"""
+    return (len(text) + 3) // 4
+
+
+class PromptPrefix:
+    """The static part of a prompt: the template with the schema filled in, up to the question"""
+
+    __slots__ = ('text', 'digest', 'tokens')
+
+    def __init__(self, text: str):
+        self.text = text
+        self.digest = content_hash(text)
+        self.tokens = estimate_tokens(text)
+
+    def __repr__(self) -> str:
+        return f"PromptPrefix({self.digest[:12]}, tokens={self.tokens})"
+
+
+class PromptBuilder:
+    """Splits a prompt template into a reusable prefix and a per-question suffix
+
+    The template must end with the question: everything before {question}
+    depends only on the schema and becomes a PromptPrefix, built once per
+    distinct schema text. prefix.text + suffix equals template.format(...).
+    """
+
+    def __init__(self, template: str):
+        if template.count(QUESTION_FIELD) != 1:
+            raise ValueError("The prompt template needs exactly one {question} field")
+        self.template = template
+        index = template.index(QUESTION_FIELD)
+        self._head, self._tail = template[:index], template[index:]
+        if "{schema}" in self._tail:
+            raise ValueError("{schema} must come before {question} in the prompt template")
+        self._prefix = None  # (schema, prefix) of the last schema seen; schemas change rarely
+
+    def prefix(self, schema: str) -> PromptPrefix:
+        prefix = self._prefix
+        if prefix is None or prefix[0] != schema:
+            prefix = self._prefix = (schema, PromptPrefix(self._head.format(schema=schema)))
+        return prefix[1]
+
+    def build(self, schema: str, question: str) -> Tuple[PromptPrefix, str]:
+        """(prefix, suffix) of the prompt for a question"""
+        return self.prefix(schema), self._tail.format(question=question)
+
+
+class TokenUsage:
+    """Prompt tokens served from a provider's context cache versus sent with each request"""
+
+    def __init__(self):
+        self.requests = 0
+        self.cached_requests = 0
+        self.cached_tokens = 0
+        self.sent_tokens = 0
+        self._lock = threading.Lock()
+
+    def record(self, cached_tokens: int, sent_tokens: int):
+        with self._lock:
+            self.requests += 1
+            self.cached_requests += cached_tokens > 0
+            self.cached_tokens += cached_tokens
+            self.sent_tokens += sent_tokens
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.cached_tokens + self.sent_tokens
+            return {
+                "requests": self.requests,
+                "cached_requests": self.cached_requests,
+                "cached_tokens": self.cached_tokens,
+                "sent_tokens": self.sent_tokens,
+                "cached_fraction": self.cached_tokens / total if total else 0.0,
+            }
+
+
+def send_prompt(model, prefix: PromptPrefix, suffix: str, usage: TokenUsage = None, **kwargs):
+    """Call a model with a split prompt and account for the tokens it was charged
+
+    Models with generate_with_prefix (see model_routing.ModelBackend) may
+    serve the prefix from a context cache; any other model gets the whole
+    prompt. Token counts come from the response's usage_metadata when the
+    provider reports them, otherwise they are estimated.
+    """
+    if hasattr(model, 'generate_with_prefix'):
+        response = model.generate_with_prefix(prefix, suffix, **kwargs)
+    else:
+        response = model.generate_content(prefix.text + suffix, **kwargs)
+
+    if usage is not None:
+        metadata = getattr(response, 'usage_metadata', None)
+        prompt_tokens = getattr(metadata, 'prompt_token_count', None)
+        if prompt_tokens:
+            cached = getattr(metadata, 'cached_content_token_count', 0) or 0
+            usage.record(cached, prompt_tokens - cached)
+        else:
+            usage.record(0, prefix.tokens + estimate_tokens(suffix))
+    return response
@@ -0,0 +1,298 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+try:
+    from .sqlite_access import connect, connect_writable
+except ImportError:
+    from sqlite_access import connect, connect_writable
+
+SORT_KEYS = ('total_time', 'mean_time', 'max_time', 'calls', 'rows', 'errors')
+
+# One alternative per token class
+_TOKEN_PATTERN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<string>[xX]?'(?:[^']|'')*')
+  | (?P<identifier>"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\])
+  | (?P<number>0[xX][0-9a-fA-F]+|\d+(?:\.\d*)?(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?)
+  | (?P<param>[?:@$]\w*)
+  | (?P<word>[A-Za-z_][\w$]*)
+  | (?P<operator><=|>=|<>|!=|==|\|\||<<|>>|[-+*/%<>=~&|])
+  | (?P<punct>.)
+""", re.VERBOSE | re.DOTALL)
+
+# Keywords after which a following "(" is not a function call and a sign is unary
+_KEYWORDS = {
+    'select', 'from', 'where', 'and', 'or', 'not', 'in', 'is', 'like', 'glob', 'between',
+    'on', 'by', 'having', 'when', 'then', 'else', 'case', 'values', 'limit', 'offset',
+    'as', 'exists', 'join', 'union', 'all', 'distinct', 'with', 'over', 'using', 'set',
+}
+
+
+def tokenize(sql_query: str) -> Iterator[Tuple[str, str, int, int]]:
+    """Yield (kind, text, start, end) for each token, skipping whitespace and comments"""
+    for match in _TOKEN_PATTERN.finditer(sql_query):
+        if match.lastgroup not in ('space', 'comment'):
+            yield match.lastgroup, match.group(), match.start(), match.end()
+
+
+def _tokens(sql_query: str, keep_literals: bool = False) -> List[str]:
+    tokens = []
+    for kind, text, _, _ in tokenize(sql_query):
+        if kind in ('string', 'number', 'param') and keep_literals:
+            tokens.append(text)
+        elif kind in ('string', 'number', 'param'):
+            previous = tokens[-2] if len(tokens) >= 2 else None
+            if tokens and tokens[-1] in ('-', '+') and (
+                    previous is None or previous in _KEYWORDS or previous in ('(', ',', '=', '<', '>',
+                                                                               '<=', '>=', '<>', '!=')):
+                tokens.pop()  # fold a unary sign into the literal
+            tokens.append('?')
+        elif kind == 'identifier':
+            tokens.append(text)
+        else:
+            tokens.append(text.lower())
+    return tokens
+
+
+def fingerprint(sql_query: str) -> str:
+    """Normalize a statement so queries differing only in literals share one fingerprint.
+
+    Comments are dropped, string/number literals and bind parameters become
+    "?", IN-lists of literals collapse to "in (...)", keywords and bare
+    identifiers are lowercased and whitespace is canonicalized. Quoted
+    identifiers are kept as written.
+    """
+    tokens = _tokens(sql_query)
+
+    # Collapse IN (?, ?, ...) lists of any length
+    collapsed = []
+    i = 0
+    while i < len(tokens):
+        if tokens[i] == 'in' and i + 2 < len(tokens) and tokens[i + 1] == '(' and tokens[i + 2] == '?':
+            j = i + 3
+            while j + 1 < len(tokens) and tokens[j] == ',' and tokens[j + 1] == '?':
+                j += 2
+            if j < len(tokens) and tokens[j] == ')':
+                collapsed.extend(['in', '(...)'])
+                i = j + 1
+                continue
+        collapsed.append(tokens[i])
+        i += 1
+
+    return _render(collapsed)
+
+
+def canonicalize(sql_query: str) -> str:
+    """Canonical text of a statement: like fingerprint() but with literals kept"""
+    return _render(_tokens(sql_query, keep_literals=True))
+
+
+def _render(tokens: List[str]) -> str:
+    parts = []
+    previous = None
+    for token in tokens:
+        if parts and not (
+                token in (')', ',', '.', ';')
+                or previous in ('(', '.')
+                or (token == '(' and previous not in _KEYWORDS and re.match(r'\w', previous or ''))):
+            parts.append(' ')
+        parts.append(token)
+        previous = token
+    return ''.join(parts).rstrip('; ')
+
+
+def fingerprint_id(normalized: str) -> str:
+    """Short stable id for a fingerprint"""
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+
+
+class QueryStatsTable:
+    """pg_stat_statements-style per-fingerprint statistics.
+
+    Statistics accumulate in memory, bounded to max_entries fingerprints
+    (the least-called 5% are dropped when full). When db_path is set they
+    are merged into a query_stats table on flush(), and every
+    flush_interval seconds by a background thread, so record() never
+    writes on the caller's thread. A failed flush keeps the statistics in
+    memory for the next one.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, max_entries: int = 5000,
+                 flush_interval: float = 60.0):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.evicted = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._flusher: Optional[threading.Thread] = None
+
+    def record(self, sql_query: str, seconds: float, rows: int = 0, error: bool = False):
+        """Account one execution of sql_query"""
+        normalized = fingerprint(sql_query)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(normalized)
+            if entry is None:
+                if len(self._entries) >= self.max_entries:
+                    self._evict()
+                entry = self._entries[normalized] = {
+                    "fingerprint": fingerprint_id(normalized),
+                    "query": normalized,
+                    "calls": 0,
+                    "total_time": 0.0,
+                    "max_time": 0.0,
+                    "rows": 0,
+                    "errors": 0,
+                    "first_seen": now,
+                    "last_seen": now,
+                }
+            entry["calls"] += 1
+            entry["total_time"] += seconds
+            entry["max_time"] = max(entry["max_time"], seconds)
+            entry["rows"] += rows
+            entry["errors"] += int(error)
+            entry["last_seen"] = now
+
+        if self.db_path and time.monotonic() - self._last_flush >= self.flush_interval:
+            self._flush_in_background()
+
+    def _flush_in_background(self):
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._last_flush = time.monotonic()
+            self._flusher = threading.Thread(target=self._try_flush, name="query-stats-flush", daemon=True)
+            self._flusher.start()
+
+    def _try_flush(self):
+        try:
+            self.flush()
+        except sqlite3.Error:
+            pass  # e.g. "database is locked"; the statistics wait for the next flush
+
+    def _restore(self, entries: List[Dict[str, Any]]):
+        """Merge statistics that could not be written back into memory"""
+        with self._lock:
+            for entry in entries:
+                current = self._entries.get(entry["query"])
+                if current is None:
+                    self._entries[entry["query"]] = entry
+                    continue
+                current["calls"] += entry["calls"]
+                current["total_time"] += entry["total_time"]
+                current["max_time"] = max(current["max_time"], entry["max_time"])
+                current["rows"] += entry["rows"]
+                current["errors"] += entry["errors"]
+                current["first_seen"] = min(current["first_seen"], entry["first_seen"])
+
+    def _evict(self):
+        """Drop the least-called 5% of fingerprints"""
+        count = max(1, len(self._entries) // 20)
+        victims = sorted(self._entries.values(), key=lambda e: (e["calls"], e["last_seen"]))[:count]
+        for entry in victims:
+            del self._entries[entry["query"]]
+        self.evicted += count
+
+    def _create_table(self, conn: sqlite3.Connection):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS query_stats (
+                fingerprint TEXT PRIMARY KEY,
+                query TEXT NOT NULL,
+                calls INTEGER NOT NULL,
+                total_time REAL NOT NULL,
+                max_time REAL NOT NULL,
+                rows INTEGER NOT NULL,
+                errors INTEGER NOT NULL,
+                first_seen REAL NOT NULL,
+                last_seen REAL NOT NULL
+            )
+        """)
+
+    def flush(self) -> int:
+        """Merge in-memory statistics into the query_stats table and reset them
+
+        Raises sqlite3.Error if the table cannot be written; the statistics
+        are then kept in memory.
+        """
+        if not self.db_path:
+            return 0
+        with self._lock:
+            entries, self._entries = list(self._entries.values()), {}
+            self._last_flush = time.monotonic()
+        if not entries:
+            return 0
+
+        try:
+            self._write(entries)
+        except sqlite3.Error:
+            self._restore(entries)
+            raise
+        return len(entries)
+
+    def _write(self, entries: List[Dict[str, Any]]):
+        with connect_writable(self.db_path, timeout=30) as conn:
+            self._create_table(conn)
+            conn.executemany("""
+                INSERT INTO query_stats
+                (fingerprint, query, calls, total_time, max_time, rows, errors, first_seen, last_seen)
+                VALUES (:fingerprint, :query, :calls, :total_time, :max_time, :rows, :errors, :first_seen, :last_seen)
+                ON CONFLICT(fingerprint) DO UPDATE SET
+                    calls = calls + excluded.calls,
+                    total_time = total_time + excluded.total_time,
+                    max_time = max(max_time, excluded.max_time),
+                    rows = rows + excluded.rows,
+                    errors = errors + excluded.errors,
+                    last_seen = excluded.last_seen
+            """, entries)
+
+    def _persisted(self) -> List[Dict[str, Any]]:
+        if not self.db_path:
+            return []
+        try:
+            with connect(self.db_path, 'read_only') as conn:
+                conn.row_factory = sqlite3.Row
+                return [dict(row) for row in conn.execute("SELECT * FROM query_stats")]
+        except sqlite3.Error:
+            return []
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """All fingerprints, persisted totals merged with unflushed statistics"""
+        merged = {entry["fingerprint"]: entry for entry in self._persisted()}
+        with self._lock:
+            pending = [dict(entry) for entry in self._entries.values()]
+        for entry in pending:
+            total = merged.get(entry["fingerprint"])
+            if total is None:
+                merged[entry["fingerprint"]] = entry
+                continue
+            total["calls"] += entry["calls"]
+            total["total_time"] += entry["total_time"]
+            total["max_time"] = max(total["max_time"], entry["max_time"])
+            total["rows"] += entry["rows"]
+            total["errors"] += entry["errors"]
+            total["last_seen"] = entry["last_seen"]
+
+        for entry in merged.values():
+            entry["mean_time"] = entry["total_time"] / entry["calls"] if entry["calls"] else 0.0
+        return list(merged.values())
+
+    def top(self, n: int = 10, sort_by: str = 'total_time') -> List[Dict[str, Any]]:
+        """The n most expensive fingerprints by the given statistic"""
+        if sort_by not in SORT_KEYS:
+            raise ValueError(f"Unknown sort key: {sort_by} (expected one of {', '.join(SORT_KEYS)})")
+        return sorted(self.entries(), key=lambda entry: entry[sort_by], reverse=True)[:n]
+
+    def reset(self):
+        """Discard all statistics, in memory and persisted"""
+        with self._lock:
+            self._entries = {}
+        if self.db_path:
+            with connect_writable(self.db_path, timeout=30) as conn:
+                conn.execute("DROP TABLE IF EXISTS query_stats")
@@ -0,0 +1,197 @@
+import csv
+import gzip
+import io
+import json
+import os
+import struct
+import sys
+from array import array
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+try:
+    from .result_set import ColumnarResult
+    from .sqlite_access import connect
+except ImportError:
+    from result_set import ColumnarResult
+    from sqlite_access import connect
+
+EXPORT_FORMATS = ('csv', 'ndjson', 'columnar')
+
+# Binary columnar layout (all integers little-endian):
+#   file header:  b"T2SC" | u8 version | u32 length | JSON {"columns": [...]}
+#   each chunk:   b"CHNK" | u32 rows | u32 columns | per column: 1-byte code | u32 length | payload
+# Column codes: b"q" int64 array, b"d" float64 array, b"j" JSON list (text, NULLs, mixed)
+COLUMNAR_MAGIC = b"T2SC"
+COLUMNAR_VERSION = 1
+CHUNK_MAGIC = b"CHNK"
+
+
+def _jsonable(value: Any) -> Any:
+    """Make SQLite values JSON-serializable (BLOBs become hex strings)"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex()
+    return value
+
+
+def _encode_csv(columns: List[str], rows: List[tuple], with_header: bool) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if with_header:
+        writer.writerow(columns)
+    writer.writerows([[_jsonable(value) for value in row] for row in rows])
+    return buffer.getvalue().encode('utf-8')
+
+
+def _encode_ndjson(columns: List[str], rows: List[tuple], with_header: bool) -> bytes:
+    lines = [
+        json.dumps({name: _jsonable(value) for name, value in zip(columns, row)}, ensure_ascii=False)
+        for row in rows
+    ]
+    return ("\n".join(lines) + "\n").encode('utf-8') if lines else b""
+
+
+def _encode_columnar(columns: List[str], rows: List[tuple], with_header: bool) -> bytes:
+    parts = []
+    if with_header:
+        header = json.dumps({"columns": columns}).encode('utf-8')
+        parts.append(COLUMNAR_MAGIC + struct.pack("<BI", COLUMNAR_VERSION, len(header)) + header)
+
+    chunk = ColumnarResult.from_rows(columns, rows)
+    parts.append(CHUNK_MAGIC + struct.pack("<II", len(rows), len(columns)))
+    for values in chunk._columns:
+        if isinstance(values, array):
+            if sys.byteorder == 'big':
+                values = array(values.typecode, values)
+                values.byteswap()
+            code, payload = values.typecode.encode('ascii'), values.tobytes()
+        else:
+            code, payload = b"j", json.dumps([_jsonable(v) for v in values]).encode('utf-8')
+        parts.append(code + struct.pack("<I", len(payload)) + payload)
+    return b"".join(parts)
+
+
+_ENCODERS = {
+    'csv': _encode_csv,
+    'ndjson': _encode_ndjson,
+    'columnar': _encode_columnar,
+}
+
+
+def _manifest_path(path: str) -> str:
+    return path + ".progress"
+
+
+def _load_manifest(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(_manifest_path(path), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_manifest(path: str, manifest: Dict[str, Any]):
+    tmp_path = _manifest_path(path) + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, _manifest_path(path))
+
+
+def export_query(db_path: str, sql_query: str, path: str, format: str = 'csv',
+                 compress: bool = False, chunk_size: int = 10000,
+                 progress: Optional[Callable[[int, int], None]] = None,
+                 resume: bool = False, access_profile=None) -> Dict[str, Any]:
+    """Stream the rows of sql_query to path in bounded-size chunks.
+
+    At most chunk_size rows are held in memory at once. Each chunk is written
+    (as its own gzip member when compress=True) and then recorded in a
+    "<path>.progress" manifest, so an interrupted export can be continued with
+    resume=True. Resuming re-runs the query and skips the rows already
+    written, so the query must return rows in a deterministic order.
+    """
+    if format not in _ENCODERS:
+        raise ValueError(f"Unsupported export format: {format} (expected one of {', '.join(EXPORT_FORMATS)})")
+    encode = _ENCODERS[format]
+
+    manifest = {"sql": sql_query, "format": format, "compress": compress,
+                "rows": 0, "chunks": 0, "offset": 0}
+    previous = _load_manifest(path) if resume else None
+    if (previous and all(previous.get(key) == manifest[key] for key in ("sql", "format", "compress"))
+            and os.path.exists(path) and os.path.getsize(path) >= previous["offset"]):
+        manifest = previous
+
+    with connect(db_path, access_profile) as conn, open(path, 'r+b' if manifest["chunks"] else 'wb') as out:
+        out.truncate(manifest["offset"])
+        out.seek(manifest["offset"])
+
+        cursor = conn.execute(sql_query)
+        columns = [description[0] for description in cursor.description or ()]
+
+        # Skip rows already written by an earlier, interrupted run
+        to_skip = manifest["rows"]
+        while to_skip > 0:
+            skipped = len(cursor.fetchmany(min(to_skip, chunk_size)))
+            if not skipped:
+                break
+            to_skip -= skipped
+
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            first_chunk = manifest["chunks"] == 0
+            if not rows and not first_chunk:
+                break
+
+            payload = encode(columns, rows, first_chunk)
+            if compress:
+                payload = gzip.compress(payload)
+            out.write(payload)
+            out.flush()
+
+            manifest["rows"] += len(rows)
+            manifest["chunks"] += 1
+            manifest["offset"] = out.tell()
+            _save_manifest(path, manifest)
+
+            if progress:
+                progress(manifest["rows"], manifest["chunks"])
+            if not rows:
+                break
+
+    os.remove(_manifest_path(path))
+    return {"path": path, "format": format, "rows": manifest["rows"], "chunks": manifest["chunks"]}
+
+
+def read_columnar(path: str) -> Iterator[ColumnarResult]:
+    """Read a file written with format='columnar', yielding one ColumnarResult per chunk"""
+    with open(path, 'rb') as f:
+        data = f.read(2)
+        f.seek(0)
+        stream = gzip.open(f) if data == b"\x1f\x8b" else f
+
+        if stream.read(4) != COLUMNAR_MAGIC:
+            raise ValueError(f"{path} is not a columnar export")
+        version, header_length = struct.unpack("<BI", stream.read(5))
+        if version != COLUMNAR_VERSION:
+            raise ValueError(f"Unsupported columnar export version: {version}")
+        columns = json.loads(stream.read(header_length))["columns"]
+
+        while True:
+            magic = stream.read(4)
+            if not magic:
+                break
+            if magic != CHUNK_MAGIC:
+                raise ValueError(f"Corrupt chunk in {path}")
+            row_count, column_count = struct.unpack("<II", stream.read(8))
+            data = []
+            for _ in range(column_count):
+                code = stream.read(1)
+                (length,) = struct.unpack("<I", stream.read(4))
+                payload = stream.read(length)
+                if code == b"j":
+                    data.append(json.loads(payload))
+                else:
+                    values = array(code.decode('ascii'))
+                    values.frombytes(payload)
+                    if sys.byteorder == 'big':
+                        values.byteswap()
+                    data.append(values)
+            yield ColumnarResult(columns, data, range(row_count))
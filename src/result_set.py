@@ -0,0 +1,181 @@
+from array import array
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Union
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional
+    np = None
+
+# array typecodes used for homogeneous numeric columns
+_TYPECODES = {int: 'q', float: 'd'}
+
+
+class _ColumnBuilder:
+    """Accumulate one column, staying in a packed array while values are homogeneous"""
+
+    __slots__ = ('values', 'kind')
+
+    def __init__(self):
+        self.values = None
+        self.kind = None
+
+    def append(self, value: Any):
+        if self.values is None:
+            typecode = _TYPECODES.get(type(value))
+            if typecode is not None:
+                self.values = array(typecode)
+                self.kind = type(value)
+            else:
+                self.values = []
+        elif self.kind is not None and type(value) is not self.kind:
+            # Mixed types or NULLs - fall back to a plain list
+            self.values = list(self.values)
+            self.kind = None
+        self.values.append(value)
+
+    def finish(self) -> Union[array, list]:
+        return self.values if self.values is not None else []
+
+
+class RowView(Mapping):
+    """Lazy, read-only view of a single row in a ColumnarResult"""
+
+    __slots__ = ('_result', '_index')
+
+    def __init__(self, result: 'ColumnarResult', index: int):
+        self._result = result
+        self._index = index
+
+    def __getitem__(self, key: Union[str, int]) -> Any:
+        if isinstance(key, int):
+            return self._result._columns[key][self._index]
+        try:
+            position = self._result._positions[key]
+        except KeyError:
+            raise KeyError(key) from None
+        return self._result._columns[position][self._index]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._result._positions)
+
+    def __len__(self) -> int:
+        return len(self._result._positions)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+class ColumnarResult:
+    """Query result stored column-wise: column names once, one array per column.
+
+    Integer and float columns are packed into `array` buffers; anything else
+    (text, NULLs, mixed types) is kept as a list. Slicing returns a view that
+    shares the underlying columns instead of copying them. A name repeated
+    in columns refers to its first column, as with sqlite3.Row.
+    """
+
+    def __init__(self, columns: Sequence[str], data: Sequence[Union[array, list]],
+                 rows: Optional[range] = None, error: Optional[str] = None):
+        self.columns = list(columns)
+        self._columns = list(data)
+        self._positions = {}
+        for i, name in enumerate(self.columns):
+            self._positions.setdefault(name, i)
+        if rows is None:
+            rows = range(len(self._columns[0]) if self._columns else 0)
+        self._rows = rows
+        self._error = error
+
+    @classmethod
+    def from_rows(cls, columns: Sequence[str], rows) -> 'ColumnarResult':
+        """Build a columnar result from an iterable of row tuples"""
+        builders = [_ColumnBuilder() for _ in columns]
+        for row in rows:
+            for builder, value in zip(builders, row):
+                builder.append(value)
+        return cls(columns, [builder.finish() for builder in builders])
+
+    @classmethod
+    def from_cursor(cls, cursor, chunk_size: int = 10000) -> 'ColumnarResult':
+        """Build a columnar result from a DB-API cursor, fetching in chunks"""
+        columns = [description[0] for description in cursor.description or ()]
+        builders = [_ColumnBuilder() for _ in columns]
+        while True:
+            chunk = cursor.fetchmany(chunk_size)
+            if not chunk:
+                break
+            for row in chunk:
+                for builder, value in zip(builders, row):
+                    builder.append(value)
+        return cls(columns, [builder.finish() for builder in builders])
+
+    @classmethod
+    def from_error(cls, message: str) -> 'ColumnarResult':
+        """Single-row result carrying an error, shaped like [{"error": message}]"""
+        return cls(["error"], [[message]], error=message)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __getitem__(self, key: Union[int, slice]) -> Union[RowView, 'ColumnarResult']:
+        if isinstance(key, slice):
+            return ColumnarResult(self.columns, self._columns, self._rows[key], self._error)
+        return RowView(self, self._rows[key])
+
+    def __iter__(self) -> Iterator[RowView]:
+        for index in self._rows:
+            yield RowView(self, index)
+
+    def __repr__(self) -> str:
+        return f"ColumnarResult(columns={self.columns!r}, rows={len(self)})"
+
+    def column(self, name: str) -> Union[memoryview, list]:
+        """Return one column; packed numeric columns come back as a zero-copy memoryview"""
+        values = self._columns[self._positions[name]]
+        rows = self._rows
+        if not rows:
+            window = slice(0, 0)
+        elif rows.stop < 0:
+            # A reversed view running down to row 0; stop=-1 would mean the last row
+            window = slice(rows.start, None, rows.step)
+        else:
+            window = slice(rows.start, rows.stop, rows.step)
+        if isinstance(values, array):
+            return memoryview(values)[window]
+        return values[window]
+
+    def to_numpy(self, name: str):
+        """Return a column as a NumPy array, sharing memory for packed numeric columns"""
+        if np is None:
+            raise ImportError("NumPy is required for to_numpy()")
+        values = self.column(name)
+        if isinstance(values, memoryview):
+            return np.asarray(values)
+        return np.array(values, dtype=object)
+
+    def to_records(self) -> List[Dict[str, Any]]:
+        """Materialize rows as a list of dicts, matching execute_query's classic output"""
+        positions = self._positions
+        data = self._columns
+        return [{name: data[i][index] for name, i in positions.items()} for index in self._rows]
+
+    def to_tuples(self) -> List[tuple]:
+        """Materialize rows as a list of tuples"""
+        data = self._columns
+        return [tuple(values[index] for values in data) for index in self._rows]
+
+    @property
+    def error(self) -> Optional[str]:
+        """Error message if this result was produced by from_error(); a column named error is data"""
+        return self._error
+
+    def nbytes(self) -> int:
+        """Approximate size of the column buffers in bytes"""
+        total = 0
+        for values in self._columns:
+            if isinstance(values, array):
+                total += values.itemsize * len(values)
+            else:
+                total += 8 * len(values)
+        return total
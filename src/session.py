@@ -0,0 +1,250 @@
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    from .candidate_generation import clean_sql
+    from .model_routing import SchemaLinker
+    from .prompt_builder import PromptPrefix, estimate_tokens
+    from .query_stats import tokenize
+    from .result_set import ColumnarResult
+    from .sqlite_access import SharedDatabase, attach_uri, connect, read_tables
+    from .tracing import instrument, stage
+except ImportError:
+    from candidate_generation import clean_sql
+    from model_routing import SchemaLinker
+    from prompt_builder import PromptPrefix, estimate_tokens
+    from query_stats import tokenize
+    from result_set import ColumnarResult
+    from sqlite_access import SharedDatabase, attach_uri, connect, read_tables
+    from tracing import instrument, stage
+
+# Name under which the previous turn's result can be queried
+PREVIOUS_RESULT = "prev_result"
+
+FOLLOW_UP_TEMPLATE = """You are a SQL expert continuing a conversation about a SQLite database.
+
+Relevant tables:
+{schema}
+
+Conversation so far:
+{history}
+{previous_result}
+Convert the follow-up question into SQL. It may refer to earlier questions.
+Return only the SQL query without any explanation or formatting.
+
+Follow-up question: {question}
+SQL query:"""
+
+# Everything from the question on is the per-question suffix
+_QUESTION_AT = FOLLOW_UP_TEMPLATE.index("{question}")
+_FOLLOW_UP_HEAD, _FOLLOW_UP_TAIL = FOLLOW_UP_TEMPLATE[:_QUESTION_AT], FOLLOW_UP_TEMPLATE[_QUESTION_AT:]
+
+
+def unique_column_names(columns: List[str]) -> List[str]:
+    """Column names made unique for a table: a repeated "name" becomes "name_1", "name_2", ..."""
+    seen, names = set(), []
+    for name in columns:
+        unique, n = name, 0
+        while unique.lower() in seen:  # SQLite compares column names case-insensitively
+            n += 1
+            unique = f"{name}_{n}"
+        seen.add(unique.lower())
+        names.append(unique)
+    return names
+
+
+class Turn:
+    """One question of a session and the shape of its answer"""
+
+    __slots__ = ('question', 'sql_query', 'columns', 'row_count', 'tables', 'error', 'reused_result',
+                 'prompt_tokens')
+
+    def __init__(self, question: str, sql_query: Optional[str], columns: List[str], row_count: int,
+                 tables: List[str], error: Optional[str] = None, reused_result: bool = False,
+                 prompt_tokens: int = 0):
+        self.question = question
+        self.sql_query = sql_query
+        self.columns = columns
+        self.row_count = row_count
+        self.tables = tables
+        self.error = error
+        self.reused_result = reused_result
+        self.prompt_tokens = prompt_tokens
+
+    def __repr__(self) -> str:
+        return f"Turn({self.question!r}, rows={self.row_count})"
+
+
+class Session:
+    """A conversation over a TextToSQL.
+
+    The first question is sent with the full schema. Follow-ups get a
+    compact prompt instead: the schema of the tables the conversation has
+    used so far (plus any the new question names), the recent questions
+    with their SQL, and the columns of the previous result. The previous
+    result, when it has at most cache_rows rows, is kept in an in-memory
+    table named prev_result; a refinement ("only those in Engineering")
+    can be answered by querying it instead of the database.
+    """
+
+    def __init__(self, text_to_sql, max_turns: int = 5, cache_rows: int = 10000):
+        self.text_to_sql = text_to_sql
+        self.max_turns = max_turns
+        self.cache_rows = cache_rows
+        self.turns: List[Turn] = []
+        self.linker = SchemaLinker()
+        self._cache: Optional[sqlite3.Connection] = None
+        self._cached_columns: List[str] = []
+
+    def reset(self):
+        """Forget the conversation and the cached result"""
+        self.turns = []
+        self._drop_cache()
+
+    def close(self):
+        self._drop_cache()
+
+    def __enter__(self) -> 'Session':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _drop_cache(self):
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+            self._cached_columns = []
+
+    def _session_tables(self) -> List[str]:
+        tables = []
+        for turn in self.turns[-self.max_turns:]:
+            tables.extend(table for table in turn.tables if table not in tables)
+        return tables
+
+    def build_prompt(self, question: str) -> str:
+        """The follow-up prompt for a question; the full prompt if nothing was asked yet"""
+        prefix, suffix = self.build_prompt_parts(question)
+        return prefix.text + suffix
+
+    def build_prompt_parts(self, question: str) -> Tuple[PromptPrefix, str]:
+        """(prefix, suffix) of build_prompt(), as sent through TextToSQL.generate_sql"""
+        if not self.turns:
+            return self.text_to_sql.build_prompt_parts(question)
+
+        tables = self._session_tables()
+        tables.extend(table for table in self.linker.link(question, self.text_to_sql) if table not in tables)
+        schema = self.text_to_sql.get_enhanced_schema(tables=tables)
+
+        history = []
+        for turn in self.turns[-self.max_turns:]:
+            history.append(f"Q: {turn.question}")
+            history.append(f"SQL: {turn.sql_query or '(failed)'}")
+            if turn.error:
+                history.append(f"Error: {turn.error}")
+            else:
+                history.append(f"Result: {turn.row_count} rows; columns: {', '.join(turn.columns)}")
+
+        previous_result = ""
+        if self._cache is not None:
+            previous_result = (f"\nThe previous result is available as table {PREVIOUS_RESULT}"
+                               f"({', '.join(self._cached_columns)}). If the question only filters, sorts "
+                               f"or limits the previous result, query {PREVIOUS_RESULT} instead.\n")
+
+        prefix = PromptPrefix(_FOLLOW_UP_HEAD.format(schema=schema, history="\n".join(history),
+                                                     previous_result=previous_result))
+        return prefix, _FOLLOW_UP_TAIL.format(question=question)
+
+    def _generate(self, question: str, prompt_parts: Tuple[PromptPrefix, str]) -> str:
+        # Through TextToSQL so a configured router and token accounting apply to every turn
+        sql_query = self.text_to_sql.generate_sql(question, prompt_parts=prompt_parts if self.turns else None)
+        return sql_query if sql_query.startswith("Error") else clean_sql(sql_query)
+
+    def _uses_previous_result(self, sql_query: str) -> bool:
+        return self._cache is not None and any(
+            kind in ('word', 'identifier') and text.strip('"`[]').lower() == PREVIOUS_RESULT
+            for kind, text, _, _ in tokenize(sql_query))
+
+    def _execute_on_cache(self, sql_query: str) -> ColumnarResult:
+        """Run a query over prev_result, with the database attached for any base tables it joins"""
+        db_path = self.text_to_sql.db_path
+        start = time.perf_counter()
+        try:
+            if not isinstance(db_path, SharedDatabase) and \
+                    not self._cache.execute("PRAGMA database_list").fetchall()[1:]:
+                self._cache.execute("ATTACH DATABASE ? AS source",
+                                    (attach_uri(db_path, self.text_to_sql.access_profile),))
+            with stage('execute'):
+                result = ColumnarResult.from_cursor(self._cache.execute(sql_query))
+        except sqlite3.Error as e:
+            self.text_to_sql.query_stats.record(sql_query, time.perf_counter() - start, error=True)
+            return ColumnarResult.from_error(str(e))
+        self.text_to_sql.query_stats.record(sql_query, time.perf_counter() - start, rows=len(result))
+        return result
+
+    def _base_tables(self, sql_query: str, reused: bool) -> List[str]:
+        if reused:
+            # Refinements work on the tables the previous result came from
+            return list(self.turns[-1].tables)
+        try:
+            with connect(self.text_to_sql.db_path, self.text_to_sql.access_profile) as conn:
+                return read_tables(conn, sql_query)
+        except sqlite3.Error:
+            return []
+
+    def _cache_result(self, result: ColumnarResult):
+        self._drop_cache()
+        if len(result) > self.cache_rows or not result.columns:
+            return
+        names = unique_column_names(result.columns)  # joins often repeat names, e.g. e.name, d.name
+        self._cache = instrument(sqlite3.connect(":memory:", uri=True))
+        try:
+            columns = ", ".join('"' + name.replace('"', '""') + '"' for name in names)
+            self._cache.execute(f"CREATE TABLE {PREVIOUS_RESULT} ({columns})")
+            placeholders = ", ".join("?" * len(names))
+            self._cache.executemany(f"INSERT INTO {PREVIOUS_RESULT} VALUES ({placeholders})", result.to_tuples())
+            # Generated SQL only ever reads, from prev_result or the attached database
+            self._cache.execute("PRAGMA query_only = ON")
+        except sqlite3.Error:
+            self._drop_cache()  # follow-ups query the database instead
+            return
+        self._cached_columns = names
+
+    def ask(self, question: str) -> Dict[str, Any]:
+        """Answer a question in the context of the conversation, shaped like TextToSQL.query()
+
+        The result also carries reused_result (whether the previous result
+        was queried instead of the database) and prompt_tokens.
+        """
+        prefix, suffix = self.build_prompt_parts(question)
+        prompt_tokens = prefix.tokens + estimate_tokens(suffix)
+        sql_query = self._generate(question, (prefix, suffix))
+
+        if sql_query.startswith("Error"):
+            self.turns.append(Turn(question, None, [], 0, [], error=sql_query, prompt_tokens=prompt_tokens))
+            return {"question": question, "sql_query": None, "results": [], "error": sql_query,
+                    "reused_result": False, "prompt_tokens": prompt_tokens}
+
+        reused = self._uses_previous_result(sql_query)
+        if reused:
+            result = self._execute_on_cache(sql_query)
+        else:
+            result = self.text_to_sql.execute_query(sql_query, columnar=True)
+
+        error = result.error
+        turn = Turn(question, sql_query, [] if error else list(result.columns), 0 if error else len(result),
+                    self._base_tables(sql_query, reused), error=error, reused_result=reused,
+                    prompt_tokens=prompt_tokens)
+        if error is None:
+            self._cache_result(result)
+        self.turns.append(turn)
+
+        return {
+            "question": question,
+            "sql_query": sql_query,
+            "results": result.to_records(),
+            "error": None,
+            "reused_result": reused,
+            "prompt_tokens": prompt_tokens,
+        }
@@ -0,0 +1,618 @@
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+from urllib.request import pathname2url
+
+try:
+    from .text_to_sql import TextToSQL
+    from .result_set import ColumnarResult
+    from .query_stats import tokenize
+    from .sqlite_access import AccessProfile, connect, get_access_profile, is_internal_table, read_tables
+    from .tracing import instrument
+except ImportError:
+    from text_to_sql import TextToSQL
+    from result_set import ColumnarResult
+    from query_stats import tokenize
+    from sqlite_access import AccessProfile, connect, get_access_profile, is_internal_table, read_tables
+    from tracing import instrument
+
+_Token = namedtuple('_Token', 'kind text lower start end depth')
+
+_AGGREGATES = {'count', 'sum', 'total', 'avg', 'min', 'max'}
+
+# Built-in scalar functions; any other call (group_concat, json_group_array,
+# user-defined functions) may be an aggregate and is not fanned out
+_SCALAR_FUNCTIONS = {
+    'abs', 'char', 'coalesce', 'format', 'glob', 'hex', 'ifnull', 'iif', 'instr', 'length', 'like',
+    'likelihood', 'likely', 'lower', 'ltrim', 'nullif', 'octet_length', 'printf', 'quote', 'random',
+    'randomblob', 'replace', 'round', 'rtrim', 'sign', 'soundex', 'substr', 'substring', 'trim', 'typeof',
+    'unhex', 'unicode', 'unlikely', 'upper', 'zeroblob',
+    'date', 'time', 'datetime', 'julianday', 'strftime', 'unixepoch', 'timediff',
+    'acos', 'acosh', 'asin', 'asinh', 'atan', 'atan2', 'atanh', 'ceil', 'ceiling', 'cos', 'cosh',
+    'degrees', 'exp', 'floor', 'ln', 'log', 'log10', 'log2', 'mod', 'pi', 'pow', 'power', 'radians',
+    'sin', 'sinh', 'sqrt', 'tan', 'tanh', 'trunc',
+    'json', 'json_array', 'json_array_length', 'json_extract', 'json_insert', 'json_object', 'json_patch',
+    'json_quote', 'json_remove', 'json_replace', 'json_set', 'json_type', 'json_valid',
+}
+
+# Keywords that may be followed by "(" without being a function call
+_KEYWORDS = {'select', 'from', 'where', 'group', 'by', 'having', 'order', 'limit', 'offset', 'on',
+             'using', 'join', 'exists', 'values', 'all', 'distinct'}
+
+# Words that may appear outside aggregate calls in a merged expression
+_EXPRESSION_WORDS = {
+    'and', 'or', 'not', 'is', 'null', 'in', 'like', 'glob', 'between', 'escape', 'case', 'when',
+    'then', 'else', 'end', 'as', 'cast', 'integer', 'int', 'real', 'text', 'numeric', 'blob',
+    'collate', 'nocase', 'rtrim', 'binary', 'true', 'false', 'current_date', 'current_time',
+    'current_timestamp',
+}
+
+# Trailing words of an ORDER BY term that are not part of its expression
+_ORDER_SUFFIX_WORDS = {'asc', 'desc', 'nulls', 'first', 'last'}
+
+# Words ending a select item that cannot be an alias
+_NOT_ALIAS = {'end', 'null', 'true', 'false', 'current_date', 'current_time', 'current_timestamp'}
+
+_CLAUSE_ORDER = ('from', 'where', 'group', 'having', 'order', 'limit')
+
+# SQLite's compile-time default for SQLITE_LIMIT_ATTACHED
+DEFAULT_MAX_ATTACHED = 10
+
+
+class UnsupportedFanout(Exception):
+    """A statement whose result cannot be merged from per-shard results"""
+
+
+def _scan(sql_query: str) -> List[_Token]:
+    tokens = []
+    depth = 0
+    for kind, text, start, end in tokenize(sql_query):
+        if text == ')':
+            depth -= 1
+        if kind == 'identifier':
+            lower = text[1:-1].lower()
+        elif kind in ('word', 'operator', 'punct'):
+            lower = text.lower()
+        else:
+            lower = text
+        tokens.append(_Token(kind, text, lower, start, end, depth))
+        if text == '(':
+            depth += 1
+    return tokens
+
+
+class FanoutPlan:
+    """How to run one SELECT on every shard and combine the results.
+
+    partial_sql runs on each shard; merge_sql(width) runs over a table
+    "partials" (columns c0..c<width-1>) holding the concatenated shard rows.
+    """
+
+    def __init__(self, sql_query: str):
+        self.sql = sql_query.strip().rstrip(';').strip()
+        self.tokens = _scan(self.sql)
+        self.partial_columns = []  # partial column expressions, aliased c0, c1, ...
+        self.output_names = None  # None: take names from the shard cursor
+        self.hidden = 0  # trailing partial columns not part of the output
+        self._merged_select = None
+        self._merge_tail = ""
+        self._parse()
+
+    # -- token helpers -------------------------------------------------
+
+    def _text(self, i: int, j: int) -> str:
+        return self.sql[self.tokens[i].start:self.tokens[j - 1].end] if j > i else ""
+
+    def _norm(self, i: int, j: int) -> str:
+        return " ".join(token.lower for token in self.tokens[i:j])
+
+    def _split(self, i: int, j: int) -> List[Tuple[int, int]]:
+        """Split a range on commas at the range's own nesting depth"""
+        parts, start = [], i
+        depth = self.tokens[i].depth if i < j else 0
+        for k in range(i, j):
+            if self.tokens[k].text == ',' and self.tokens[k].depth == depth:
+                parts.append((start, k))
+                start = k + 1
+        parts.append((start, j))
+        return parts
+
+    def _closing(self, k: int) -> int:
+        """Index of the ')' matching the '(' at k"""
+        depth = self.tokens[k].depth
+        for m in range(k + 1, len(self.tokens)):
+            if self.tokens[m].text == ')' and self.tokens[m].depth == depth:
+                return m
+        raise UnsupportedFanout("unbalanced parentheses")
+
+    def _aggregate_calls(self, i: int, j: int) -> Dict[int, Tuple[int, str, str]]:
+        """Aggregate calls in a range: start index -> (closing index, function, argument text)"""
+        calls = {}
+        k = i
+        while k < j:
+            token = self.tokens[k]
+            if (token.kind == 'word' and token.lower in _AGGREGATES and k + 1 < j
+                    and self.tokens[k + 1].text == '('):
+                close = self._closing(k + 1)
+                args = self._split(k + 2, close)
+                if len(args) == 1:  # min()/max() with several arguments are scalar functions
+                    if close > k + 2 and self.tokens[k + 2].lower == 'distinct':
+                        raise UnsupportedFanout(f"{token.text}(DISTINCT ...) cannot be merged across shards")
+                    if self._aggregate_calls(k + 2, close):
+                        raise UnsupportedFanout("nested aggregate calls")
+                    if close + 1 < len(self.tokens) and self.tokens[close + 1].lower == 'filter':
+                        raise UnsupportedFanout("aggregate FILTER clauses")
+                    calls[k] = (close, token.lower, self._text(k + 2, close))
+                    k = close + 1
+                    continue
+            k += 1
+        return calls
+
+    # -- parsing -------------------------------------------------------
+
+    def _parse(self):
+        tokens = self.tokens
+        if not tokens or tokens[0].lower != 'select':
+            raise UnsupportedFanout("only plain SELECT statements fan out")
+        for token in tokens:
+            if token.kind != 'word':
+                continue
+            if token.lower in ('union', 'intersect', 'except', 'window', 'over'):
+                raise UnsupportedFanout(f"{token.text.upper()} needs all rows in one place")
+            if token.lower == 'select' and token.depth > 0:
+                raise UnsupportedFanout("subqueries see only one shard's rows")
+        if len(tokens) > 1 and tokens[1].lower == 'distinct':
+            raise UnsupportedFanout("SELECT DISTINCT")
+        for k, token in enumerate(tokens[:-1]):
+            if (token.kind in ('word', 'identifier') and tokens[k + 1].text == '('
+                    and token.lower not in _AGGREGATES and token.lower not in _SCALAR_FUNCTIONS
+                    and token.lower not in _EXPRESSION_WORDS and token.lower not in _KEYWORDS):
+                raise UnsupportedFanout(f"{token.text}() may be an aggregate that cannot be merged across shards")
+
+        positions = {}
+        for k, token in enumerate(tokens):
+            if token.depth or token.kind != 'word' or token.lower not in _CLAUSE_ORDER:
+                continue
+            if token.lower in ('group', 'order') and not (k + 1 < len(tokens) and tokens[k + 1].lower == 'by'):
+                continue
+            positions.setdefault(token.lower, k)
+        if 'from' not in positions:
+            raise UnsupportedFanout("no FROM clause")
+        found = sorted(positions, key=positions.get)
+        if found != [clause for clause in _CLAUSE_ORDER if clause in positions]:
+            raise UnsupportedFanout("unexpected clause order")
+
+        bounds = {}
+        select_start = 2 if tokens[1].lower == 'all' else 1
+        bounds['select'] = (select_start, positions['from'])
+        for n, clause in enumerate(found):
+            start = positions[clause] + (2 if clause in ('group', 'order') else 1)
+            end = positions[found[n + 1]] if n + 1 < len(found) else len(tokens)
+            bounds[clause] = (start, end)
+
+        source_end = bounds['where'][1] if 'where' in bounds else bounds['from'][1]
+        self.source = self._text(positions['from'], source_end)
+
+        self.select_range = bounds['select']
+        self.items = []  # (expression range, lowercased alias)
+        for i, j in self._split(*bounds['select']):
+            self.items.append(self._select_item(i, j))
+
+        self.limit = self._parse_limit(*bounds['limit']) if 'limit' in bounds else None
+        groups = self._split(*bounds['group']) if 'group' in bounds else []
+        has_aggregates = any(self._aggregate_calls(i, j) for (i, j), _ in self.items)
+        if groups or has_aggregates or 'having' in bounds:
+            self._plan_aggregate(groups, bounds.get('having'), bounds.get('order'))
+        else:
+            self._plan_rows(bounds.get('order'))
+
+    def _select_item(self, i: int, j: int) -> Tuple[Tuple[int, int], Optional[str]]:
+        tokens = self.tokens
+        if j - i >= 3 and tokens[j - 2].lower == 'as':
+            return (i, j - 2), tokens[j - 1].lower
+        last, previous = tokens[j - 1], tokens[j - 2] if j - i >= 2 else None
+        if (previous is not None and last.kind in ('word', 'identifier') and last.lower not in _NOT_ALIAS
+                and (previous.text == ')' or previous.kind in ('identifier', 'number', 'string')
+                     or (previous.kind == 'word' and previous.lower not in _EXPRESSION_WORDS))):
+            return (i, j - 1), last.lower
+        return (i, j), None
+
+    def _parse_limit(self, i: int, j: int) -> Tuple[int, int]:
+        parts = [token for token in self.tokens[i:j]]
+        if len(parts) == 1 and parts[0].kind == 'number':
+            return int(parts[0].text), 0
+        if len(parts) == 3 and parts[0].kind == parts[2].kind == 'number':
+            if parts[1].lower == 'offset':
+                return int(parts[0].text), int(parts[2].text)
+            if parts[1].text == ',':
+                return int(parts[2].text), int(parts[0].text)
+        raise UnsupportedFanout("LIMIT must be a constant")
+
+    def _limit_clause(self) -> str:
+        if self.limit is None:
+            return ""
+        limit, offset = self.limit
+        return f" LIMIT {limit} OFFSET {offset}" if offset else f" LIMIT {limit}"
+
+    def _order_terms(self, i: int, j: int) -> List[Tuple[Tuple[int, int], str]]:
+        """ORDER BY terms as (expression range, suffix such as 'COLLATE NOCASE DESC')"""
+        terms = []
+        for start, end in self._split(i, j):
+            cut = end
+            while cut > start + 1 and self.tokens[cut - 1].lower in _ORDER_SUFFIX_WORDS:
+                cut -= 1
+            if cut > start + 2 and self.tokens[cut - 2].lower == 'collate':
+                cut -= 2
+            terms.append(((start, cut), self._text(cut, end)))
+        return terms
+
+    def _item_for(self, i: int, j: int) -> Optional[int]:
+        """Select item an ORDER BY/GROUP BY term refers to by position, alias or identical text"""
+        if j - i == 1 and self.tokens[i].kind == 'number':
+            position = int(self.tokens[i].text) - 1
+            if not 0 <= position < len(self.items):
+                raise UnsupportedFanout("term position out of range")
+            return position
+        norm = self._norm(i, j)
+        for n, ((start, end), alias) in enumerate(self.items):
+            if (j - i == 1 and alias == self.tokens[i].lower) or self._norm(start, end) == norm:
+                return n
+        return None
+
+    def _add_partial(self, expression: str) -> str:
+        if expression not in self.partial_columns:
+            self.partial_columns.append(expression)
+        return f"c{self.partial_columns.index(expression)}"
+
+    # -- row queries ---------------------------------------------------
+
+    def _plan_rows(self, order: Optional[Tuple[int, int]]):
+        """No aggregation: concatenate shard rows, then order and limit globally"""
+        hidden, suffixes = [], []
+        for (i, j), suffix in (self._order_terms(*order) if order else []):
+            item = self._item_for(i, j)
+            if item is not None:
+                (i, j), _ = self.items[item]
+                if self._text(i, j).endswith('*'):
+                    raise UnsupportedFanout("ORDER BY refers to a * column")
+            hidden.append(self._text(i, j))
+            suffixes.append(suffix)
+        self.hidden = len(hidden)
+
+        columns = [self._text(*self.select_range)] + [f"{expression} AS __t2s_order_{n}" for n, expression in enumerate(hidden)]
+        partial = f"SELECT {', '.join(columns)} {self.source}"
+        if order:
+            partial += " ORDER BY " + self._text(*order)
+        if self.limit is not None:
+            # Each shard returns only the rows that can make the global top-N
+            partial += f" LIMIT {self.limit[0] + self.limit[1]}"
+        self.partial_sql = partial
+        self._order_suffixes = suffixes
+
+    # -- aggregate queries ---------------------------------------------
+
+    def _plan_aggregate(self, groups: List[Tuple[int, int]], having: Optional[Tuple[int, int]],
+                        order: Optional[Tuple[int, int]]):
+        """Aggregate per shard, then re-aggregate the partial aggregates"""
+        self._references = {}  # normalized expression or alias -> merged SQL
+
+        group_columns, group_expressions = [], []
+        for i, j in groups:
+            item = self._item_for(i, j)
+            if item is not None:
+                (i, j), _ = self.items[item]
+                if self._aggregate_calls(i, j):
+                    raise UnsupportedFanout("GROUP BY an aggregate")
+            expression = self._text(i, j)
+            group_expressions.append(expression)
+            column = self._add_partial(expression)
+            group_columns.append(column)
+            self._references[self._norm(i, j)] = column
+
+        # Plain (grouped) select items first, so aggregates can refer to them
+        merged = [None] * len(self.items)
+        for n, ((i, j), alias) in enumerate(self.items):
+            if not self._aggregate_calls(i, j):
+                if self._text(i, j).endswith('*'):
+                    raise UnsupportedFanout("* in an aggregate query")
+                merged[n] = self._add_partial(self._text(i, j))
+                self._references.setdefault(self._norm(i, j), merged[n])
+                if alias:
+                    self._references.setdefault(alias, merged[n])
+        for n, ((i, j), alias) in enumerate(self.items):
+            if merged[n] is None:
+                merged[n] = self._merge_expression(i, j)
+                if alias:
+                    self._references.setdefault(alias, f"({merged[n]})")
+
+        self.output_names = [self._alias_text(n) or self._default_name(*self.items[n][0])
+                             for n in range(len(self.items))]
+        self._merged_select = ", ".join(f"{expression} AS r{n}" for n, expression in enumerate(merged))
+
+        tail = ""
+        if group_columns:
+            tail += " GROUP BY " + ", ".join(group_columns)
+        if having:
+            tail += " HAVING " + self._merge_expression(*having)
+        if order:
+            terms = []
+            for (i, j), suffix in self._order_terms(*order):
+                item = self._item_for(i, j)
+                expression = f"r{item}" if item is not None else self._merge_expression(i, j)
+                terms.append(f"{expression} {suffix}".strip())
+            tail += " ORDER BY " + ", ".join(terms)
+        self._merge_tail = tail + self._limit_clause()
+
+        partial = f"SELECT {', '.join(f'{c} AS c{n}' for n, c in enumerate(self.partial_columns))} {self.source}"
+        if group_expressions:
+            partial += " GROUP BY " + ", ".join(group_expressions)
+        self.partial_sql = partial
+
+    def _alias_text(self, n: int) -> Optional[str]:
+        """An item's alias as written (aliases are stored lowercased for matching)"""
+        (i, j), alias = self.items[n]
+        if alias is None:
+            return None
+        token = self.tokens[j + 1] if self.tokens[j].lower == 'as' else self.tokens[j]
+        return token.text[1:-1] if token.kind == 'identifier' else token.text
+
+    def _default_name(self, i: int, j: int) -> str:
+        """Result column name SQLite gives an unaliased expression"""
+        if self.tokens[j - 1].kind in ('word', 'identifier') and all(
+                token.kind in ('word', 'identifier') or token.text == '.' for token in self.tokens[i:j]):
+            token = self.tokens[j - 1]
+            return token.text[1:-1] if token.kind == 'identifier' else token.text
+        return self._text(i, j)
+
+    def _merge_aggregate(self, function: str, argument: str) -> str:
+        if function == 'avg':
+            total = self._add_partial(f"SUM({argument})")
+            count = self._add_partial(f"COUNT({argument})")
+            return f"(CAST(SUM({total}) AS REAL) / NULLIF(SUM({count}), 0))"
+        column = self._add_partial(f"{function.upper()}({argument})")
+        merge = {'count': 'SUM', 'sum': 'SUM', 'total': 'TOTAL', 'min': 'MIN', 'max': 'MAX'}[function]
+        return f"{merge}({column})"
+
+    def _merge_expression(self, i: int, j: int) -> str:
+        """Rewrite an expression over source rows into one over the partials table"""
+        reference = self._references.get(self._norm(i, j))
+        if reference is not None:
+            return reference
+
+        calls = self._aggregate_calls(i, j)
+        parts, position, k = [], self.tokens[i].start, i
+        while k < j:
+            token = self.tokens[k]
+            if k in calls:
+                close, function, argument = calls[k]
+                parts.append(self.sql[position:token.start] + self._merge_aggregate(function, argument))
+                position, k = self.tokens[close].end, close + 1
+                continue
+            is_call = k + 1 < j and self.tokens[k + 1].text == '('
+            if token.kind == 'identifier' or (token.kind == 'word' and not is_call
+                                              and token.lower not in _EXPRESSION_WORDS):
+                end = k
+                while end + 2 < j and self.tokens[end + 1].text == '.' and \
+                        self.tokens[end + 2].kind in ('word', 'identifier'):
+                    end += 2
+                reference = self._references.get(self._norm(k, end + 1))
+                if reference is None:
+                    raise UnsupportedFanout(f"{self._text(k, end + 1)} is neither grouped nor aggregated")
+                parts.append(self.sql[position:token.start] + reference)
+                position, k = self.tokens[end].end, end + 1
+                continue
+            k += 1
+        parts.append(self.sql[position:self.tokens[j - 1].end])
+        return "".join(parts)
+
+    def merge_sql(self, width: int) -> str:
+        if self._merged_select is not None:
+            return f"SELECT {self._merged_select} FROM partials{self._merge_tail}"
+        visible = width - self.hidden
+        sql = f"SELECT {', '.join(f'c{n}' for n in range(visible))} FROM partials"
+        if self.hidden:
+            sql += " ORDER BY " + ", ".join(f"c{visible + n} {suffix}".strip()
+                                            for n, suffix in enumerate(self._order_suffixes))
+        return sql + self._limit_clause()
+
+
+def plan_fanout(sql_query: str) -> FanoutPlan:
+    """Plan a SELECT for per-shard execution; raises UnsupportedFanout if it can't be merged"""
+    return FanoutPlan(sql_query)
+
+
+def _run_on_shard(task: Tuple[str, str, AccessProfile]) -> Tuple[List[str], List[tuple]]:
+    """Process pool worker: run the partial query on one shard"""
+    path, sql_query, profile = task
+    with connect(path, profile) as conn:
+        cursor = conn.execute(sql_query)
+        columns = [description[0] for description in cursor.description or ()]
+        return columns, cursor.fetchall()
+
+
+def merge_partials(plan: FanoutPlan, partials: Sequence[Tuple[List[str], List[tuple]]]) -> Tuple[List[str], List[tuple]]:
+    """Combine per-shard partial results in an in-memory database"""
+    names = partials[0][0]
+    width = len(names)
+    conn = instrument(sqlite3.connect(":memory:"))
+    try:
+        conn.execute(f"CREATE TABLE partials ({', '.join(f'c{n}' for n in range(width))})")
+        insert = f"INSERT INTO partials VALUES ({', '.join('?' * width)})"
+        for _, rows in partials:
+            conn.executemany(insert, rows)
+        rows = conn.execute(plan.merge_sql(width)).fetchall()
+    finally:
+        conn.close()
+    return plan.output_names or names[:width - plan.hidden], rows
+
+
+class ShardedTextToSQL(TextToSQL):
+    """TextToSQL over several SQLite files holding the same tables (e.g. one per month).
+
+    Each table is either partitioned (every shard holds some of its rows,
+    the default) or replicated (every shard holds a full copy, e.g. a
+    dimension table; listed in replicated_tables). The model sees one
+    logical schema, taken from the first shard, which also holds the
+    column metadata. A statement reading only replicated tables runs on
+    the first shard. Otherwise a generated SELECT runs on every shard in
+    parallel in a process pool, joining partitioned rows with the shard's
+    copy of the replicated tables, and the partial results are merged in an
+    in-memory database: COUNT/SUM/TOTAL/MIN/MAX are re-aggregated, AVG is
+    rebuilt from per-shard SUM and COUNT, and HAVING, ORDER BY and LIMIT are
+    applied globally (LIMIT is also pushed down for plain row queries).
+    Statements that cannot be merged (DISTINCT, subqueries, compound
+    SELECTs, window functions, other aggregates such as group_concat) run
+    instead on one connection that attaches the shards read-only: partitioned
+    tables become UNION ALL views over every shard and replicated tables
+    views over the first. With more shards than SQLite can attach at once
+    (SQLITE_LIMIT_ATTACHED, 10 by default) the tables the statement reads
+    are copied into temporary tables instead, a batch of shards at a time.
+    Only the first shard is written: it gets the library's
+    bookkeeping tables (column_metadata, metadata_generation and its
+    triggers, and query_stats if stats_db_path points to it). The
+    other shards are only read.
+    """
+
+    def __init__(self, shard_paths: Sequence[str], model=None, workers: Optional[int] = None,
+                 access_profile: Union[str, AccessProfile, None] = None, stats_db_path: Optional[str] = None,
+                 replicated_tables: Sequence[str] = ()):
+        if not shard_paths:
+            raise ValueError("At least one shard is required")
+        self.shard_paths = list(shard_paths)
+        self.workers = workers if workers is not None else min(len(self.shard_paths), os.cpu_count() or 1)
+        self.last_plan = None
+        self._pool = None
+        super().__init__(self.shard_paths[0], model=model, seed_sample_data=False,
+                         access_profile=access_profile, stats_db_path=stats_db_path)
+        self._shard_tables = self._check_shards()
+        unknown = sorted(set(replicated_tables) - set(self._shard_tables))
+        if unknown:
+            raise ValueError(f"Replicated tables {unknown} are not in the shards")
+        self.replicated_tables = sorted(set(replicated_tables))
+
+    def _check_shards(self) -> List[str]:
+        """Make sure every shard has the same tables; return their names"""
+        expected = None
+        for path in self.shard_paths:
+            with connect(path, 'read_only') as conn:
+                tables = sorted(row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+                                if not is_internal_table(row[0]))
+            if expected is None:
+                expected = tables
+            elif tables != expected:
+                raise ValueError(f"Shard {path} has tables {tables}, expected {expected}")
+        return expected
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def _execute_fanout(self, plan: FanoutPlan) -> Tuple[List[str], List[tuple]]:
+        tasks = [(path, plan.partial_sql, self.access_profile) for path in self.shard_paths]
+        if self.workers > 1:
+            partials = list(self._get_pool().map(_run_on_shard, tasks))
+        else:
+            partials = [_run_on_shard(task) for task in tasks]
+        return merge_partials(plan, partials)
+
+    def _tables_read(self, sql_query: str) -> List[str]:
+        with connect(self.shard_paths[0], 'read_only') as conn:
+            return [table for table in read_tables(conn, sql_query) if table in self._shard_tables]
+
+    def _execute_single(self, sql_query: str) -> Tuple[List[str], List[tuple]]:
+        """Run a statement reading only replicated tables on the first shard, read-only"""
+        profile = self.access_profile if get_access_profile(self.access_profile).read_only else 'read_only'
+        return _run_on_shard((self.shard_paths[0], sql_query, profile))
+
+    def _attach(self, conn: sqlite3.Connection, n: int):
+        conn.execute("ATTACH DATABASE ? AS ?",
+                     ("file:" + pathname2url(os.path.abspath(self.shard_paths[n])) + "?mode=ro", f"shard{n}"))
+
+    def _shards_holding(self, table: str) -> range:
+        return range(1) if table in self.replicated_tables else range(len(self.shard_paths))
+
+    def _copy_tables(self, conn: sqlite3.Connection, tables: List[str], batch: int):
+        """Copy the rows of tables into same-named temporary tables, attaching batch shards at a time"""
+        for first in range(0, len(self.shard_paths), batch):
+            shards = range(first, min(first + batch, len(self.shard_paths)))
+            for n in shards:
+                self._attach(conn, n)
+            for table in tables:
+                quoted = '"' + table.replace('"', '""') + '"'
+                if first == 0:
+                    # Declared types only: same affinities, no constraints (keys may repeat across shards)
+                    columns = ", ".join('"' + row[1].replace('"', '""') + '" ' + row[2]
+                                        for row in conn.execute(f"PRAGMA shard0.table_info({quoted})"))
+                    conn.execute(f"CREATE TEMP TABLE {quoted} ({columns})")
+                for n in shards:
+                    if n in self._shards_holding(table):
+                        conn.execute(f"INSERT INTO temp.{quoted} SELECT * FROM shard{n}.{quoted}")
+            for n in shards:
+                conn.execute(f"DETACH DATABASE shard{n}")
+
+    def _execute_attached(self, sql_query: str, tables: List[str]) -> Tuple[List[str], List[tuple]]:
+        """Run a statement over all shards at once through views, or copies past the attach limit"""
+        conn = instrument(sqlite3.connect("file::memory:", uri=True))
+        conn.isolation_level = None  # DETACH needs autocommit
+        try:
+            limit = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) if hasattr(conn, 'getlimit') \
+                else DEFAULT_MAX_ATTACHED
+            if len(self.shard_paths) > limit:
+                self._copy_tables(conn, tables, limit)
+            else:
+                for n in range(len(self.shard_paths)):
+                    self._attach(conn, n)
+                for table in self._shard_tables:
+                    quoted = '"' + table.replace('"', '""') + '"'
+                    union = " UNION ALL ".join(f"SELECT * FROM shard{n}.{quoted}"
+                                               for n in self._shards_holding(table))
+                    conn.execute(f"CREATE TEMP VIEW {quoted} AS {union}")
+            cursor = conn.execute(sql_query)
+            columns = [description[0] for description in cursor.description or ()]
+            return columns, cursor.fetchall()
+        finally:
+            conn.close()
+
+    def _execute(self, sql_query: str, columnar: bool) -> Tuple[Union[List[Dict[str, Any]], ColumnarResult],
+                                                                 Optional[str]]:
+        """Execute SQL across all shards and return the merged results, plus the error if it failed"""
+        start = time.perf_counter()
+        try:
+            tables = self._tables_read(sql_query)
+            replicated = [table for table in tables if table in self.replicated_tables]
+            layout = {"partitioned": [table for table in tables if table not in replicated],
+                      "replicated": replicated}
+            if replicated and not layout["partitioned"]:
+                self.last_plan = dict(layout, mode="single")
+                columns, rows = self._execute_single(sql_query)
+            else:
+                try:
+                    plan = plan_fanout(sql_query)
+                except UnsupportedFanout as e:
+                    self.last_plan = dict(layout, mode="attached", reason=str(e))
+                    columns, rows = self._execute_attached(sql_query, tables)
+                else:
+                    self.last_plan = dict(layout, mode="fanout", partial_sql=plan.partial_sql)
+                    columns, rows = self._execute_fanout(plan)
+        except Exception as e:
+            self.query_stats.record(sql_query, time.perf_counter() - start, error=True)
+            if columnar:
+                return ColumnarResult.from_error(str(e)), str(e)
+            return [{"error": str(e)}], str(e)
+        self.query_stats.record(sql_query, time.perf_counter() - start, rows=len(rows))
+        if columnar:
+            return ColumnarResult.from_rows(columns, rows), None
+        return [dict(zip(columns, row)) for row in rows], None
+
+    def enable_aggregate_cache(self, *args, **kwargs):
+        raise ValueError("The aggregate cache works on a single database, not on shards")
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+        super().close()
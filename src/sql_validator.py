@@ -1,10 +1,26 @@
 import sqlite3
 import re
-from typing import List, Tuple
+from typing import List, Optional, Tuple, Union
+
+try:
+    from .sqlite_access import connect, get_access_profile, AccessProfile, as_database, keep_alive
+    from .tracing import explain, stage
+except ImportError:
+    from sqlite_access import connect, get_access_profile, AccessProfile, as_database, keep_alive
+    from tracing import explain, stage
 
 class SQLValidator:
-    def __init__(self, db_path: str = "example.db"):
-        self.db_path = db_path
+    def __init__(self, db_path: str = "example.db", access_profile: Union[str, AccessProfile, None] = None,
+                 connection: Optional[sqlite3.Connection] = None, engine=None):
+        self.db_path = as_database(db_path, connection=connection, engine=engine)
+        self.access_profile = get_access_profile(access_profile)
+        self._keeper = keep_alive(self.db_path)
+
+    def close(self):
+        """Release the in-memory database this validator keeps alive, if any"""
+        if self._keeper is not None:
+            self._keeper.close()
+            self._keeper = None
 
     def validate_query(self, sql_query: str) -> Tuple[bool, List[str]]:
         """Validate SQL query and return (is_valid, error_messages)"""
@@ -66,9 +82,9 @@ class SQLValidator:
     def _validate_syntax(self, sql_query: str) -> bool:
         """Validate SQL syntax using database engine"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with stage('validate'), connect(self.db_path, self.access_profile) as conn:
                 # Use EXPLAIN to validate syntax without executing
-                conn.execute(f"EXPLAIN {sql_query}")
+                explain(conn, sql_query)
                 return True
         except sqlite3.Error:
             return False
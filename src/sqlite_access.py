@@ -0,0 +1,341 @@
+import os
+import sqlite3
+import uuid
+from typing import Callable, List, Optional, Tuple, Union
+from urllib.parse import parse_qs
+from urllib.request import pathname2url
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool, StaticPool
+
+try:
+    from .tracing import explain, instrument, watch_engine
+except ImportError:
+    from tracing import explain, instrument, watch_engine
+
+# Bookkeeping tables the library keeps inside user databases; never shown to the LLM
+INTERNAL_TABLES = {'column_metadata', 'metadata_generation', 'query_stats', 'aggregate_cache'}
+
+# Materialized aggregate summaries (see aggregate_cache.py)
+SUMMARY_TABLE_PREFIX = 't2s_agg_'
+
+MEMORY_DATABASE = ':memory:'
+
+
+def is_internal_table(table_name: str) -> bool:
+    """Check whether a table belongs to the library rather than the user's data"""
+    return (table_name in INTERNAL_TABLES or table_name.startswith('sqlite_')
+            or table_name.startswith(SUMMARY_TABLE_PREFIX))
+
+
+def catalog_version(conn: sqlite3.Connection) -> Tuple[int, int]:
+    """Return (schema_version, metadata_generation) for change detection.
+
+    schema_version is bumped by SQLite on any DDL; metadata_generation is
+    bumped by triggers on column_metadata, so together they identify one
+    snapshot of everything the schema text is built from.
+    """
+    schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+    try:
+        row = conn.execute("SELECT generation FROM metadata_generation WHERE id = 0").fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    return schema_version, row[0] if row else 0
+
+
+def read_tables(conn: sqlite3.Connection, sql_query: str) -> List[str]:
+    """Tables of the main database a statement reads, from the OpenRead opcodes of its program"""
+    root_pages = {row[0]: row[1] for row in
+                  conn.execute("SELECT rootpage, tbl_name FROM sqlite_master WHERE rootpage > 0")}
+    tables = set()
+    for row in explain(conn, sql_query):
+        # columns: addr, opcode, p1, p2, p3, ...; p3 is the database index (0 = main)
+        if row[1] == "OpenRead" and row[4] == 0 and row[3] in root_pages:
+            tables.add(root_pages[row[3]])
+    return sorted(table for table in tables if not table.startswith('sqlite_'))
+
+
+class AccessProfile:
+    """How connections to a database are opened and tuned.
+
+    read_only opens the file with URI mode=ro and PRAGMA query_only;
+    immutable additionally passes immutable=1, which lets SQLite skip all
+    locking and change detection (only safe for frozen snapshots).
+    journal_mode is applied once, through a writable connection, when the
+    database is initialized. With initialize=False (implied by immutable)
+    TextToSQL never writes to the database: no journal mode, metadata
+    tables or sample data.
+    """
+
+    def __init__(self, name: str, read_only: bool = False, immutable: bool = False,
+                 mmap_size: Optional[int] = None, cache_size: Optional[int] = None,
+                 temp_store: Optional[str] = None, journal_mode: Optional[str] = None,
+                 initialize: bool = True):
+        self.name = name
+        self.read_only = read_only or immutable
+        self.immutable = immutable
+        self.initialize = initialize and not immutable
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.temp_store = temp_store
+        self.journal_mode = journal_mode
+
+    def __repr__(self) -> str:
+        return f"AccessProfile({self.name!r})"
+
+
+ACCESS_PROFILES = {
+    # Plain sqlite3.connect() behaviour
+    'default': AccessProfile('default'),
+    # Read-mostly analytics on local disk: WAL so metadata writes don't block readers
+    'read_only': AccessProfile('read_only', read_only=True, mmap_size=256 * 1024 * 1024,
+                               cache_size=-64000, temp_store='MEMORY', journal_mode='WAL'),
+    # Databases owned by someone else: read, but never initialized or written
+    'query_only': AccessProfile('query_only', read_only=True, initialize=False, mmap_size=256 * 1024 * 1024,
+                                cache_size=-64000, temp_store='MEMORY'),
+    # Frozen snapshot files that never change while open
+    'immutable': AccessProfile('immutable', immutable=True, mmap_size=256 * 1024 * 1024,
+                               cache_size=-64000, temp_store='MEMORY'),
+}
+
+
+def get_access_profile(profile: Union[str, AccessProfile, None]) -> AccessProfile:
+    """Resolve a profile name (or None for 'default') to an AccessProfile"""
+    if isinstance(profile, AccessProfile):
+        return profile
+    try:
+        return ACCESS_PROFILES[profile or 'default']
+    except KeyError:
+        raise ValueError(f"Unknown access profile: {profile} (expected one of {', '.join(ACCESS_PROFILES)})") from None
+
+
+def is_uri(db_path) -> bool:
+    return isinstance(db_path, str) and db_path.startswith('file:')
+
+
+def is_memory_database(db_path) -> bool:
+    """Check whether db_path names an in-memory database (plain or shared-cache URI)"""
+    if not isinstance(db_path, str):
+        return False
+    if db_path == MEMORY_DATABASE:
+        return True
+    if not is_uri(db_path):
+        return False
+    location, _, query = db_path[len('file:'):].partition('?')
+    return location == MEMORY_DATABASE or 'memory' in parse_qs(query).get('mode', [])
+
+
+def resolve_database(db_path):
+    """Turn ":memory:" into a uniquely named shared-cache URI.
+
+    Every sqlite3 connection to ":memory:" gets its own empty database;
+    connections to the same "file:name?mode=memory&cache=shared" URI share
+    one, for as long as at least one of them stays open (see keep_alive()).
+    Anything else is returned unchanged.
+    """
+    if db_path == MEMORY_DATABASE:
+        return f"file:t2s_memory_{uuid.uuid4().hex}?mode=memory&cache=shared"
+    return db_path
+
+
+def keep_alive(db_path) -> Optional[sqlite3.Connection]:
+    """Open a connection that keeps a shared in-memory database alive.
+
+    Returns None for anything but an in-memory URI. The database is
+    discarded once the returned connection and all others are closed.
+    """
+    if is_uri(db_path) and is_memory_database(db_path):
+        return sqlite3.connect(db_path, uri=True, check_same_thread=False)
+    return None
+
+
+class SharedConnection:
+    """A connection handed out by SharedDatabase.
+
+    Behaves like sqlite3.Connection for the library's purposes, but the
+    row_factory and any progress handler, trace callback or authorizer set
+    through it apply only until it is released, so they never leak into the
+    caller's own use of the connection. Leaving a "with" block commits (or
+    rolls back) and releases it; close() releases it. Releasing returns
+    pooled connections to their engine and leaves injected ones open.
+    """
+
+    def __init__(self, connection, release: Optional[Callable[[], None]] = None):
+        self._connection = connection
+        self._release = release
+        self._hooks = set()
+        self.row_factory = None
+
+    def cursor(self, *args) -> sqlite3.Cursor:
+        cursor = self._connection.cursor(*args)
+        if self.row_factory is not None:
+            cursor.row_factory = self.row_factory
+        return cursor
+
+    def execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, parameters) -> sqlite3.Cursor:
+        return self.cursor().executemany(sql, parameters)
+
+    def set_progress_handler(self, handler, n: int):
+        self._hooks.add('progress')
+        self._connection.set_progress_handler(handler, n)
+
+    def set_trace_callback(self, callback):
+        self._hooks.add('trace')
+        self._connection.set_trace_callback(callback)
+
+    def set_authorizer(self, callback):
+        self._hooks.add('authorizer')
+        self._connection.set_authorizer(callback)
+
+    def close(self):
+        if self._connection is None:
+            return
+        connection, self._connection = self._connection, None
+        if 'progress' in self._hooks:
+            connection.set_progress_handler(None, 0)
+        if 'trace' in self._hooks:
+            connection.set_trace_callback(None)
+        if 'authorizer' in self._hooks:
+            connection.set_authorizer(None)
+        if self._release is not None:
+            self._release()
+
+    def __enter__(self) -> 'SharedConnection':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._connection is not None:
+            if exc_type is None:
+                self._connection.commit()
+            else:
+                self._connection.rollback()
+        self.close()
+        return False
+
+    def __getattr__(self, name: str):
+        if self._connection is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(self._connection, name)
+
+
+class SharedDatabase:
+    """A caller-supplied sqlite3 connection or SQLAlchemy engine used in place of a path.
+
+    Pass one to TextToSQL, SQLValidator and DatabaseUtils (as connection=
+    or engine=, or as db_path) and they all read and write through it
+    instead of opening files. An injected sqlite3 connection is never
+    closed by the library and is shared across threads, so create it with
+    check_same_thread=False. An injected engine must hand out connections
+    to a single database (e.g. a file, or StaticPool for ":memory:").
+    """
+
+    def __init__(self, connection: Optional[sqlite3.Connection] = None, engine=None):
+        if (connection is None) == (engine is None):
+            raise ValueError("Pass exactly one of connection or engine")
+        self.connection = connection
+        self.engine = engine
+
+    def connect(self) -> SharedConnection:
+        if self.connection is not None:
+            return SharedConnection(self.connection)
+        raw = self.engine.raw_connection()
+        return SharedConnection(raw.driver_connection, release=raw.close)
+
+    def __repr__(self) -> str:
+        source = self.connection if self.connection is not None else self.engine
+        return f"SharedDatabase({source!r})"
+
+
+def as_database(db_path, connection: Optional[sqlite3.Connection] = None, engine=None):
+    """Pick the database a component works on: an injected connection/engine or db_path"""
+    if connection is not None or engine is not None:
+        return SharedDatabase(connection=connection, engine=engine)
+    return resolve_database(db_path)
+
+
+def _database_uri(db_path: str, profile: AccessProfile) -> str:
+    if is_uri(db_path):
+        location, _, query = db_path.partition('?')
+        params = [param for param in query.split('&') if param and not param.startswith(('mode=', 'immutable='))]
+    else:
+        location, params = "file:" + pathname2url(os.path.abspath(db_path)), []
+    params.append("mode=ro")
+    if profile.immutable:
+        params.append("immutable=1")
+    return location + "?" + "&".join(params)
+
+
+def attach_uri(db_path, profile: Union[str, AccessProfile, None] = None) -> str:
+    """URI for ATTACHing db_path to a connection opened with uri=True"""
+    if is_memory_database(db_path):
+        # Named in-memory databases are already URIs and cannot be opened with mode=ro
+        return db_path
+    return _database_uri(db_path, get_access_profile(profile))
+
+
+def connect_writable(db_path, **kwargs) -> sqlite3.Connection:
+    """Open a plain writable connection to a path, URI or SharedDatabase"""
+    if isinstance(db_path, SharedDatabase):
+        return instrument(db_path.connect())
+    return instrument(sqlite3.connect(db_path, uri=is_uri(db_path), **kwargs))
+
+
+def connect(db_path, profile: Union[str, AccessProfile, None] = None, **kwargs) -> sqlite3.Connection:
+    """Open a connection to db_path configured for the given access profile"""
+    profile = get_access_profile(profile)
+    if isinstance(db_path, SharedDatabase):
+        # The caller owns the connection's configuration
+        return instrument(db_path.connect())
+    if profile.read_only and not is_memory_database(db_path):
+        conn = instrument(sqlite3.connect(_database_uri(db_path, profile), uri=True, **kwargs))
+    else:
+        # In-memory databases cannot be opened with mode=ro; query_only still applies
+        conn = connect_writable(db_path, **kwargs)
+
+    if profile.read_only:
+        conn.execute("PRAGMA query_only = ON")
+    if profile.mmap_size is not None:
+        conn.execute(f"PRAGMA mmap_size = {int(profile.mmap_size)}")
+    if profile.cache_size is not None:
+        conn.execute(f"PRAGMA cache_size = {int(profile.cache_size)}")
+    if profile.temp_store is not None:
+        conn.execute(f"PRAGMA temp_store = {profile.temp_store}")
+    return conn
+
+
+def create_sqlite_engine(db_path, profile: Union[str, AccessProfile, None] = None):
+    """Create a SQLAlchemy engine whose connections use the access profile
+
+    Connections checked out while a tracing.Tracer is active are traced;
+    a caller-supplied engine is returned untouched.
+    """
+    profile = get_access_profile(profile)
+    if isinstance(db_path, SharedDatabase):
+        if db_path.engine is not None:
+            return db_path.engine
+        # One pooled connection that is never closed or rolled back by the pool
+        return watch_engine(create_engine("sqlite://", creator=lambda: SharedConnection(db_path.connection),
+                                          poolclass=StaticPool, pool_reset_on_return=None))
+    if is_uri(db_path):
+        # "sqlite://" would default to SingletonThreadPool, which closes connections
+        # other threads still hold once more than pool_size threads use it
+        engine = create_engine("sqlite://", creator=lambda: connect(db_path, profile, check_same_thread=False),
+                               poolclass=QueuePool)
+    elif profile.name == 'default':
+        engine = create_engine(f"sqlite:///{db_path}")
+    else:
+        engine = create_engine(f"sqlite:///{db_path}",
+                               creator=lambda: connect(db_path, profile, check_same_thread=False))
+    return watch_engine(engine)
+
+
+def apply_journal_mode(db_path, profile: Union[str, AccessProfile, None] = None):
+    """Switch the database file to the profile's journal mode (e.g. WAL)"""
+    profile = get_access_profile(profile)
+    if profile.journal_mode is None or isinstance(db_path, SharedDatabase) or is_memory_database(db_path):
+        return
+    with connect_writable(db_path) as conn:
+        conn.execute(f"PRAGMA journal_mode = {profile.journal_mode}")
@@ -0,0 +1,148 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Union
+
+try:
+    from .model_routing import GeminiBackend
+    from .sqlite_access import AccessProfile
+    from .text_to_sql import TextToSQL
+except ImportError:
+    from model_routing import GeminiBackend
+    from sqlite_access import AccessProfile
+    from text_to_sql import TextToSQL
+
+
+class TenantRegistry:
+    """Serve many SQLite databases from one process.
+
+    All tenants share one model client and one prompt template. Each
+    tenant's TextToSQL (engine plus cached schema snapshot) is opened on
+    first use and the least recently used tenants are evicted once more
+    than max_tenants are open. Per-tenant statistics survive eviction.
+
+    Tenants are opened with the 'query_only' access profile, so customer
+    databases are only read: no metadata tables or triggers are added to
+    them. Pass a writable profile (e.g. 'default') to seed_sample_data.
+    """
+
+    def __init__(self, db_path_for: Union[str, Callable[[str], str]], model=None, max_tenants: int = 256,
+                 seed_sample_data: bool = False,
+                 access_profile: Union[str, AccessProfile, None] = 'query_only'):
+        # db_path_for is either a format string such as "tenants/{tenant}.db" or a callable
+        if isinstance(db_path_for, str):
+            template = db_path_for
+            db_path_for = lambda tenant_id: template.format(tenant=tenant_id)
+        self.db_path_for = db_path_for
+        self.max_tenants = max_tenants
+        self.seed_sample_data = seed_sample_data
+        self.access_profile = access_profile
+
+        # One model client for every tenant; each tenant's schema prefix is cached separately
+        if model is None:
+            model = GeminiBackend('gemini-1.5-flash')
+        self.model = model
+        self.prompt_template = None
+
+        self._tenants = OrderedDict()  # tenant_id -> TextToSQL, least recently used first
+        self._stats = {}
+        self._lock = threading.RLock()
+
+    def _new_stats(self) -> Dict[str, Any]:
+        return {
+            "opens": 0,
+            "evictions": 0,
+            "queries": 0,
+            "errors": 0,
+            "total_query_seconds": 0.0,
+            "last_used": None,
+            "resident": False,
+        }
+
+    def _open(self, tenant_id: str) -> TextToSQL:
+        engine = TextToSQL(self.db_path_for(tenant_id), model=self.model,
+                           seed_sample_data=self.seed_sample_data, access_profile=self.access_profile)
+        # Share a single prompt pipeline across tenants
+        if self.prompt_template is None:
+            self.prompt_template = engine.prompt_template
+        engine.prompt_template = self.prompt_template
+        return engine
+
+    def get(self, tenant_id: str) -> TextToSQL:
+        """Return the tenant's TextToSQL, opening it if necessary"""
+        with self._lock:
+            stats = self._stats.setdefault(tenant_id, self._new_stats())
+            engine = self._tenants.get(tenant_id)
+            if engine is None:
+                engine = self._open(tenant_id)
+                self._tenants[tenant_id] = engine
+                stats["opens"] += 1
+                stats["resident"] = True
+            else:
+                self._tenants.move_to_end(tenant_id)
+            stats["last_used"] = time.time()
+            self._enforce_limits()
+            return engine
+
+    def query(self, tenant_id: str, question: str) -> Dict[str, Any]:
+        """Run TextToSQL.query() for a tenant and record its statistics"""
+        engine = self.get(tenant_id)
+        start = time.perf_counter()
+        result = engine.query(question, columnar=True)
+        elapsed = time.perf_counter() - start
+        failed = result["error"] is not None or result["results"].error is not None
+        result["results"] = result["results"].to_records()
+
+        with self._lock:
+            stats = self._stats[tenant_id]
+            stats["queries"] += 1
+            stats["total_query_seconds"] += elapsed
+            if failed:
+                stats["errors"] += 1
+        return result
+
+    def _enforce_limits(self):
+        """Evict least recently used tenants until at most max_tenants remain"""
+        while len(self._tenants) > max(self.max_tenants, 1):
+            self.evict(next(iter(self._tenants)))
+
+    def evict(self, tenant_id: str) -> bool:
+        """Close a tenant's engine and drop its schema snapshot"""
+        with self._lock:
+            engine = self._tenants.pop(tenant_id, None)
+            if engine is None:
+                return False
+            engine.close()
+            stats = self._stats[tenant_id]
+            stats["evictions"] += 1
+            stats["resident"] = False
+            return True
+
+    def evict_idle(self, max_idle_seconds: float) -> int:
+        """Evict tenants unused for longer than max_idle_seconds"""
+        cutoff = time.time() - max_idle_seconds
+        with self._lock:
+            idle = [tenant_id for tenant_id in self._tenants
+                    if self._stats[tenant_id]["last_used"] < cutoff]
+            for tenant_id in idle:
+                self.evict(tenant_id)
+            return len(idle)
+
+    def stats(self, tenant_id: Optional[str] = None) -> Dict[str, Any]:
+        """Per-tenant statistics, for one tenant or all tenants seen so far"""
+        with self._lock:
+            if tenant_id is not None:
+                return dict(self._stats.get(tenant_id) or self._new_stats())
+            return {tenant: dict(stats) for tenant, stats in self._stats.items()}
+
+    def close(self):
+        """Evict every resident tenant"""
+        with self._lock:
+            for tenant_id in list(self._tenants):
+                self.evict(tenant_id)
+
+    def __len__(self) -> int:
+        return len(self._tenants)
+
+    def __contains__(self, tenant_id: str) -> bool:
+        return tenant_id in self._tenants
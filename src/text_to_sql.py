@@ -1,20 +1,84 @@
-import os
 import sqlite3
-from typing import Optional, List, Dict, Any
-from sqlalchemy import create_engine, inspect
-import google.generativeai as genai
+import re
+import time
+from typing import Optional, List, Dict, Any, Tuple, Union, Callable
+from sqlalchemy import inspect
 from langchain.prompts import PromptTemplate
 from dotenv import load_dotenv
 
+try:
+    from .result_set import ColumnarResult
+    from .result_export import export_query
+    from .query_stats import QueryStatsTable
+    from .aggregate_cache import AggregateCache
+    from .metadata_store import ColumnMetadata, MetadataStore
+    from .catalog_artifact import CatalogArtifact, load_catalog
+    from .preview import PreviewResult
+    from .model_routing import GeminiBackend
+    from .prompt_builder import PromptBuilder, PromptPrefix, TokenUsage, content_hash, send_prompt
+    from .tracing import explain, stage
+    from .sqlite_access import catalog_version, is_internal_table, connect, create_sqlite_engine, \
+        apply_journal_mode, get_access_profile, AccessProfile, as_database, connect_writable, keep_alive
+except ImportError:
+    from result_set import ColumnarResult
+    from result_export import export_query
+    from query_stats import QueryStatsTable
+    from aggregate_cache import AggregateCache
+    from metadata_store import ColumnMetadata, MetadataStore
+    from catalog_artifact import CatalogArtifact, load_catalog
+    from preview import PreviewResult
+    from model_routing import GeminiBackend
+    from prompt_builder import PromptBuilder, PromptPrefix, TokenUsage, content_hash, send_prompt
+    from tracing import explain, stage
+    from sqlite_access import catalog_version, is_internal_table, connect, create_sqlite_engine, \
+        apply_journal_mode, get_access_profile, AccessProfile, as_database, connect_writable, keep_alive
+
 load_dotenv()
 
 class TextToSQL:
-    def __init__(self, db_path: str = "example.db"):
-        self.db_path = db_path
-
-        # Configure Gemini
-        genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-        self.model = genai.GenerativeModel('gemini-1.5-flash')
+    def __init__(self, db_path: str = "example.db", model=None, seed_sample_data: bool = True,
+                 access_profile: Union[str, AccessProfile, None] = None,
+                 stats_db_path: Optional[str] = None, connection: Optional[sqlite3.Connection] = None,
+                 engine=None, router=None):
+        # A path, a URI, ":memory:" (a private shared-cache database) or an
+        # injected connection/engine; pass self.db_path on to SQLValidator or
+        # DatabaseUtils to have them work on the same data
+        self.db_path = as_database(db_path, connection=connection, engine=engine)
+        self._keeper = keep_alive(self.db_path)
+        self.seed_sample_data = seed_sample_data
+        # Connection settings for reads: 'default', 'read_only', 'query_only' or 'immutable'
+        self.access_profile = get_access_profile(access_profile)
+
+        # Column metadata, loaded per table on first use
+        self.metadata = MetadataStore(self.db_path, self.access_profile)
+
+        # Precompiled catalog artifact, see use_catalog_artifact()
+        self.catalog = None
+        self._catalog_options = {}
+
+        # Per-fingerprint execution statistics, kept in memory unless
+        # stats_db_path is given: a separate file, or self.db_path to opt in
+        # to a query_stats table in the queried database itself
+        self.query_stats = QueryStatsTable(stats_db_path)
+
+        # Summary tables for repeated aggregate queries, see enable_aggregate_cache()
+        self.aggregate_cache = None
+        self._schema_cache = None
+
+        # Optional ModelRouter choosing a backend per question (see model_routing.py)
+        self.router = router
+        if model is None and router is not None:
+            model = router.fast
+
+        # Gemini (configured on first use, with context caching of the schema
+        # prefix) unless a shared model client was passed in
+        if model is None:
+            model = GeminiBackend('gemini-1.5-flash')
+        self.model = model
+
+        # Prompt tokens served from the provider's context cache versus sent
+        self.token_usage = TokenUsage()
+        self._prompt_builder = None
 
         # Initialize database
         self._init_database()
@@ -24,7 +88,7 @@ class TextToSQL:
 
     def _create_metadata_table(self):
         """Create column metadata table if it doesn't exist"""
-        with sqlite3.connect(self.db_path) as conn:
+        with connect_writable(self.db_path) as conn:
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS column_metadata (
                     table_name TEXT NOT NULL,
@@ -39,6 +103,26 @@ class TextToSQL:
                 )
             """)
 
+            # Generation counter bumped on every metadata change, used to
+            # invalidate cached schema snapshots
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS metadata_generation (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    generation INTEGER NOT NULL
+                );
+
+                INSERT OR IGNORE INTO metadata_generation (id, generation) VALUES (0, 0);
+
+                CREATE TRIGGER IF NOT EXISTS column_metadata_insert AFTER INSERT ON column_metadata
+                BEGIN UPDATE metadata_generation SET generation = generation + 1 WHERE id = 0; END;
+
+                CREATE TRIGGER IF NOT EXISTS column_metadata_update AFTER UPDATE ON column_metadata
+                BEGIN UPDATE metadata_generation SET generation = generation + 1 WHERE id = 0; END;
+
+                CREATE TRIGGER IF NOT EXISTS column_metadata_delete AFTER DELETE ON column_metadata
+                BEGIN UPDATE metadata_generation SET generation = generation + 1 WHERE id = 0; END;
+            """)
+
     def _insert_sample_metadata(self):
         """Insert sample metadata for demonstration"""
         metadata_data = [
@@ -53,7 +137,7 @@ class TextToSQL:
             ('employees', 'hire_date', '入职日期', '员工入职时间', 'DATE', '2020-01-15', 0, '格式：YYYY-MM-DD')
         ]
 
-        with sqlite3.connect(self.db_path) as conn:
+        with connect_writable(self.db_path) as conn:
             conn.executemany("""
                 INSERT OR IGNORE INTO column_metadata
                 (table_name, column_name, business_name, description, data_type, example_value, is_sensitive, business_rules)
@@ -62,20 +146,28 @@ class TextToSQL:
 
     def _init_database(self):
         """Initialize SQLite database with sample data"""
-        self.engine = create_engine(f"sqlite:///{self.db_path}")
+        self.engine = create_sqlite_engine(self.db_path, self.access_profile)
+
+        # Frozen snapshots and query_only databases are never written to
+        if not self.access_profile.initialize:
+            return
+
+        # Switch to WAL etc. so metadata writes don't block readers
+        apply_journal_mode(self.db_path, self.access_profile)
 
         # Create metadata table
         self._create_metadata_table()
 
-        # Create tables if they don't exist
-        self._create_sample_tables()
+        if self.seed_sample_data:
+            # Create tables if they don't exist
+            self._create_sample_tables()
 
-        # Insert sample metadata
-        self._insert_sample_metadata()
+            # Insert sample metadata
+            self._insert_sample_metadata()
 
     def _create_sample_tables(self):
         """Create sample employee and department tables"""
-        with sqlite3.connect(self.db_path) as conn:
+        with connect_writable(self.db_path) as conn:
             conn.executescript("""
                 CREATE TABLE IF NOT EXISTS departments (
                     id INTEGER PRIMARY KEY,
@@ -119,45 +211,46 @@ User question: {question}
 SQL query:"""
 
     def get_column_metadata(self) -> Dict[str, Dict[str, Dict[str, str]]]:
-        """Get column metadata from the metadata table"""
-        metadata = {}
-
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.execute("""
-                SELECT table_name, column_name, business_name, description,
-                       data_type, example_value, is_sensitive, business_rules
-                FROM column_metadata
-            """)
-
-            for row in cursor.fetchall():
-                table_name, column_name, business_name, description, data_type, example_value, is_sensitive, business_rules = row
-
-                if table_name not in metadata:
-                    metadata[table_name] = {}
-
-                metadata[table_name][column_name] = {
-                    'business_name': business_name,
-                    'description': description,
-                    'data_type': data_type,
-                    'example_value': example_value,
-                    'is_sensitive': bool(is_sensitive),
-                    'business_rules': business_rules
-                }
-
-        return metadata
-
-    def get_enhanced_schema(self) -> str:
-        """Get enhanced database schema with metadata"""
+        """Get column metadata from the metadata table
+
+        Builds dicts for the whole catalog; prefer get_table_metadata().
+        """
+        return {table_name: {column_name: meta.to_dict() for column_name, meta in columns.items()}
+                for table_name, columns in self.metadata.all().items()}
+
+    def get_table_metadata(self, table_name: str) -> Dict[str, ColumnMetadata]:
+        """Get metadata records of one table's columns, keyed by column name"""
+        if self.catalog is not None:
+            return self._current_catalog().table_metadata(table_name)
+        return self.metadata.table(table_name)
+
+    def get_table_names(self) -> List[str]:
+        """Names of the user's tables, without the library's internal ones, sorted"""
+        return sorted(table_name for table_name in inspect(self.engine).get_table_names()
+                      if not is_internal_table(table_name))
+
+    def get_enhanced_schema(self, tables: Optional[List[str]] = None, include_metadata: bool = True) -> str:
+        """Get enhanced database schema with metadata, optionally for some tables only
+
+        include_metadata=False renders the bare schema, as a baseline for comparisons.
+        The text is canonical: tables sorted by name, columns in declaration
+        order, foreign keys sorted, so equal catalogs give byte-identical
+        schemas (and prompt prefixes).
+        """
         inspector = inspect(self.engine)
-        metadata = self.get_column_metadata()
+        table_names = sorted(table_name for table_name in inspector.get_table_names()
+                             if not is_internal_table(table_name))  # Skip the metadata tables themselves
+        if tables is not None:
+            table_names = [table_name for table_name in table_names if table_name in tables]
+        metadata = self.metadata.tables(table_names) if include_metadata else {}
         schema = []
 
-        for table_name in inspector.get_table_names():
-            if table_name == 'column_metadata':
-                continue  # Skip the metadata table itself
-
+        for table_name in table_names:
             columns = inspector.get_columns(table_name)
-            foreign_keys = inspector.get_foreign_keys(table_name)
+            foreign_keys = sorted(inspector.get_foreign_keys(table_name),
+                                  key=lambda fk: (fk['referred_table'], fk['constrained_columns'],
+                                                  fk['referred_columns']))
+            table_metadata = metadata.get(table_name, {})
 
             table_info = f"Table: {table_name}\n"
             table_info += "Columns:\n"
@@ -170,14 +263,14 @@ SQL query:"""
 
                 # Add metadata if available
                 metadata_info = ""
-                if table_name in metadata and col_name in metadata[table_name]:
-                    meta = metadata[table_name][col_name]
-                    metadata_info = f" (业务名称: {meta['business_name']}, 描述: {meta['description']}"
-                    if meta['example_value']:
-                        metadata_info += f", 示例: {meta['example_value']}"
-                    if meta['business_rules']:
-                        metadata_info += f", 规则: {meta['business_rules']}"
-                    if meta['is_sensitive']:
+                meta = table_metadata.get(col_name)
+                if meta is not None:
+                    metadata_info = f" (业务名称: {meta.business_name}, 描述: {meta.description}"
+                    if meta.example_value:
+                        metadata_info += f", 示例: {meta.example_value}"
+                    if meta.business_rules:
+                        metadata_info += f", 规则: {meta.business_rules}"
+                    if meta.is_sensitive:
                         metadata_info += ", 敏感字段"
                     metadata_info += ")"
 
@@ -192,15 +285,63 @@ SQL query:"""
 
         return "\n".join(schema)
 
+    def get_catalog_version(self) -> tuple:
+        """Get (schema_version, metadata_generation) of the database"""
+        with connect(self.db_path, self.access_profile) as conn:
+            return catalog_version(conn)
+
     def get_database_schema(self) -> str:
-        """Legacy method - returns basic schema"""
-        return self.get_enhanced_schema()
+        """Legacy method - returns the enhanced schema, cached until the catalog changes"""
+        with stage('schema'):
+            version = self.get_catalog_version()
+            if self._schema_cache is None or self._schema_cache[0] != version:
+                if self.catalog is not None:
+                    schema = self._current_catalog(version).schema()
+                else:
+                    with stage('reflect'):
+                        schema = self.get_enhanced_schema()
+                self._schema_cache = (version, schema, content_hash(schema))
+            return self._schema_cache[1]
+
+    def get_schema_hash(self) -> str:
+        """SHA-256 of the canonical schema text; changes exactly when the prompt prefix does"""
+        self.get_database_schema()
+        return self._schema_cache[2]
+
+    def use_catalog_artifact(self, path: Optional[str] = None, **compile_options) -> CatalogArtifact:
+        """Serve schema text and metadata from a precompiled catalog artifact
+
+        The artifact (by default <db_path>.catalog) is memory-mapped
+        read-only, so processes using the same file share its pages. It is
+        compiled if missing and recompiled whenever schema_version or the
+        metadata generation moves past the version it was built from.
+        """
+        self._catalog_options = compile_options
+        previous, self.catalog = self.catalog, load_catalog(self, path, **compile_options)
+        if previous is not None:
+            previous.close()
+        return self.catalog
+
+    def _current_catalog(self, version: Optional[tuple] = None) -> CatalogArtifact:
+        """The catalog artifact, reloaded or rebuilt first if it is stale"""
+        version = version or self.get_catalog_version()
+        if self.catalog.version != version:
+            # Another process may already have rebuilt it; load_catalog checks first
+            previous = self.catalog
+            self.catalog = load_catalog(self, previous.path, current=version, **self._catalog_options)
+            previous.close()  # unmaps the replaced file
+        return self.catalog
+
+    def invalidate_schema_cache(self):
+        """Drop the cached schema snapshot"""
+        self._schema_cache = None
+        self.metadata.invalidate()
 
     def add_column_metadata(self, table_name: str, column_name: str, business_name: str,
                           description: str, data_type: str = None, example_value: str = None,
                           is_sensitive: bool = False, business_rules: str = None):
         """Add or update column metadata"""
-        with sqlite3.connect(self.db_path) as conn:
+        with connect_writable(self.db_path) as conn:
             conn.execute("""
                 INSERT OR REPLACE INTO column_metadata
                 (table_name, column_name, business_name, description, data_type, example_value, is_sensitive, business_rules)
@@ -209,51 +350,147 @@ SQL query:"""
 
     def remove_column_metadata(self, table_name: str, column_name: str):
         """Remove column metadata"""
-        with sqlite3.connect(self.db_path) as conn:
+        with connect_writable(self.db_path) as conn:
             conn.execute("""
                 DELETE FROM column_metadata
                 WHERE table_name = ? AND column_name = ?
             """, (table_name, column_name))
 
-    def generate_sql(self, question: str) -> str:
-        """Generate SQL from natural language question"""
-        schema = self.get_database_schema()
+    @property
+    def prompt_builder(self) -> PromptBuilder:
+        # Rebuilt if prompt_template is replaced
+        if self._prompt_builder is None or self._prompt_builder.template != self.prompt_template:
+            self._prompt_builder = PromptBuilder(self.prompt_template)
+        return self._prompt_builder
+
+    def build_prompt_parts(self, question: str, schema: Optional[str] = None) -> Tuple[PromptPrefix, str]:
+        """(static prefix, question suffix) of the prompt for a question"""
+        if schema is None:
+            schema = self.get_database_schema()
+        return self.prompt_builder.build(schema, question)
+
+    def build_prompt(self, question: str, schema: Optional[str] = None) -> str:
+        """Fill the prompt template for a question"""
+        prefix, suffix = self.build_prompt_parts(question, schema)
+        return prefix.text + suffix
+
+    def generate_sql(self, question: str, prompt_parts: Optional[Tuple[PromptPrefix, str]] = None) -> str:
+        """Generate SQL from natural language question
+
+        prompt_parts replaces the default (prefix, suffix) prompt, e.g. a
+        session's follow-up prompt; routing and token accounting still apply.
+        """
+        if self.router is not None:
+            try:
+                return self.router.generate_sql(self, question, prompt_parts)
+            except Exception as e:
+                return f"Error generating SQL: {str(e)}"
+
+        if prompt_parts is None:
+            schema = self.get_database_schema()
 
         try:
-            prompt = self.prompt_template.format(
-                schema=schema,
-                question=question
-            )
+            prefix, suffix = prompt_parts or self.build_prompt_parts(question, schema)
 
-            response = self.model.generate_content(prompt)
+            response = send_prompt(self.model, prefix, suffix, self.token_usage)
             return response.text.strip()
         except Exception as e:
             return f"Error generating SQL: {str(e)}"
 
-    def execute_query(self, sql_query: str) -> List[Dict[str, Any]]:
-        """Execute SQL query and return results"""
+    def execute_query(self, sql_query: str,
+                      columnar: bool = False) -> Union[List[Dict[str, Any]], ColumnarResult]:
+        """Execute SQL query and return results
+
+        With columnar=True the rows are returned as a ColumnarResult, which
+        stores each column name once and packs numeric columns into arrays.
+        """
+        return self._execute(sql_query, columnar)[0]
+
+    def _execute(self, sql_query: str, columnar: bool) -> Tuple[Union[List[Dict[str, Any]], ColumnarResult],
+                                                                 Optional[str]]:
+        """execute_query() plus the error message, if the execution failed"""
+        start = time.perf_counter()
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.execute(sql_query)
-                results = [dict(row) for row in cursor.fetchall()]
-                return results
+            executed_sql = sql_query
+            if self.aggregate_cache is not None:
+                executed_sql = self.aggregate_cache.rewrite(sql_query)
+
+            with stage('execute'), connect(self.db_path, self.access_profile) as conn:
+                if columnar:
+                    results = ColumnarResult.from_cursor(conn.execute(executed_sql))
+                    columns = results.columns
+                else:
+                    conn.row_factory = sqlite3.Row
+                    cursor = conn.execute(executed_sql)
+                    columns = [description[0] for description in cursor.description or ()]
+                    results = [dict(row) for row in cursor.fetchall()]
         except Exception as e:
-            return [{"error": str(e)}]
-
-    def query(self, question: str) -> Dict[str, Any]:
-        """Main method: convert natural language to SQL and execute"""
+            self.query_stats.record(sql_query, time.perf_counter() - start, error=True)
+            if columnar:
+                return ColumnarResult.from_error(str(e)), str(e)
+            return [{"error": str(e)}], str(e)
+
+        # Bookkeeping never turns a successful query into an error
+        self.query_stats.record(sql_query, time.perf_counter() - start, rows=len(results))
+        if self.aggregate_cache is not None and executed_sql is sql_query:
+            try:
+                self.aggregate_cache.observe(sql_query, columns)
+            except sqlite3.Error:
+                pass  # materializing is an optimization; the next call tries again
+        return results, None
+
+    def enable_aggregate_cache(self, min_calls: int = 3, max_staleness: float = 0.0,
+                               max_tables: int = 20, max_rows: int = 10000) -> AggregateCache:
+        """Materialize aggregate queries that run at least min_calls times
+
+        Later executions read from the summary table, which triggers mark
+        dirty when base tables change. A dirty summary is recomputed on use
+        unless it was refreshed less than max_staleness seconds ago.
+        """
+        self.aggregate_cache = AggregateCache(self.db_path, min_calls=min_calls, max_staleness=max_staleness,
+                                              max_tables=max_tables, max_rows=max_rows)
+        return self.aggregate_cache
+
+    def top_queries(self, n: int = 10, sort_by: str = 'total_time') -> List[Dict[str, Any]]:
+        """Most expensive query fingerprints seen by execute_query"""
+        return self.query_stats.top(n, sort_by)
+
+    def close(self):
+        """Flush statistics and release connections; an in-memory database is discarded"""
+        try:
+            self.query_stats.flush()
+        except sqlite3.Error:
+            pass  # best effort: a locked or unwritable statistics database loses nothing else
+        if self.engine is not getattr(self.db_path, 'engine', None):
+            self.engine.dispose()
+        if self._keeper is not None:
+            self._keeper.close()
+            self._keeper = None
+        if self.catalog is not None:
+            self.catalog.close()
+            self.catalog = None
+
+    def query(self, question: str, columnar: bool = False) -> Dict[str, Any]:
+        """Main method: convert natural language to SQL and execute
+
+        With columnar=True "results" is the ColumnarResult, whose error
+        attribute tells a failed execution from a result column named error;
+        otherwise it is a list of row dicts, built directly from the cursor.
+        """
         sql_query = self.generate_sql(question)
 
         if sql_query.startswith("Error"):
             return {
                 "question": question,
                 "sql_query": None,
-                "results": [],
+                "results": ColumnarResult([], []) if columnar else [],
                 "error": sql_query
             }
 
-        results = self.execute_query(sql_query)
+        results, error = self._execute(sql_query, columnar)
+        if self.router is not None:
+            # Execution success is the accuracy signal available online
+            self.router.record_outcome(error is None)
 
         return {
             "question": question,
@@ -262,6 +499,62 @@ SQL query:"""
             "error": None
         }
 
+    def preview(self, question_or_sql: str, rows: int = 20, count: bool = True) -> PreviewResult:
+        """Return the first rows of a question's (or SELECT's) result as soon as they are read
+
+        The result carries an approximate total and, with count=True, an
+        exact COUNT(*) running in the background; the remaining rows are
+        only read by PreviewResult.fetch_all().
+        """
+        question = None
+        if self._is_sql(question_or_sql):
+            sql_query = question_or_sql
+        else:
+            question, sql_query = question_or_sql, self.generate_sql(question_or_sql)
+            if sql_query.startswith("Error"):
+                return PreviewResult(self, None, question=question, error=sql_query)
+        with stage('preview'):
+            return PreviewResult(self, sql_query, limit=rows, count=count, question=question)
+
+    def _is_sql(self, text: str) -> bool:
+        """Check whether text is a read-only SQL statement rather than a question"""
+        if not re.match(r'\s*(SELECT|WITH)\b', text, re.IGNORECASE):
+            return False
+        try:
+            with stage('detect_sql'), connect(self.db_path, self.access_profile) as conn:
+                explain(conn, text)
+            return True
+        except sqlite3.Error:
+            return False
+
+    def export(self, question_or_sql: str, path: str, format: str = 'csv',
+               compress: bool = False, chunk_size: int = 10000,
+               progress: Optional[Callable[[int, int], None]] = None,
+               resume: bool = False) -> Dict[str, Any]:
+        """Stream query results to a CSV, NDJSON or binary columnar file
+
+        Accepts either a natural language question or a SELECT statement.
+        Rows go from the cursor to disk chunk_size rows at a time, so memory
+        use does not grow with the size of the result.
+        """
+        if self._is_sql(question_or_sql):
+            sql_query = question_or_sql
+        else:
+            sql_query = self.generate_sql(question_or_sql)
+            if sql_query.startswith("Error"):
+                return {"path": path, "sql_query": None, "rows": 0, "chunks": 0, "error": sql_query}
+
+        try:
+            with stage('export'):
+                result = export_query(self.db_path, sql_query, path, format=format, compress=compress,
+                                      chunk_size=chunk_size, progress=progress, resume=resume,
+                                      access_profile=self.access_profile)
+        except (sqlite3.Error, OSError) as e:
+            return {"path": path, "sql_query": sql_query, "rows": 0, "chunks": 0, "error": str(e)}
+
+        result.update({"sql_query": sql_query, "error": None})
+        return result
+
 if __name__ == "__main__":
     # Example usage
     text_to_sql = TextToSQL()
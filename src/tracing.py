@@ -0,0 +1,354 @@
+"""
+Opt-in tracing of every SQL statement the library issues
+
+Connections opened through sqlite_access (connect, connect_writable and
+the pooled connections of create_sqlite_engine) get a trace callback and a
+progress handler while a Tracer is active, so reflection PRAGMAs, metadata
+reads, validation EXPLAINs and sample-row SELECTs show up next to the
+user's own query. EXPLAIN, which SQLite does not trace, is recorded by
+explain(). Each statement is attributed to the stage() path of the thread
+that ran it.
+
+    with Tracer(profile=True) as tracer:
+        text_to_sql.query("How many employees are there?")
+    tracer.report()                        # per-stage and per-statement totals
+    tracer.export_folded("query.folded")   # flamegraph.pl / speedscope input
+
+Without an active Tracer instrumenting a connection and entering a stage
+cost a single check.
+"""
+import cProfile
+import os
+import pstats
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import event
+
+UNATTRIBUTED = "unattributed"
+
+_active = ()  # replaced, never mutated, so callbacks can read it without a lock
+_active_lock = threading.Lock()
+_local = threading.local()
+
+
+def _stages() -> List[str]:
+    stack = getattr(_local, 'stages', None)
+    if stack is None:
+        stack = _local.stages = []
+    return stack
+
+
+def current_stage() -> str:
+    """The calling thread's stage path, e.g. "query/generate/schema" """
+    stack = getattr(_local, 'stages', None)
+    return "/".join(stack) if stack else UNATTRIBUTED
+
+
+@contextmanager
+def stage(name: str):
+    """Attribute the statements run inside the block to a pipeline stage; stages nest
+
+    Active tracers also record the stage's wall time, which includes the
+    Python work around its statements (e.g. SQLAlchemy reflection).
+    """
+    if not _active:
+        yield
+        return
+    stack = _stages()
+    stack.append(name)
+    path = "/".join(stack)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+        for tracer in _active:
+            tracer._add_stage(path, elapsed)
+
+
+class StatementTrace:
+    """One statement: where it ran, how long it ran and how many VM steps it took
+
+    SQLite reports no end of statement, so duration runs from the trace
+    callback to the last progress tick (a lower bound, with a resolution
+    of progress_steps VM instructions) and vm_steps counts whole ticks.
+    Fetching rows keeps a statement running: both include the fetch.
+    """
+
+    __slots__ = ('stage', 'sql', 'thread', 'start', 'end', 'vm_steps')
+
+    def __init__(self, stage: str, sql: str, start: float):
+        self.stage = stage
+        self.sql = sql
+        self.thread = threading.current_thread().name
+        self.start = self.end = start
+        self.vm_steps = 0
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"stage": self.stage, "sql": self.sql, "thread": self.thread,
+                "duration_ms": self.duration * 1000, "vm_steps": self.vm_steps}
+
+
+def instrument(conn):
+    """Install the trace callback and progress handler on a connection if a Tracer is active
+
+    Returns the connection. A progress handler set on the connection later
+    (e.g. a cancellation check) replaces the step counting, not the trace.
+    """
+    tracers = _active
+    if not tracers:
+        return conn
+    steps = min(tracer.progress_steps for tracer in tracers)
+    running = [None]  # the connection's current statement
+
+    def on_statement(sql: str):
+        tracers = _active
+        if not tracers:
+            running[0] = None
+            return
+        record = running[0] = StatementTrace(current_stage(), sql, time.perf_counter())
+        for tracer in tracers:
+            tracer._add(record)
+
+    def on_progress() -> int:
+        record = running[0]
+        if record is not None:
+            record.vm_steps += steps
+            record.end = time.perf_counter()
+        return 0
+
+    conn.set_trace_callback(on_statement)
+    conn.set_progress_handler(on_progress, steps)
+    return conn
+
+
+def explain(conn, sql_query: str, query_plan: bool = False) -> list:
+    """Run EXPLAIN (or EXPLAIN QUERY PLAN) on a statement and return its rows
+
+    SQLite never passes EXPLAIN to the trace callback, so while a Tracer
+    is active the call is recorded here, timed around the fetch.
+    """
+    statement = f"EXPLAIN QUERY PLAN {sql_query}" if query_plan else f"EXPLAIN {sql_query}"
+    tracers = _active
+    if not tracers:
+        return conn.execute(statement).fetchall()
+    record = StatementTrace(current_stage(), statement, time.perf_counter())
+    try:
+        return conn.execute(statement).fetchall()
+    finally:
+        record.end = time.perf_counter()
+        for tracer in tracers:
+            tracer._add(record)
+
+
+def uninstrument(conn):
+    """Remove the hooks installed by instrument()"""
+    conn.set_trace_callback(None)
+    conn.set_progress_handler(None, 0)
+
+
+def watch_engine(engine):
+    """Instrument a SQLAlchemy engine's pooled connections on checkout while a Tracer is active"""
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        if _active:
+            instrument(dbapi_connection)
+            connection_record.info['traced'] = True
+
+    def checkin(dbapi_connection, connection_record):
+        if connection_record.info.pop('traced', False) and dbapi_connection is not None:
+            uninstrument(dbapi_connection)
+
+    event.listen(engine, "checkout", checkout)
+    event.listen(engine, "checkin", checkin)
+    return engine
+
+
+def _frame_label(function) -> str:
+    filename, line, name = function
+    if filename == '~':
+        label = name  # built-in
+    else:
+        label = f"{name} ({os.path.basename(filename)}:{line})"
+    return label.replace(';', ':')
+
+
+def folded_stacks(stats: pstats.Stats, min_microseconds: int = 1, max_depth: int = 64) -> Dict[str, int]:
+    """Convert cProfile statistics into folded stacks ("a;b;c microseconds")
+
+    cProfile keeps caller/callee edges, not full stacks: a function's own
+    time is split across the paths reaching it in proportion to the time
+    each caller spent in it. Recursive edges are not expanded again.
+    """
+    entries = stats.stats
+    children = defaultdict(dict)
+    for function, (_, _, _, _, callers) in entries.items():
+        for caller, edge in callers.items():
+            children[caller][function] = edge[3]  # cumulative time spent in function when called by caller
+
+    folded = defaultdict(int)
+
+    def walk(function, functions, labels, cumulative):
+        own, total = entries[function][2], entries[function][3]
+        share = min(1.0, cumulative / total) if total else 0.0
+        microseconds = int(own * share * 1_000_000)
+        if microseconds:
+            folded[";".join(labels)] += microseconds
+        if len(functions) >= max_depth:
+            return
+        for child, edge_time in children.get(function, {}).items():
+            child_time = edge_time * share
+            if child_time * 1_000_000 < min_microseconds or child in functions:
+                continue
+            walk(child, functions + [child], labels + [_frame_label(child)], child_time)
+
+    for function, (_, _, _, total, callers) in entries.items():
+        # Time not accounted for by callers was spent below the frame that started the profile
+        called = sum(edge[3] for caller, edge in callers.items() if caller != function)
+        if total - called > min_microseconds / 1_000_000:
+            walk(function, [function], [_frame_label(function)], total - called)
+    return dict(folded)
+
+
+class Tracer:
+    """Collects the statements run on instrumented connections while active
+
+    Statements from every thread are recorded (each notes its thread);
+    only the most recent max_statements are kept. progress_steps trades
+    resolution for overhead: a progress callback every 1000 VM steps costs
+    a few percent on a large scan, every 100 steps closer to half. With profile=True a
+    cProfile capture runs in the thread that started the tracer, for one
+    request at a time.
+    """
+
+    def __init__(self, progress_steps: int = 1000, profile: bool = False, max_statements: int = 100000):
+        self.progress_steps = progress_steps
+        self.statements = deque(maxlen=max_statements)
+        self.profiler = cProfile.Profile() if profile else None
+        self.started = self.stopped = None
+        self._stage_times = defaultdict(lambda: [0, 0.0])  # stage -> [entries, seconds]
+        self._lock = threading.Lock()
+
+    def _add(self, record: StatementTrace):
+        self.statements.append(record)
+
+    def _add_stage(self, path: str, elapsed: float):
+        with self._lock:
+            entry = self._stage_times[path]
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def start(self) -> 'Tracer':
+        global _active
+        with _active_lock:
+            if self not in _active:
+                _active = _active + (self,)
+        self.started, self.stopped = time.perf_counter(), None
+        if self.profiler is not None:
+            self.profiler.enable()
+        return self
+
+    def stop(self):
+        global _active
+        if self.profiler is not None:
+            self.profiler.disable()
+        with _active_lock:
+            _active = tuple(tracer for tracer in _active if tracer is not self)
+        self.stopped = time.perf_counter()
+
+    def __enter__(self) -> 'Tracer':
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Per stage: wall time, statement count, statement time and VM steps, slowest first
+
+        wall_ms is inclusive of nested stages; total_ms only counts the
+        stage's own statements.
+        """
+        stages = defaultdict(lambda: {"calls": 0, "wall_ms": 0.0, "statements": 0, "total_ms": 0.0,
+                                      "max_ms": 0.0, "vm_steps": 0})
+        with self._lock:
+            for path, (calls, seconds) in self._stage_times.items():
+                stages[path].update(calls=calls, wall_ms=seconds * 1000)
+        for record in list(self.statements):
+            entry = stages[record.stage]
+            duration_ms = record.duration * 1000
+            entry["statements"] += 1
+            entry["total_ms"] += duration_ms
+            entry["max_ms"] = max(entry["max_ms"], duration_ms)
+            entry["vm_steps"] += record.vm_steps
+        return dict(sorted(stages.items(), key=lambda item: (-item[1]["wall_ms"], -item[1]["total_ms"])))
+
+    def top(self, n: int = 10, sort_by: str = 'total_ms') -> List[Dict[str, Any]]:
+        """Statement fingerprints by total time (or 'calls', 'vm_steps'), with the stages issuing them"""
+        try:
+            from .query_stats import fingerprint
+        except ImportError:
+            from query_stats import fingerprint
+
+        entries = {}
+        for record in list(self.statements):
+            key = fingerprint(record.sql)
+            entry = entries.get(key)
+            if entry is None:
+                entry = entries[key] = {"fingerprint": key, "sql": record.sql, "calls": 0,
+                                        "total_ms": 0.0, "vm_steps": 0, "stages": []}
+            entry["calls"] += 1
+            entry["total_ms"] += record.duration * 1000
+            entry["vm_steps"] += record.vm_steps
+            if record.stage not in entry["stages"]:
+                entry["stages"].append(record.stage)
+        return sorted(entries.values(), key=lambda entry: -entry[sort_by])[:n]
+
+    def report(self, n: int = 10) -> Dict[str, Any]:
+        end = self.stopped or time.perf_counter()
+        return {
+            "wall_ms": (end - self.started) * 1000 if self.started is not None else 0.0,
+            "statements": len(self.statements),
+            "stages": self.summary(),
+            "top": self.top(n),
+        }
+
+    def profile_stats(self) -> Optional[pstats.Stats]:
+        if self.profiler is None:
+            return None
+        try:
+            return pstats.Stats(self.profiler)
+        except TypeError:
+            return None  # nothing was captured
+
+    def folded_stacks(self) -> Dict[str, int]:
+        """The cProfile capture as folded stacks; empty without profile=True"""
+        stats = self.profile_stats()
+        return folded_stacks(stats) if stats is not None else {}
+
+    def export_folded(self, path: str) -> int:
+        """Write folded stacks for flamegraph.pl, inferno or speedscope; returns the number of stacks"""
+        stacks = self.folded_stacks()
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, microseconds in sorted(stacks.items()):
+                f.write(f"{stack} {microseconds}\n")
+        return len(stacks)
+
+
+def print_trace(report: Dict[str, Any]):
+    print(f"Wall time: {report['wall_ms']:.1f} ms  Statements: {report['statements']}")
+    print(f"  {'stage':<40} {'wall ms':>9} {'stmts':>6} {'stmt ms':>9} {'vm steps':>10}")
+    for path, entry in report["stages"].items():
+        print(f"  {path:<40} {entry['wall_ms']:>9.2f} {entry['statements']:>6} "
+              f"{entry['total_ms']:>9.2f} {entry['vm_steps']:>10}")
+    for entry in report["top"]:
+        sql = " ".join(entry["sql"].split())
+        print(f"  {entry['calls']:>4}x {entry['total_ms']:>8.2f} ms {entry['vm_steps']:>10} steps  "
+              f"{sql[:80]}  [{', '.join(entry['stages'])}]")
@@ -1,24 +1,85 @@
 import unittest
 import os
+import sqlite3
+import csv
+import gc
+import gzip
+import json
+import shutil
+import tempfile
+import threading
+import time
+import types
 import sys
 sys.path.append('src')
 
 from text_to_sql import TextToSQL
 from sql_validator import SQLValidator
 from database_utils import DatabaseUtils
+from result_set import ColumnarResult
+from result_export import read_columnar
+from tenant_registry import TenantRegistry
+import evaluation
+from evaluation import ReplayModel, prompt_key, run_suite, execution_match, evaluate_case
+from candidate_generation import CandidateGenerator
+from query_stats import QueryStatsTable, canonicalize, fingerprint
+from sqlite_access import SharedDatabase
+from metadata_store import ColumnMetadata
+from catalog_artifact import CatalogArtifact, compile_catalog
+from cli import main as cli_main
+from sharding import ShardedTextToSQL, plan_fanout
+from model_routing import ModelBackend, ModelRouter, StubBackend
+from session import Session
+from comparison import RateLimiter, Variant, compare_variants, DEFAULT_VARIANTS
+from model_routing import GeminiBackend
+from aggregate_cache import is_cacheable
+from prompt_builder import PromptBuilder, PromptPrefix
+from tracing import Tracer, stage
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModel:
+    """Offline stand-in for the Gemini model that answers with fixed SQL"""
+    def __init__(self, sql="SELECT * FROM employees"):
+        self.sql = sql
+        self.prompts = []
+
+    def generate_content(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+        return FakeResponse(self.sql)
+
+
+class ScriptedModel:
+    """Offline model answering successive calls from a script of (sql, delay) pairs"""
+    def __init__(self, script):
+        self.script = list(script)
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def generate_content(self, prompt, **kwargs):
+        with self._lock:
+            sql, delay = self.script[len(self.calls) % len(self.script)]
+            self.calls.append(kwargs)
+        time.sleep(delay)
+        return FakeResponse(sql)
 
 class TestTextToSQL(unittest.TestCase):
     def setUp(self):
         """Set up test database"""
-        self.test_db = "test.db"
+        self.test_db = "file:test_text_to_sql?mode=memory&cache=shared"
         self.text_to_sql = TextToSQL(self.test_db)
         self.validator = SQLValidator(self.test_db)
         self.db_utils = DatabaseUtils(self.test_db)
 
     def tearDown(self):
         """Clean up test database"""
-        if os.path.exists(self.test_db):
-            os.remove(self.test_db)
+        self.db_utils.close()
+        self.validator.close()
+        self.text_to_sql.close()
 
     def test_database_initialization(self):
         """Test database is properly initialized"""
@@ -87,6 +148,15 @@ class TestTextToSQL(unittest.TestCase):
         self.assertEqual(len(result['results']), 1)
         self.assertTrue(result['results'][0]['count(*)'] >= 5)
 
+    def test_schema_snapshot_invalidation(self):
+        """Test the cached schema is rebuilt when metadata changes"""
+        schema = self.text_to_sql.get_database_schema()
+        self.assertIs(self.text_to_sql.get_database_schema(), schema)
+        self.assertNotIn("metadata_generation", schema)
+
+        self.text_to_sql.add_column_metadata("employees", "age", "年龄(岁)", "员工的周岁年龄")
+        self.assertIn("年龄(岁)", self.text_to_sql.get_database_schema())
+
     def test_read_only_enforcement(self):
         """Test that only read-only queries are allowed"""
         read_only_query = "SELECT * FROM employees"
@@ -95,5 +165,1477 @@ class TestTextToSQL(unittest.TestCase):
         write_query = "INSERT INTO employees (name) VALUES ('Test')"
         self.assertFalse(self.validator.is_read_only_query(write_query))
 
+class TestColumnarResult(unittest.TestCase):
+    def setUp(self):
+        """Set up test database"""
+        self.test_db = "test_columnar.db"
+        self.text_to_sql = TextToSQL(self.test_db)
+
+    def tearDown(self):
+        """Clean up test database"""
+        if os.path.exists(self.test_db):
+            os.remove(self.test_db)
+
+    def test_matches_list_of_dicts(self):
+        """Test columnar results convert back to the classic records"""
+        sql = "SELECT * FROM employees ORDER BY id"
+        records = self.text_to_sql.execute_query(sql)
+        result = self.text_to_sql.execute_query(sql, columnar=True)
+
+        self.assertEqual(len(result), len(records))
+        self.assertEqual(result.to_records(), records)
+        self.assertEqual(result[0]['name'], 'John Doe')
+        self.assertEqual(dict(result[-1]), records[-1])
+
+    def test_numeric_columns_are_packed(self):
+        """Test homogeneous numeric columns are stored as arrays"""
+        result = self.text_to_sql.execute_query("SELECT id, salary, name FROM employees ORDER BY id", columnar=True)
+
+        self.assertIsInstance(result.column('id'), memoryview)
+        self.assertIsInstance(result.column('salary'), memoryview)
+        self.assertIsInstance(result.column('name'), list)
+
+    def test_slicing_shares_columns(self):
+        """Test slices are views over the same column buffers"""
+        result = self.text_to_sql.execute_query("SELECT id FROM employees ORDER BY id", columnar=True)
+        window = result[1:4]
+
+        self.assertEqual(len(window), 3)
+        self.assertIs(window._columns[0], result._columns[0])
+        self.assertEqual([row['id'] for row in window], [2, 3, 4])
+        self.assertEqual(list(window.column('id')), [2, 3, 4])
+
+    def test_reversed_slices(self):
+        """Test negative-step views select the same rows as list slicing"""
+        result = ColumnarResult.from_rows(['id', 'name'], [(i, str(i)) for i in range(5)])
+        ids = list(range(5))
+        for key in (slice(None, None, -1), slice(3, None, -2), slice(-2, 0, -1), slice(None, None, -10),
+                    slice(0, 5, -1), slice(4, -6, -1)):
+            self.assertEqual(list(result[key].column('id')), ids[key])
+            self.assertEqual(result[key].column('name'), [str(i) for i in ids[key]])
+        self.assertEqual(list(result[::-1][::-1].column('id')), ids)
+        self.assertEqual(list(result[0:0][::-1].column('id')), [])
+
+    def test_duplicate_column_names(self):
+        """Test a repeated column name refers to its first column, like dict(sqlite3.Row)"""
+        sql = "SELECT e.name, d.name FROM employees e JOIN departments d ON d.id = e.department_id ORDER BY e.id"
+        result = self.text_to_sql.execute_query(sql, columnar=True)
+
+        self.assertEqual(result.to_records(), self.text_to_sql.execute_query(sql))
+        self.assertEqual(result.to_records()[0], {'name': 'John Doe'})
+        self.assertEqual(dict(result[0]), {'name': 'John Doe'})
+        self.assertEqual(result.to_tuples()[0][1], result[0][1])
+
+    def test_mixed_column_falls_back_to_list(self):
+        """Test NULLs and mixed types keep their original values"""
+        result = ColumnarResult.from_rows(['value'], [(1,), (None,), (2.5,)])
+        self.assertEqual(result.column('value'), [1, None, 2.5])
+
+    def test_error_result(self):
+        """Test errors keep the [{"error": ...}] shape"""
+        result = self.text_to_sql.execute_query("SELECT * FROM nonexistent_table", columnar=True)
+        self.assertIsNotNone(result.error)
+        self.assertEqual(list(result.to_records()[0]), ['error'])
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        """Set up test database and output directory"""
+        self.test_db = "test_export.db"
+        self.text_to_sql = TextToSQL(self.test_db)
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Clean up test database and exports"""
+        shutil.rmtree(self.output_dir)
+        if os.path.exists(self.test_db):
+            os.remove(self.test_db)
+
+    def test_csv_export(self):
+        """Test CSV export from SQL writes a header and every row"""
+        path = os.path.join(self.output_dir, "employees.csv")
+        result = self.text_to_sql.export("SELECT id, name FROM employees ORDER BY id", path, chunk_size=2)
+
+        self.assertIsNone(result['error'])
+        self.assertEqual(result['rows'], 5)
+        self.assertEqual(result['chunks'], 3)
+        with open(path, newline='', encoding='utf-8') as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0], ['id', 'name'])
+        self.assertEqual(rows[1], ['1', 'John Doe'])
+        self.assertEqual(len(rows), 6)
+        self.assertFalse(os.path.exists(path + ".progress"))
+
+    def test_gzip_ndjson_export(self):
+        """Test gzip-compressed NDJSON export with progress callbacks"""
+        path = os.path.join(self.output_dir, "employees.ndjson.gz")
+        calls = []
+        self.text_to_sql.export("SELECT * FROM employees ORDER BY id", path, format='ndjson',
+                                compress=True, chunk_size=2, progress=lambda rows, chunks: calls.append(rows))
+
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(records, self.text_to_sql.execute_query("SELECT * FROM employees ORDER BY id"))
+        self.assertEqual(calls, [2, 4, 5])
+
+    def test_columnar_round_trip(self):
+        """Test binary columnar export reads back chunk by chunk"""
+        path = os.path.join(self.output_dir, "employees.t2sc")
+        sql = "SELECT * FROM employees ORDER BY id"
+        self.text_to_sql.export(sql, path, format='columnar', chunk_size=3)
+
+        records = []
+        for chunk in read_columnar(path):
+            records.extend(chunk.to_records())
+        self.assertEqual(records, self.text_to_sql.execute_query(sql))
+
+    def test_resume_after_interruption(self):
+        """Test an interrupted export continues from the last completed chunk"""
+        path = os.path.join(self.output_dir, "employees.csv.gz")
+        sql = "SELECT * FROM employees ORDER BY id"
+
+        def interrupt(rows, chunks):
+            if chunks == 2:
+                raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            self.text_to_sql.export(sql, path, compress=True, chunk_size=2, progress=interrupt)
+        self.assertTrue(os.path.exists(path + ".progress"))
+
+        result = self.text_to_sql.export(sql, path, compress=True, chunk_size=2, resume=True)
+        self.assertEqual(result['rows'], 5)
+
+        with gzip.open(path, 'rt', encoding='utf-8', newline='') as f:
+            rows = list(csv.reader(f))
+        self.assertEqual([row[0] for row in rows], ['id', '1', '2', '3', '4', '5'])
+
+class TestTenantRegistry(unittest.TestCase):
+    def setUp(self):
+        """Set up a directory of tenant databases"""
+        self.tenant_dir = tempfile.mkdtemp()
+        for tenant in ("acme", "globex", "a", "b", "c"):
+            with sqlite3.connect(os.path.join(self.tenant_dir, f"{tenant}.db")) as conn:
+                conn.execute("CREATE TABLE orders (id INTEGER PRIMARY KEY, amount REAL)")
+        self.model = FakeModel("SELECT COUNT(*) AS total FROM orders")
+        self.registry = TenantRegistry(os.path.join(self.tenant_dir, "{tenant}.db"), model=self.model,
+                                       max_tenants=2)
+
+    def tearDown(self):
+        """Clean up tenant databases"""
+        self.registry.close()
+        shutil.rmtree(self.tenant_dir)
+
+    def test_tenants_share_model_and_prompt(self):
+        """Test every tenant uses the registry's model client and prompt"""
+        first = self.registry.get("acme")
+        second = self.registry.get("globex")
+
+        self.assertIs(first.model, self.model)
+        self.assertIs(second.model, self.model)
+        self.assertIs(first.prompt_template, second.prompt_template)
+        self.assertEqual(len(first.execute_query("SELECT name FROM sqlite_master WHERE name = 'employees'")), 0)
+
+    def test_lru_eviction(self):
+        """Test the least recently used tenant is evicted past max_tenants"""
+        self.registry.get("a")
+        self.registry.get("b")
+        self.registry.get("a")
+        self.registry.get("c")
+
+        self.assertIn("a", self.registry)
+        self.assertNotIn("b", self.registry)
+        self.assertEqual(self.registry.stats("b")["evictions"], 1)
+
+        self.registry.get("b")
+        self.assertEqual(self.registry.stats("b")["opens"], 2)
+
+    def test_tenant_databases_are_not_written(self):
+        """Test opening and querying a tenant adds no bookkeeping to its database"""
+        path = os.path.join(self.tenant_dir, "acme.db")
+        before = os.path.getmtime(path), os.path.getsize(path)
+        self.assertIsNone(self.registry.query("acme", "How many orders are there?")["error"])
+        self.registry.close()
+
+        with sqlite3.connect(path) as conn:
+            names = [row[0] for row in conn.execute("SELECT name FROM sqlite_master")]
+            journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(names, ["orders"])
+        self.assertEqual(journal_mode, "delete")
+        self.assertEqual((os.path.getmtime(path), os.path.getsize(path)), before)
+
+    def test_query_stats(self):
+        """Test per-tenant query statistics"""
+        result = self.registry.query("acme", "How many metadata rows are there?")
+
+        self.assertIsNone(result['error'])
+        stats = self.registry.stats("acme")
+        self.assertEqual(stats["queries"], 1)
+        self.assertEqual(stats["errors"], 0)
+        self.assertTrue(stats["resident"])
+
+    def test_error_column_is_not_a_failure(self):
+        """Test only failed executions count as errors, not a result column named error"""
+        self.model.sql = "SELECT 'none' AS error"
+        result = self.registry.query("acme", "Any errors?")
+        self.assertEqual(result["results"], [{"error": "none"}])
+        self.model.sql = "SELECT * FROM missing_table"
+        self.registry.query("acme", "Anything missing?")
+        self.assertEqual(self.registry.stats("acme")["errors"], 1)
+
+class TestAccessProfiles(unittest.TestCase):
+    def setUp(self):
+        """Set up test database"""
+        self.test_db = "test_profiles.db"
+        TextToSQL(self.test_db, model=FakeModel())
+
+    def tearDown(self):
+        """Clean up test database and WAL files"""
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.test_db + suffix):
+                os.remove(self.test_db + suffix)
+
+    def test_read_only_profile(self):
+        """Test read-only connections reject writes but metadata updates still work"""
+        text_to_sql = TextToSQL(self.test_db, model=FakeModel(), access_profile='read_only')
+
+        self.assertEqual(len(text_to_sql.execute_query("SELECT * FROM employees")), 5)
+        result = text_to_sql.execute_query("DELETE FROM employees")
+        self.assertIn("error", result[0])
+
+        text_to_sql.add_column_metadata("employees", "age", "年龄", "员工年龄")
+        self.assertEqual(text_to_sql.get_column_metadata()["employees"]["age"]["business_name"], "年龄")
+        self.assertEqual(text_to_sql.execute_query("PRAGMA journal_mode")[0]["journal_mode"], "wal")
+
+    def test_immutable_profile(self):
+        """Test immutable snapshots are readable and never initialized"""
+        text_to_sql = TextToSQL(self.test_db, model=FakeModel(), access_profile='immutable')
+        db_utils = DatabaseUtils(self.test_db, access_profile='immutable')
+
+        self.assertEqual(len(text_to_sql.execute_query("SELECT * FROM departments")), 3)
+        self.assertEqual(len(db_utils.get_sample_data("employees", 2)), 2)
+        self.assertIn("Table: employees", text_to_sql.get_database_schema())
+
+    def test_unknown_profile(self):
+        """Test unknown profile names are rejected"""
+        with self.assertRaises(ValueError):
+            SQLValidator(self.test_db, access_profile='turbo')
+
+class TestEvaluation(unittest.TestCase):
+    def setUp(self):
+        """Set up test database and recorded responses"""
+        self.test_db = "test_evaluation.db"
+        self.text_to_sql = TextToSQL(self.test_db, model=FakeModel())
+        self.work_dir = tempfile.mkdtemp()
+        self.recordings = os.path.join(self.work_dir, "recordings.json")
+        self.cases = [
+            {"id": "1", "question": "Find employees older than 30",
+             "gold_sql": "SELECT * FROM employees WHERE age > 30"},
+            {"id": "2", "question": "Count total number of employees",
+             "gold_sql": "SELECT COUNT(*) FROM employees"},
+            {"id": "3", "question": "List all departments",
+             "gold_sql": "SELECT * FROM departments"},
+        ]
+        answers = {
+            "Find employees older than 30": "SELECT * FROM employees WHERE age >= 30",
+            "Count total number of employees": "SELECT COUNT(id) AS total FROM employees",
+        }
+        records = {prompt_key(self.text_to_sql.build_prompt(question)): {"text": sql}
+                   for question, sql in answers.items()}
+        with open(self.recordings, 'w', encoding='utf-8') as f:
+            json.dump(records, f)
+
+    def tearDown(self):
+        """Clean up test database and recordings"""
+        shutil.rmtree(self.work_dir)
+        if os.path.exists(self.test_db):
+            os.remove(self.test_db)
+
+    def test_execution_match_ignores_order_and_names(self):
+        """Test results are compared as multisets of values"""
+        self.assertTrue(execution_match([{"a": 1}, {"a": 2}], [{"b": 2}, {"b": 1}]))
+        self.assertFalse(execution_match([{"a": 1}], [{"a": 1}, {"a": 1}]))
+
+    def test_error_column_is_data(self):
+        """Test a result column named error is compared as data, and failed executions never match"""
+        sql = "SELECT 'none' AS error"
+        outcome = evaluate_case(self.text_to_sql, {"id": "e", "question": "Any errors?", "gold_sql": sql},
+                                model=FakeModel(sql))
+        self.assertIsNone(outcome["error"])
+        self.assertTrue(outcome["correct"])
+
+        failed = self.text_to_sql.execute_query("SELECT * FROM missing_table", columnar=True)
+        self.assertFalse(execution_match(failed, failed))
+        outcome = evaluate_case(self.text_to_sql, {"id": "m", "question": "Missing?", "gold_sql": sql},
+                                model=FakeModel("SELECT * FROM missing_table"))
+        self.assertIn("no such table", outcome["error"])
+        self.assertFalse(outcome["correct"])
+
+    def test_replay_suite(self):
+        """Test accuracy, replay misses and stage timings from replayed responses"""
+        for workers in (1, 2):
+            report = run_suite(self.test_db, self.cases, self.recordings, workers=workers)
+
+            self.assertEqual(report["cases"], 3)
+            self.assertEqual(report["correct"], 1)
+            self.assertEqual(report["replay_misses"], 1)
+            self.assertEqual(set(report["stages"]), {"schema", "prompt", "generate", "execute"})
+            self.assertGreater(report["tokens"]["prompt_total"], 0)
+
+    def test_record_mode(self):
+        """Test unrecorded prompts are sent to the wrapped model and saved"""
+        replay = ReplayModel(self.recordings, model=FakeModel("SELECT 1"), record=True)
+        self.assertEqual(replay.generate_content("new prompt").text, "SELECT 1")
+        replay.save()
+
+        self.assertEqual(ReplayModel(self.recordings).generate_content("new prompt").text, "SELECT 1")
+
+    def test_live_model_errors_are_not_replay_misses(self):
+        """Test recording goes through the backend's prefix path and only lookup misses count as misses"""
+        backend = StubBackend(context_cache=True, default="SELECT COUNT(*) FROM departments")
+        replay = ReplayModel(self.recordings, model=backend, record=True)
+        outcome = evaluate_case(self.text_to_sql, self.cases[2], model=replay)
+        self.assertFalse(outcome["replay_miss"])
+        self.assertEqual(len(backend.cached_prefixes), 1)
+        self.assertEqual(self.text_to_sql.token_usage.snapshot()["requests"], 1)
+
+        backend.error = KeyError("candidates")
+        outcome = evaluate_case(self.text_to_sql, {"id": "4", "question": "Oldest employee?",
+                                                   "gold_sql": "SELECT 1"}, model=replay)
+        self.assertFalse(outcome["replay_miss"])
+        self.assertTrue(outcome["error"].startswith("Error generating SQL"))
+
+        outcome = evaluate_case(self.text_to_sql, self.cases[2], model=ReplayModel(self.recordings))
+        self.assertTrue(outcome["replay_miss"])
+
+        run_suite(self.test_db, self.cases, self.recordings)
+        self.assertIsNone(evaluation._worker)
+
+class TestCandidateGeneration(unittest.TestCase):
+    def setUp(self):
+        """Set up test database"""
+        self.test_db = "test_candidates.db"
+        self.text_to_sql = TextToSQL(self.test_db, model=FakeModel())
+
+    def tearDown(self):
+        """Clean up test database"""
+        if os.path.exists(self.test_db):
+            os.remove(self.test_db)
+
+    def test_first_valid_skips_invalid_candidates(self):
+        """Test dangerous or broken candidates are never selected"""
+        self.text_to_sql.model = ScriptedModel([
+            ("DROP TABLE employees", 0),
+            ("SELECT * FROM nonexistent_table", 0.05),
+            ("```sql\nSELECT name FROM departments\n```", 0.1),
+        ])
+        result = CandidateGenerator(self.text_to_sql, n=3).generate("List all departments")
+
+        self.assertIsNone(result['error'])
+        self.assertEqual(result['sql_query'], "SELECT name FROM departments")
+        self.assertEqual(len(result['results']), 3)
+        self.assertEqual([c['status'] for c in result['candidates']], ["invalid", "invalid", "ok"])
+        self.assertEqual(len(self.text_to_sql.execute_query("SELECT * FROM employees")), 5)
+
+    def test_majority_agreement(self):
+        """Test majority selection picks the result most candidates agree on"""
+        self.text_to_sql.model = ScriptedModel([
+            ("SELECT 42", 0),
+            ("SELECT COUNT(*) FROM employees", 0.05),
+            ("SELECT COUNT(id) FROM employees", 0.1),
+        ])
+        result = CandidateGenerator(self.text_to_sql, n=3, selection='majority',
+                                    temperatures=[0.0, 0.4, 0.8]).generate("How many employees?")
+
+        self.assertEqual(list(result['results'][0].values()), [5])
+        self.assertEqual([call["generation_config"]["temperature"] for call in self.text_to_sql.model.calls],
+                         [0.0, 0.4, 0.8])
+
+    def test_hedged_request_beats_slow_call(self):
+        """Test a hedged request answers when the first call is slow"""
+        self.text_to_sql.model = ScriptedModel([
+            ("SELECT * FROM employees", 2.0),
+            ("SELECT * FROM employees WHERE age > 30", 0),
+        ])
+        start = time.perf_counter()
+        result = CandidateGenerator(self.text_to_sql, n=3, hedge_after=0.05).generate("Find employees older than 30")
+
+        self.assertLess(time.perf_counter() - start, 1.0)
+        self.assertEqual(result['selected'], 1)
+        self.assertEqual(len(self.text_to_sql.model.calls), 2)
+        self.assertEqual(result['candidates'][0]['status'], "cancelled")
+
+    def test_hedged_majority_keeps_voting(self):
+        """Test hedging under majority launches candidates until a majority agrees"""
+        self.text_to_sql.model = ScriptedModel([
+            ("SELECT COUNT(*) FROM employees", 0),
+            ("SELECT 42", 0),
+            ("SELECT COUNT(id) FROM employees", 0),
+        ])
+        result = CandidateGenerator(self.text_to_sql, n=3, selection='majority',
+                                    hedge_after=5.0).generate("How many employees?")
+
+        self.assertEqual(len(self.text_to_sql.model.calls), 3)
+        self.assertEqual(result['selected'], 2)
+        self.assertEqual(list(result['results'][0].values()), [5])
+
+        # Every candidate execution is accounted like execute_query's
+        calls = {entry["query"]: entry["calls"] for entry in self.text_to_sql.top_queries()}
+        self.assertEqual(calls["select count(*) from employees"], 1)
+        self.assertEqual(calls["select ?"], 1)
+
+    def test_no_valid_candidate(self):
+        """Test an error is reported when every candidate fails"""
+        self.text_to_sql.model = ScriptedModel([("DELETE FROM employees", 0)])
+        result = CandidateGenerator(self.text_to_sql, n=2).generate("Remove everyone")
+
+        self.assertIsNone(result['sql_query'])
+        self.assertIn("No valid SQL candidate", result['error'])
+
+class TestQueryStats(unittest.TestCase):
+    def setUp(self):
+        """Set up test database"""
+        self.test_db = "test_query_stats.db"
+        self.text_to_sql = TextToSQL(self.test_db, model=FakeModel())
+
+    def tearDown(self):
+        """Clean up test database"""
+        if os.path.exists(self.test_db):
+            os.remove(self.test_db)
+
+    def test_fingerprint_normalization(self):
+        """Test literals, case and whitespace are canonicalized"""
+        self.assertEqual(fingerprint("SELECT * FROM employees WHERE age > 30"),
+                         fingerprint("select *\n  from Employees where AGE>45;"))
+        self.assertEqual(fingerprint("SELECT name FROM t WHERE id IN (1, 2, 3) AND name = 'O''Brien' -- note"),
+                         "select name from t where id in (...) and name = ?")
+        self.assertNotEqual(fingerprint("SELECT age FROM employees"), fingerprint("SELECT salary FROM employees"))
+
+    def test_execute_query_is_recorded(self):
+        """Test calls, rows and errors are aggregated per fingerprint"""
+        self.text_to_sql.execute_query("SELECT * FROM employees WHERE age > 30")
+        self.text_to_sql.execute_query("SELECT * FROM employees WHERE age > 28")
+        self.text_to_sql.execute_query("SELECT * FROM nonexistent_table")
+
+        top = self.text_to_sql.top_queries(sort_by='calls')
+        self.assertEqual(top[0]["query"], "select * from employees where age > ?")
+        self.assertEqual(top[0]["calls"], 2)
+        self.assertEqual(top[0]["rows"], 6)
+        self.assertEqual(top[1]["errors"], 1)
+
+    def test_stats_stay_in_memory_by_default(self):
+        """Test statistics are not written into the queried database unless asked to"""
+        self.text_to_sql.execute_query("SELECT COUNT(*) FROM employees")
+        self.assertEqual(self.text_to_sql.query_stats.flush(), 0)
+        self.text_to_sql.close()
+        with sqlite3.connect(self.test_db) as conn:
+            tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        self.assertNotIn("query_stats", tables)
+
+    def test_flush_merges_into_table(self):
+        """Test flushed statistics are merged with later ones"""
+        self.text_to_sql = TextToSQL(self.test_db, model=FakeModel(), stats_db_path=self.test_db)
+        self.text_to_sql.execute_query("SELECT COUNT(*) FROM employees")
+        self.assertEqual(self.text_to_sql.query_stats.flush(), 1)
+        self.text_to_sql.execute_query("SELECT count(*) FROM employees")
+
+        persisted = QueryStatsTable(self.test_db).top()
+        self.assertEqual(persisted[0]["calls"], 1)
+        self.assertEqual(self.text_to_sql.top_queries()[0]["calls"], 2)
+        self.assertNotIn("query_stats", self.text_to_sql.get_database_schema())
+
+    def test_failed_flush_does_not_fail_queries(self):
+        """Test an unwritable statistics database neither breaks nor double-counts a query"""
+        work_dir = tempfile.mkdtemp()
+        text_to_sql = TextToSQL(os.path.join(work_dir, "data.db"), model=FakeModel(),
+                                stats_db_path=os.path.join(work_dir, "missing", "stats.db"))
+        text_to_sql.query_stats.flush_interval = 0
+        results = text_to_sql.execute_query("SELECT * FROM employees")
+        self.assertEqual(len(results), 5)
+        text_to_sql.query_stats._flusher.join(10)
+
+        top = text_to_sql.top_queries()
+        self.assertEqual((top[0]["calls"], top[0]["errors"]), (1, 0))  # kept in memory after the failed flush
+        with self.assertRaises(sqlite3.Error):
+            text_to_sql.query_stats.flush()
+        self.assertEqual(text_to_sql.top_queries()[0]["calls"], 1)
+        text_to_sql.close()
+        shutil.rmtree(work_dir)
+
+    def test_bounded_table(self):
+        """Test the least-called fingerprints are evicted when full"""
+        stats = QueryStatsTable(max_entries=20)
+        for _ in range(3):
+            stats.record("SELECT * FROM hot", 0.001)
+        for i in range(30):
+            stats.record(f"SELECT c{i} FROM cold", 0.001)
+
+        entries = stats.entries()
+        self.assertLessEqual(len(entries), 20)
+        self.assertIn("select * from hot", [entry["query"] for entry in entries])
+
+class TestAggregateCache(unittest.TestCase):
+    def setUp(self):
+        """Set up test database with the aggregate cache enabled"""
+        self.test_db = "test_aggregate_cache.db"
+        self.text_to_sql = TextToSQL(self.test_db, model=FakeModel())
+        self.cache = self.text_to_sql.enable_aggregate_cache(min_calls=2)
+        self.sql = "SELECT department_id, AVG(salary) AS avg_salary FROM employees GROUP BY department_id ORDER BY department_id"
+
+    def tearDown(self):
+        """Clean up test database"""
+        if os.path.exists(self.test_db):
+            os.remove(self.test_db)
+
+    def test_repeated_aggregate_is_materialized(self):
+        """Test a frequent aggregate query is served from a summary table"""
+        expected = self.text_to_sql.execute_query(self.sql)
+        self.text_to_sql.execute_query(self.sql)
+        self.assertEqual(len(self.cache.summaries()), 1)
+
+        self.assertIn("FROM \"t2s_agg_", self.cache.rewrite(self.sql))
+        # Another spelling runs once as written before it is served from the summary
+        for _ in range(2):
+            self.assertEqual(self.text_to_sql.execute_query(self.sql.lower()), expected)
+        self.assertEqual(self.cache.stats["hits"], 2)
+        self.assertNotIn("t2s_agg_", self.text_to_sql.get_database_schema())
+
+    def test_base_table_changes_refresh_summary(self):
+        """Test triggers mark the summary dirty and it is recomputed"""
+        for _ in range(2):
+            self.text_to_sql.execute_query(self.sql)
+
+        with sqlite3.connect(self.test_db) as conn:
+            conn.execute("UPDATE employees SET salary = salary + 1000 WHERE department_id = 3")
+        self.assertEqual(self.cache.summaries()[0]["dirty"], 1)
+
+        results = self.text_to_sql.execute_query(self.sql)
+        self.assertEqual(results[2]["avg_salary"], 71000.0)
+        self.assertEqual(self.cache.stats["refreshes"], 1)
+        self.assertEqual(self.cache.summaries()[0]["dirty"], 0)
+
+    def test_staleness_bound(self):
+        """Test a dirty summary may be served stale within max_staleness"""
+        self.cache.max_staleness = 3600
+        for _ in range(2):
+            self.text_to_sql.execute_query(self.sql)
+        with sqlite3.connect(self.test_db) as conn:
+            conn.execute("DELETE FROM employees WHERE department_id = 3")
+
+        self.assertEqual(len(self.text_to_sql.execute_query(self.sql)), 3)
+        self.assertEqual(self.cache.stats["refreshes"], 0)
+
+    def test_storage_limits(self):
+        """Test the table limit evicts least recently used summaries"""
+        self.cache.max_tables = 1
+        other = "SELECT COUNT(*) FROM departments"
+        for sql in (self.sql, self.sql, other, other):
+            self.text_to_sql.execute_query(sql)
+
+        summaries = self.cache.summaries()
+        self.assertEqual([row["sql"] for row in summaries], [other])
+        self.assertEqual(self.cache.stats["evicted"], 1)
+
+        self.cache.clear()
+        self.assertEqual(self.cache.summaries(), [])
+
+    def test_summary_keeps_columns_and_values(self):
+        """Test duplicate column names and declared types survive materialization"""
+        with sqlite3.connect(self.test_db) as conn:
+            conn.execute("CREATE TABLE events (name TEXT, day DATE)")
+            conn.executemany("INSERT INTO events VALUES (?, ?)",
+                             [("launch", "2024-01-05"), ("launch", "2024-01-05"), ("review", "2024-02-01")])
+        sql = "SELECT e.name, d.name, e.day, COUNT(*) FROM events e JOIN events d ON d.day = e.day GROUP BY e.name, d.name, e.day"
+        with sqlite3.connect(self.test_db) as conn:
+            conn.row_factory = sqlite3.Row
+            expected = [tuple(row) for row in conn.execute(sql)]
+            expected_names = [column[0] for column in conn.execute(sql).description]
+        for _ in range(2):
+            self.text_to_sql.execute_query(sql)
+
+        with sqlite3.connect(self.test_db) as conn:
+            cursor = conn.execute(self.cache.rewrite(sql))
+            self.assertEqual([column[0] for column in cursor.description], expected_names)
+            self.assertEqual(cursor.fetchall(), expected)
+        self.assertEqual(expected[0][2], "2024-01-05")
+
+    def test_nondeterministic_queries_are_not_cached(self):
+        """Test queries depending on the clock or random() are never materialized"""
+        for sql in ("SELECT COUNT(*), date('now') FROM employees",
+                    "SELECT COUNT(*) FROM employees WHERE hire_date < CURRENT_TIMESTAMP",
+                    "SELECT SUM(salary * random()) FROM employees",
+                    "SELECT department_id, COUNT(*) FROM employees WHERE julianday() > 0 GROUP BY department_id"):
+            for _ in range(3):
+                self.text_to_sql.execute_query(sql)
+        self.assertEqual(self.cache.summaries(), [])
+        self.assertTrue(is_cacheable(canonicalize("SELECT COUNT(*) FROM employees WHERE date(hire_date) > '2020-01-01'")))
+
+    def test_hits_are_counted_in_memory(self):
+        """Test serving a summary does not write to the registry"""
+        for _ in range(3):
+            self.text_to_sql.execute_query(self.sql)
+        with sqlite3.connect(self.test_db) as conn:
+            self.assertEqual(conn.execute("SELECT hits FROM aggregate_cache").fetchone()[0], 0)
+            changes = conn.execute("PRAGMA data_version").fetchone()[0]
+            self.cache.rewrite(self.sql)
+            self.assertEqual(conn.execute("PRAGMA data_version").fetchone()[0], changes)
+        self.assertEqual(self.cache.summaries()[0]["hits"], 2)
+
+    def test_spelling_keeps_its_own_column_names(self):
+        """Test a summary is read back under the names of the query being served"""
+        sql = "SELECT department_id, COUNT(*) AS Cnt FROM employees GROUP BY department_id ORDER BY department_id"
+        for _ in range(2):
+            self.text_to_sql.execute_query(sql)
+        self.assertEqual(len(self.cache.summaries()), 1)
+
+        other = "select department_id, count( * ) as cnt from employees group by department_id order by department_id"
+        for _ in range(2):
+            results = self.text_to_sql.execute_query(other)
+            self.assertEqual(list(results[0]), ["department_id", "cnt"])
+        self.assertEqual(self.cache.stats["hits"], 1)
+        self.assertEqual(list(self.text_to_sql.execute_query(sql)[0]), ["department_id", "Cnt"])
+
+    def test_refresh_over_limit_drops_summary(self):
+        """Test a summary that outgrows max_rows on refresh is dropped"""
+        sql = "SELECT name, COUNT(*) FROM employees GROUP BY name"
+        for _ in range(2):
+            self.text_to_sql.execute_query(sql)
+        self.assertEqual(len(self.cache.summaries()), 1)
+
+        self.cache.max_rows = 5
+        with sqlite3.connect(self.test_db) as conn:
+            conn.execute("INSERT INTO employees (name, department_id, salary, hire_date) "
+                         "VALUES ('Zed', 1, 50000, '2024-01-01')")
+        self.assertEqual(len(self.text_to_sql.execute_query(sql)), 6)
+        self.assertEqual(self.cache.summaries(), [])
+        self.assertEqual(self.cache.stats["too_large"], 1)
+        self.assertEqual(self.cache.stats["refreshes"], 0)
+        self.assertEqual(self.cache.rewrite(sql), sql)
+
+class TestInMemoryDatabase(unittest.TestCase):
+    def test_memory_database_is_shared(self):
+        """":memory:" becomes one shared database that validator and utils can reuse"""
+        text_to_sql = TextToSQL(":memory:", model=FakeModel())
+        validator = SQLValidator(text_to_sql.db_path)
+        db_utils = DatabaseUtils(text_to_sql.db_path)
+
+        self.assertTrue(text_to_sql.db_path.startswith("file:"))
+        self.assertEqual(len(text_to_sql.execute_query("SELECT * FROM employees")), 5)
+        self.assertEqual(sorted(t["name"] for t in db_utils.get_table_info()), ["departments", "employees"])
+        self.assertTrue(validator.validate_query("SELECT * FROM departments")[0])
+
+        # Each ":memory:" gets its own database
+        other = TextToSQL(":memory:", model=FakeModel(), seed_sample_data=False)
+        self.assertNotEqual(other.db_path, text_to_sql.db_path)
+        self.assertIn("error", other.execute_query("SELECT * FROM employees")[0])
+        other.close()
+
+        # The database lives until the last holder is closed
+        uri = text_to_sql.db_path
+        text_to_sql.close()
+        self.assertEqual(len(db_utils.get_sample_data("employees")), 5)
+        db_utils.close()
+        validator.close()
+        gc.collect()
+        conn = sqlite3.connect(uri, uri=True)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0], 0)
+        conn.close()
+
+    def test_memory_database_concurrent_schema(self):
+        text_to_sql = TextToSQL(":memory:", model=FakeModel())
+        expected = text_to_sql.get_enhanced_schema()
+        results, errors = [], []
+
+        def reflect():
+            try:
+                for _ in range(5):
+                    results.append(text_to_sql.get_enhanced_schema())
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=reflect) for _ in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [expected] * 60)
+        text_to_sql.close()
+
+    def test_read_only_memory_database(self):
+        text_to_sql = TextToSQL(":memory:", model=FakeModel(), access_profile="read_only")
+        self.assertEqual(len(text_to_sql.execute_query("SELECT * FROM employees")), 5)
+        self.assertIn("error", text_to_sql.execute_query("DELETE FROM employees")[0])
+        text_to_sql.close()
+
+    def test_injected_connection(self):
+        conn = sqlite3.connect(":memory:", check_same_thread=False)
+        text_to_sql = TextToSQL(model=FakeModel(), connection=conn)
+        validator = SQLValidator(connection=conn)
+        db_utils = DatabaseUtils(connection=conn)
+
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM employees").fetchone()[0], 5)
+        self.assertEqual(text_to_sql.execute_query("SELECT name FROM employees WHERE id = 1"),
+                         [{"name": "John Doe"}])
+        self.assertEqual(len(db_utils.get_table_info()), 2)
+        self.assertTrue(validator.validate_query("SELECT * FROM employees")[0])
+
+        # Library settings do not leak into the caller's connection
+        self.assertIsNone(conn.row_factory)
+        text_to_sql.add_column_metadata("employees", "name", "姓名", "全名")
+        self.assertIn("姓名", text_to_sql.get_database_schema())
+
+        text_to_sql.close()
+        db_utils.close()
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM departments").fetchone()[0], 3)
+        conn.close()
+
+    def test_injected_engine(self):
+        from sqlalchemy import create_engine
+        from sqlalchemy.pool import StaticPool
+        engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+        text_to_sql = TextToSQL(model=FakeModel(), engine=engine)
+        db_utils = DatabaseUtils(engine=engine)
+
+        self.assertIsInstance(text_to_sql.db_path, SharedDatabase)
+        self.assertIs(text_to_sql.engine, engine)
+        self.assertEqual(len(db_utils.get_sample_data("departments")), 3)
+
+        cache = text_to_sql.enable_aggregate_cache(min_calls=1)
+        for _ in range(2):
+            self.assertEqual(text_to_sql.execute_query("SELECT COUNT(*) AS n FROM employees"), [{"n": 5}])
+        self.assertEqual(cache.stats["hits"], 1)
+        text_to_sql.close()
+        engine.dispose()
+
+
+class TestMetadataStore(unittest.TestCase):
+    def setUp(self):
+        self.text_to_sql = TextToSQL(":memory:", model=FakeModel())
+
+    def tearDown(self):
+        self.text_to_sql.close()
+
+    def test_lazy_per_table_loading(self):
+        store = self.text_to_sql.metadata
+        salary = self.text_to_sql.get_table_metadata("employees")["salary"]
+        self.assertIsInstance(salary, ColumnMetadata)
+        self.assertEqual(salary.business_name, "薪资")
+        self.assertTrue(salary.is_sensitive)
+        self.assertFalse(hasattr(salary, "__dict__"))
+        self.assertEqual(list(store._tables), ["employees"])
+        self.assertEqual(self.text_to_sql.get_table_metadata("nonexistent"), {})
+
+        schema = self.text_to_sql.get_enhanced_schema(tables=["departments"])
+        self.assertIn("Table: departments", schema)
+        self.assertNotIn("Table: employees", schema)
+
+    def test_legacy_dict_shape(self):
+        metadata = self.text_to_sql.get_column_metadata()
+        self.assertEqual(set(metadata), {"departments", "employees"})
+        self.assertEqual(metadata["employees"]["salary"], {
+            'business_name': '薪资', 'description': '员工的年薪', 'data_type': 'REAL',
+            'example_value': '75000.0, 65000.0', 'is_sensitive': True, 'business_rules': '单位：美元'})
+        self.assertEqual(self.text_to_sql.get_table_metadata("employees")["age"]["business_name"], "员工年龄")
+
+    def test_reload_after_metadata_change(self):
+        self.assertEqual(self.text_to_sql.get_table_metadata("employees")["age"].business_name, "员工年龄")
+        self.text_to_sql.add_column_metadata("employees", "age", "年龄", "周岁")
+        self.assertEqual(self.text_to_sql.get_table_metadata("employees")["age"].business_name, "年龄")
+        self.text_to_sql.remove_column_metadata("employees", "age")
+        self.assertNotIn("age", self.text_to_sql.get_table_metadata("employees"))
+        self.assertNotIn("age", self.text_to_sql.get_column_metadata()["employees"])
+
+
+class TestCatalogArtifact(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.work_dir, "catalog.db")
+        self.text_to_sql = TextToSQL(self.db_path, model=FakeModel())
+
+    def tearDown(self):
+        self.text_to_sql.close()
+        shutil.rmtree(self.work_dir)
+
+    def test_compile_and_map(self):
+        expected = self.text_to_sql.get_enhanced_schema()
+        path = compile_catalog(self.text_to_sql)
+        self.assertEqual(path, self.db_path + ".catalog")
+
+        with CatalogArtifact(path) as artifact:
+            self.assertEqual(artifact.version, self.text_to_sql.get_catalog_version())
+            self.assertEqual(artifact.schema(), expected)
+            self.assertEqual(artifact.schema(tables=["departments"]),
+                             self.text_to_sql.get_enhanced_schema(tables=["departments"]))
+            self.assertEqual(artifact.table_metadata("employees")["salary"].business_name, "薪资")
+            stats = artifact.column_stats("employees")
+            self.assertEqual(stats["rows"], 5)
+            self.assertEqual(stats["columns"]["department_id"]["distinct"], 3)
+            self.assertEqual(artifact.find_tables("平均薪资 per department")[0], "employees")
+            self.assertEqual(artifact.find_tables("list departments"), ["departments"])
+
+    def test_rebuilt_when_catalog_changes(self):
+        artifact = self.text_to_sql.use_catalog_artifact()
+        other = TextToSQL(self.db_path, model=FakeModel(), seed_sample_data=False)
+        self.assertEqual(other.use_catalog_artifact().version, artifact.version)
+
+        other.add_column_metadata("employees", "age", "年龄", "周岁")
+        self.assertIn("年龄", self.text_to_sql.get_database_schema())
+        self.assertEqual(self.text_to_sql.get_table_metadata("employees")["age"].description, "周岁")
+        self.assertNotEqual(self.text_to_sql.catalog.version, artifact.version)
+        self.assertEqual(CatalogArtifact(self.db_path + ".catalog").version,
+                         self.text_to_sql.get_catalog_version())
+        other.close()
+
+    def test_index_is_read_lazily(self):
+        with sqlite3.connect(self.db_path) as conn:
+            for i in range(40):
+                conn.execute(f"CREATE TABLE inventory{i} (sku{i} TEXT, warehouse{i} TEXT)")
+        text_to_sql = TextToSQL(self.db_path, model=FakeModel(), seed_sample_data=False)
+        artifact = text_to_sql.use_catalog_artifact()
+        self.assertGreater(artifact._buckets, 1)
+        self.assertFalse(hasattr(artifact, "_index"))
+        self.assertEqual(artifact.find_tables("warehouse7 stock"), ["inventory7"])
+        self.assertEqual(artifact.find_tables("sku39 in warehouse39"), ["inventory39"])
+        self.assertEqual(artifact.find_tables("no such words"), [])
+
+        # Reloading a stale artifact unmaps the previous file
+        text_to_sql.add_column_metadata("inventory3", "sku3", "库存单位", "SKU")
+        text_to_sql.get_database_schema()
+        self.assertIsNot(text_to_sql.catalog, artifact)
+        self.assertTrue(artifact._map.closed)
+        catalog = text_to_sql.catalog
+        text_to_sql.close()
+        self.assertTrue(catalog._map.closed)
+
+    def test_corrupt_artifact_is_recompiled(self):
+        with open(self.db_path + ".catalog", "wb") as f:
+            f.write(b"garbage")
+        artifact = self.text_to_sql.use_catalog_artifact()
+        self.assertEqual(artifact.table_names, ["departments", "employees"])
+
+    def test_memory_database_rejected(self):
+        text_to_sql = TextToSQL(":memory:", model=FakeModel())
+        with self.assertRaises(ValueError):
+            text_to_sql.use_catalog_artifact()
+        text_to_sql.close()
+
+    def test_cli(self):
+        output = os.path.join(self.work_dir, "out.catalog")
+        self.assertEqual(cli_main(["compile-catalog", "--db", self.db_path, "--output", output,
+                                   "--no-column-stats"]), 0)
+        with CatalogArtifact(output) as artifact:
+            self.assertEqual(artifact.column_stats("employees"), {})
+            self.assertEqual(artifact.table_names, ["departments", "employees"])
+
+
+class TestSharding(unittest.TestCase):
+    def setUp(self):
+        """Split the sample employees over three shards, keeping a combined copy"""
+        self.work_dir = tempfile.mkdtemp()
+        source = TextToSQL(":memory:", model=FakeModel())
+        rows = [tuple(row.values()) for row in source.execute_query("SELECT * FROM employees")]
+        rows += [(6, 'Dana White', 41, 1, None, '2023-05-01'), (7, 'Evan Black', 26, 3, 52000.0, '2023-06-12')]
+        source.close()
+
+        schema = ("CREATE TABLE employees (id INTEGER PRIMARY KEY, name TEXT, age INTEGER, "
+                  "department_id INTEGER, salary REAL, hire_date DATE)")
+        self.combined = sqlite3.connect(":memory:")
+        self.combined.execute(schema)
+        self.combined.executemany("INSERT INTO employees VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.shard_paths = []
+        for n in range(3):
+            path = os.path.join(self.work_dir, f"shard_{n}.db")
+            with sqlite3.connect(path) as conn:
+                conn.execute(schema)
+                conn.executemany("INSERT INTO employees VALUES (?, ?, ?, ?, ?, ?)", rows[n::3])
+            conn.close()
+            self.shard_paths.append(path)
+        self.sharded = ShardedTextToSQL(self.shard_paths, model=FakeModel(), workers=2)
+
+    def tearDown(self):
+        self.sharded.close()
+        self.combined.close()
+        shutil.rmtree(self.work_dir)
+
+    def expected(self, sql_query):
+        cursor = self.combined.execute(sql_query)
+        columns = [description[0] for description in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def assertSameResult(self, sql_query, mode="fanout"):
+        results = self.sharded.execute_query(sql_query)
+        self.assertEqual(self.sharded.last_plan["mode"], mode, self.sharded.last_plan)
+        expected = self.expected(sql_query)
+        if "ORDER BY" in sql_query.upper():
+            self.assertEqual(results, expected)
+        else:
+            self.assertTrue(execution_match(results, expected), results)
+
+    def test_schema_is_one_logical_database(self):
+        schema = self.sharded.get_database_schema()
+        self.assertEqual(schema.count("Table: employees"), 1)
+
+    def test_reaggregates(self):
+        self.assertSameResult("SELECT COUNT(*) AS n, SUM(salary), MIN(age), MAX(hire_date) FROM employees")
+        self.assertSameResult("SELECT department_id, COUNT(*) AS n, AVG(salary) AS avg_salary FROM employees "
+                              "GROUP BY department_id ORDER BY department_id")
+        self.assertSameResult("SELECT department_id, ROUND(AVG(age), 1) a FROM employees GROUP BY 1 "
+                              "HAVING COUNT(*) > 2 ORDER BY a DESC")
+        self.assertSameResult("SELECT AVG(salary) FROM employees WHERE age > 100")
+
+    def test_global_order_and_limit(self):
+        self.assertSameResult("SELECT name, salary FROM employees ORDER BY salary DESC LIMIT 3")
+        self.assertSameResult("SELECT * FROM employees ORDER BY age LIMIT 2 OFFSET 1")
+        self.assertSameResult("SELECT name FROM employees WHERE department_id = 1")
+        self.assertIn("LIMIT 3", plan_fanout("SELECT name FROM employees ORDER BY id LIMIT 2 OFFSET 1").partial_sql)
+
+    def test_unmergeable_queries_use_attached_shards(self):
+        self.assertSameResult("SELECT COUNT(DISTINCT department_id) AS d FROM employees", mode="attached")
+        self.assertSameResult("SELECT name FROM employees WHERE salary > (SELECT AVG(salary) FROM employees) "
+                              "ORDER BY name", mode="attached")
+        self.assertIn("error", self.sharded.execute_query("DELETE FROM employees")[0])
+        self.assertEqual(len(self.expected("SELECT * FROM employees")), 7)
+
+        # Aggregates the planner cannot re-aggregate must not return one shard's value
+        self.assertSameResult("SELECT length(group_concat(name)) AS n FROM employees", mode="attached")
+        self.assertSameResult("SELECT department_id, json_group_array(name) FROM employees "
+                              "GROUP BY department_id ORDER BY department_id", mode="attached")
+        self.assertSameResult("SELECT department_id, upper(substr(MAX(name), 1, 3)) FROM employees "
+                              "GROUP BY department_id ORDER BY department_id")
+        with self.assertRaises(ValueError):
+            self.sharded.enable_aggregate_cache()
+
+    def test_replicated_tables_and_attach_limit(self):
+        """Twelve monthly shards of events, each with a full copy of the departments table"""
+        combined = sqlite3.connect(":memory:")
+        paths = []
+        for month in range(12):
+            path = os.path.join(self.work_dir, f"events_{month:02d}.db")
+            with sqlite3.connect(path) as conn:
+                for db in (conn, combined) if month == 0 else (conn,):
+                    db.execute("CREATE TABLE ev (id INTEGER PRIMARY KEY, dept_id INTEGER, day DATE)")
+                    db.execute("CREATE TABLE dept (id INTEGER PRIMARY KEY, name TEXT)")
+                conn.executemany("INSERT INTO dept VALUES (?, ?)", [(1, "sales"), (2, "ops"), (3, "it")])
+                events = [(month * 10 + n, n % 3 + 1, f"2024-{month + 1:02d}-{n + 1:02d}")
+                          for n in range(month % 3 + 1)]
+                conn.executemany("INSERT INTO ev VALUES (?, ?, ?)", events)
+                combined.executemany("INSERT INTO ev VALUES (?, ?, ?)", events)
+            conn.close()
+            paths.append(path)
+        combined.executemany("INSERT INTO dept VALUES (?, ?)", [(1, "sales"), (2, "ops"), (3, "it")])
+        sharded = ShardedTextToSQL(paths, model=FakeModel(), workers=1, replicated_tables=["dept"])
+
+        def check(sql_query, mode):
+            cursor = combined.execute(sql_query)
+            columns = [description[0] for description in cursor.description]
+            expected = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            self.assertEqual(sharded.execute_query(sql_query), expected)
+            self.assertEqual(sharded.last_plan["mode"], mode, sharded.last_plan)
+
+        # The same join gives the same count on every path
+        check("SELECT COUNT(*) AS n FROM ev JOIN dept ON dept.id = ev.dept_id", "fanout")
+        check("SELECT COUNT(*) AS n FROM ev JOIN dept ON dept.id = ev.dept_id WHERE 1 = (SELECT 1)", "attached")
+        check("SELECT COUNT(DISTINCT day) AS days, COUNT(DISTINCT dept_id) AS depts FROM ev", "attached")
+        check("SELECT dept.name, COUNT(*) AS n FROM ev JOIN dept ON dept.id = ev.dept_id "
+              "WHERE ev.id IN (SELECT id FROM ev) GROUP BY dept.name ORDER BY dept.name", "attached")
+        check("SELECT COUNT(*) AS n FROM dept", "single")
+        self.assertEqual(sharded.last_plan["replicated"], ["dept"])
+        self.assertIn("error", sharded.execute_query("DELETE FROM dept WHERE id IN (SELECT id FROM dept)")[0])
+        self.assertEqual(len(sharded.execute_query("SELECT * FROM dept")), 3)
+        with self.assertRaises(ValueError):
+            ShardedTextToSQL(paths, model=FakeModel(), replicated_tables=["missing"])
+        sharded.close()
+        combined.close()
+
+    def test_mismatched_shards_rejected(self):
+        path = os.path.join(self.work_dir, "other.db")
+        with sqlite3.connect(path) as conn:
+            conn.execute("CREATE TABLE events (id INTEGER)")
+        conn.close()
+        with self.assertRaises(ValueError):
+            ShardedTextToSQL(self.shard_paths + [path], model=FakeModel())
+
+
+class TestModelRouting(unittest.TestCase):
+    def setUp(self):
+        self.fast = StubBackend("fast", default="SELECT name FROM employees WHERE age > 30")
+        self.strong = StubBackend("strong", default="SELECT d.name, AVG(e.salary) AS avg_salary FROM employees e "
+                                                    "JOIN departments d ON e.department_id = d.id GROUP BY d.name")
+        self.router = ModelRouter(self.fast, self.strong, timeouts={'fast': 0.2, 'strong': 0.2})
+        self.text_to_sql = TextToSQL(":memory:", router=self.router)
+
+    def tearDown(self):
+        self.text_to_sql.close()
+        self.router.close()
+
+    def test_routes_by_complexity(self):
+        result = self.text_to_sql.query("Show me all employees")
+        self.assertEqual(result["sql_query"], 'SELECT * FROM "employees"')
+        self.assertEqual(self.router.last_decision["route"], "template")
+        self.assertEqual(self.text_to_sql.query("How many departments?")["results"], [{"count": 3}])
+
+        self.text_to_sql.query("Find employees older than 30")
+        self.assertEqual(self.router.last_decision["route"], "fast")
+
+        result = self.text_to_sql.query("What is the average salary per department, along with the department name?")
+        self.assertEqual(self.router.last_decision["route"], "strong")
+        self.assertEqual(len(result["results"]), 3)
+        self.assertEqual(self.router.last_decision["features"]["linked_tables"], ["departments", "employees"])
+        self.assertEqual((len(self.fast.prompts), len(self.strong.prompts)), (1, 1))
+
+    def test_fallback_on_timeout_and_error(self):
+        self.fast.delay = 0.5
+        result = self.text_to_sql.query("Find employees older than 30")
+        self.assertIsNone(result["error"])
+        self.assertEqual(self.router.last_decision["served_by"], "strong")
+        self.assertIn("timed out", self.router.last_decision["errors"][0])
+
+        self.fast.delay = 0
+        self.strong.error = RuntimeError("quota exceeded")
+        self.text_to_sql.query("Which department has the highest average salary compared to the others?")
+        self.assertEqual(self.router.last_decision["served_by"], "fast")
+
+        self.fast.error = RuntimeError("unavailable")
+        result = self.text_to_sql.query("Find employees older than 30")
+        self.assertIn("All routes failed", result["error"])
+
+        stats = self.router.stats()
+        self.assertEqual(stats["fast"]["timeouts"], 1)
+        self.assertEqual(stats["strong"]["errors"], 2)
+        self.assertEqual(stats["fast"]["slo_violations"], 1)
+
+    def test_backend_must_implement_generate_content(self):
+        class Incomplete(ModelBackend):
+            name = "incomplete"
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+        self.assertEqual(self.fast.generate_with_prefix(PromptPrefix("SELECT"), " 1").text, self.fast.default)
+
+    def test_hung_backend_is_bounded(self):
+        class HungBackend(StubBackend):
+            def generate_content(self, prompt, **kwargs):
+                self.request_options = kwargs.get("request_options")
+                return super().generate_content(prompt, **kwargs)
+
+        hung = HungBackend("fast", delay=0.5)
+        router = ModelRouter(hung, self.strong, timeouts={'fast': 0.05, 'strong': 1.0}, max_abandoned=2)
+        text_to_sql = TextToSQL(":memory:", router=router)
+        try:
+            for _ in range(3):
+                self.assertIsNone(text_to_sql.query("Find employees older than 30")["error"])
+                self.assertEqual(router.last_decision["served_by"], "strong")
+            self.assertEqual(hung.request_options, {"timeout": 0.05})
+            self.assertEqual(len(hung.prompts), 2)
+            self.assertIn("skipped, 2 timed-out calls still running", router.last_decision["errors"][0])
+            stats = router.stats()["fast"]
+            self.assertEqual((stats["timeouts"], stats["abandoned"], stats["skipped"]), (2, 2, 1))
+
+            deadline = time.monotonic() + 5
+            while router.stats()["fast"]["abandoned"] and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(router.stats()["fast"]["abandoned"], 0)
+            hung.delay = 0
+            text_to_sql.query("Find employees older than 30")
+            self.assertEqual(router.last_decision["served_by"], "fast")
+        finally:
+            text_to_sql.close()
+            router.close()
+
+    def test_error_column_counts_as_success(self):
+        self.fast.default = "SELECT 'none' AS error"
+        result = self.text_to_sql.query("Find employees older than 30")
+        self.assertEqual(result["results"], [{"error": "none"}])
+        self.assertIsNone(result["error"])
+        self.fast.default = "SELECT * FROM missing_table"
+        self.assertIn("no such table", self.text_to_sql.query("Find employees older than 30")["results"][0]["error"])
+        self.assertEqual(self.router.stats()["fast"]["accuracy"], 0.5)
+
+    def test_accuracy_stats(self):
+        self.fast.default = "SELECT * FROM missing_table"
+        self.text_to_sql.query("Find employees older than 30")
+        self.text_to_sql.query("Show me all employees")
+        stats = self.router.stats()
+        self.assertEqual(stats["fast"]["accuracy"], 0.0)
+        self.assertEqual(stats["template"]["accuracy"], 1.0)
+        self.assertIsNotNone(stats["template"]["p95_ms"])
+
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        # Rules for later turns come first: their prompts repeat the earlier questions
+        self.model = StubBackend(rules=[
+            ("question: Add their department name",
+             "SELECT p.name, d.name AS department FROM prev_result p JOIN departments d ON d.id = p.department_id"),
+            ("question: Only those earning more than 80000", "SELECT * FROM prev_result WHERE salary > 80000"),
+            ("question: Which employees are older than 30?",
+             "SELECT name, salary, department_id FROM employees WHERE age > 30 ORDER BY name"),
+        ])
+        self.text_to_sql = TextToSQL(":memory:", model=self.model)
+        self.session = Session(self.text_to_sql)
+
+    def tearDown(self):
+        self.session.close()
+        self.text_to_sql.close()
+
+    def test_follow_ups_reuse_previous_result(self):
+        # Unrelated tables only the first, full prompt pays for
+        with sqlite3.connect(self.text_to_sql.db_path, uri=True) as conn:
+            for i in range(5):
+                conn.execute(f"CREATE TABLE audit_{i} (id INTEGER PRIMARY KEY, actor TEXT, action TEXT, "
+                             f"target TEXT, details TEXT, created_at TIMESTAMP)")
+        first = self.session.ask("Which employees are older than 30?")
+        self.assertFalse(first["reused_result"])
+        self.assertEqual([row["name"] for row in first["results"]], ["Alice Brown", "Bob Johnson"])
+
+        second = self.session.ask("Only those earning more than 80000")
+        self.assertTrue(second["reused_result"])
+        self.assertEqual(second["results"], [{"name": "Bob Johnson", "salary": 85000.0, "department_id": 1}])
+        prompt = self.model.prompts[1]
+        self.assertIn("prev_result(name, salary, department_id)", prompt)
+        self.assertIn("SQL: SELECT name, salary, department_id FROM employees", prompt)
+        self.assertIn("Result: 2 rows; columns: name, salary, department_id", prompt)
+        self.assertIn("Table: employees", prompt)
+        self.assertNotIn("Table: departments", prompt)
+        self.assertLess(second["prompt_tokens"], first["prompt_tokens"])
+
+        # Joining the cached result with a base table the question names
+        third = self.session.ask("Add their department name")
+        self.assertTrue(third["reused_result"])
+        self.assertEqual(third["results"], [{"name": "Bob Johnson", "department": "Engineering"}])
+        self.assertIn("Table: departments", self.model.prompts[2])
+        self.assertEqual([turn.tables for turn in self.session.turns], [["employees"]] * 3)
+
+    def test_large_results_are_not_cached(self):
+        self.session.cache_rows = 1
+        self.session.ask("Which employees are older than 30?")
+        self.session.ask("Only those earning more than 80000")
+        self.assertNotIn("prev_result(", self.model.prompts[1])
+        self.assertEqual(self.session.turns[1].error, "no such table: prev_result")
+
+        self.session.reset()
+        self.assertEqual(self.session.build_prompt("How many departments?"),
+                         self.text_to_sql.build_prompt("How many departments?"))
+
+    def test_duplicate_columns_and_token_accounting(self):
+        self.model.rules.insert(0, ("question: Employees with their department",
+                                    "SELECT e.name, d.name FROM employees e JOIN departments d "
+                                    "ON d.id = e.department_id ORDER BY e.name LIMIT 2"))
+        self.session.ask("Which employees are older than 30?")
+        joined = self.session.ask("Employees with their department")
+        self.assertIsNone(joined["error"])
+        self.assertEqual(len(joined["results"]), 2)
+        self.assertEqual(self.session._cached_columns, ["name", "name_1"])
+
+        self.session.ask("Only those earning more than 80000")
+        self.assertIn("prev_result(name, name_1)", self.model.prompts[2])
+        # Follow-ups go through send_prompt like the first question
+        self.assertEqual(self.text_to_sql.token_usage.snapshot()["requests"], 3)
+
+class TestComparison(unittest.TestCase):
+    def setUp(self):
+        # The model only finds the right answers when the schema carries business names
+        self.model = StubBackend(rules=[
+            ("question: Who earns the most?\nSQL", "SELECT 1"),
+            ("业务名称", "SELECT name FROM employees ORDER BY salary DESC LIMIT 1"),
+        ], default="SELECT name FROM employees ORDER BY id LIMIT 1")
+        self.text_to_sql = TextToSQL(":memory:", model=self.model)
+        self.cases = [
+            {"id": str(i), "question": f"Who earns the most? ({i})",
+             "gold_sql": "SELECT name FROM employees WHERE salary = (SELECT MAX(salary) FROM employees)"}
+            for i in range(6)
+        ]
+
+    def tearDown(self):
+        self.text_to_sql.close()
+
+    def test_compare_metadata_variants(self):
+        report = compare_variants(self.text_to_sql, DEFAULT_VARIANTS, self.cases, concurrency=4)
+        json.dumps(report)
+
+        self.assertEqual(report["baseline"], "without_metadata")
+        without, with_metadata = report["variants"]["without_metadata"], report["variants"]["with_metadata"]
+        self.assertEqual((without["accuracy"], with_metadata["accuracy"]), (0.0, 1.0))
+        self.assertEqual(report["deltas"]["with_metadata"]["accuracy"], 1.0)
+        self.assertGreater(report["deltas"]["with_metadata"]["prompt_tokens_mean"], 0)
+        self.assertEqual(set(with_metadata["latency_ms"]), {"mean", "min", "p50", "p95", "max"})
+        self.assertEqual(len(report["disagreements"]), 6)
+        self.assertEqual(len(self.model.prompts), 12)
+
+        with self.assertRaises(ValueError):
+            Variant("bad", schema="unknown")
+        with self.assertRaises(ValueError):
+            compare_variants(self.text_to_sql, [Variant("a"), Variant("a")], self.cases)
+
+    def test_rate_limits(self):
+        limiter = RateLimiter(per_minute=1200)  # 20 a second, no burst
+        start = time.perf_counter()
+        waited = sum(limiter.acquire() for _ in range(5))
+        self.assertGreaterEqual(time.perf_counter() - start, 0.15)
+        self.assertGreater(waited, 0)
+
+        template = "Schema:\n{schema}\nQ: {question}\nSQL:"
+        report = compare_variants(self.text_to_sql, [Variant("plain", 'basic', template)], self.cases,
+                                  concurrency=6, requests_per_minute=1200)
+        queue = report["variants"]["plain"]["queue_ms"]
+        self.assertGreater(queue["max"], 0)
+        self.assertTrue(self.model.prompts[0].startswith("Schema:"))
+
+    def test_object_without_token_usage(self):
+        """Test a TextToSQL stand-in without token accounting can be compared"""
+        class WithoutTokenUsage(TextToSQL):
+            def __getattribute__(self, name):
+                if name == 'token_usage':
+                    raise AttributeError(name)
+                return super().__getattribute__(name)
+
+        text_to_sql = WithoutTokenUsage(":memory:", model=self.model)
+        report = compare_variants(text_to_sql, DEFAULT_VARIANTS, self.cases[:2])
+        self.assertEqual(report["variants"]["with_metadata"]["accuracy"], 1.0)
+        self.assertEqual(report["variants"]["with_metadata"]["errors"], 0)
+        text_to_sql.close()
+
+    def test_demo_comparison(self):
+        """Smoke test of the enhanced demo's show_comparison() with a local backend"""
+        import contextlib
+        import io
+        from demo_meaningless_names_enhanced import TextToSQLEnhanced
+
+        work_dir = tempfile.mkdtemp()
+        try:
+            # Only the metadata-enhanced schema lets the model find the age column
+            model = StubBackend(rules=[("员工年龄", "SELECT * FROM t01 WHERE c003 > 30")], default="SELECT * FROM t01")
+            demo = TextToSQLEnhanced(os.path.join(work_dir, "demo.db"), model=model)
+            with contextlib.redirect_stdout(io.StringIO()):
+                report = demo.show_comparison(requests_per_minute=None)
+            without, with_metadata = report["variants"]["without_metadata"], report["variants"]["with_metadata"]
+            self.assertEqual((without["errors"], with_metadata["errors"]), (0, 0))
+            self.assertEqual([o["correct"] for o in with_metadata["results"]][:2], [False, True])
+            self.assertEqual([o["correct"] for o in without["results"]][:2], [True, False])
+            self.assertEqual(len(model.prompts), 8)
+        finally:
+            shutil.rmtree(work_dir)
+
+class TestPromptCaching(unittest.TestCase):
+    def setUp(self):
+        self.model = StubBackend(context_cache=True)
+        self.text_to_sql = TextToSQL(":memory:", model=self.model)
+
+    def tearDown(self):
+        self.text_to_sql.close()
+
+    def test_canonical_schema_and_prefix(self):
+        # Same catalog, tables created in the opposite order
+        other = TextToSQL(":memory:", model=FakeModel(), seed_sample_data=False)
+        with sqlite3.connect(other.db_path, uri=True) as conn:
+            conn.executescript("""
+                CREATE TABLE employees (id INTEGER PRIMARY KEY, name TEXT NOT NULL, age INTEGER,
+                    department_id INTEGER, salary REAL, hire_date DATE,
+                    FOREIGN KEY (department_id) REFERENCES departments(id));
+                CREATE TABLE departments (id INTEGER PRIMARY KEY, name TEXT NOT NULL, location TEXT);
+            """)
+            conn.executemany("INSERT INTO column_metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             sqlite3.connect(self.text_to_sql.db_path, uri=True).execute(
+                                 "SELECT * FROM column_metadata ORDER BY table_name DESC").fetchall())
+        other.invalidate_schema_cache()
+        self.assertEqual(other.get_database_schema(), self.text_to_sql.get_database_schema())
+        self.assertEqual(other.get_schema_hash(), self.text_to_sql.get_schema_hash())
+        other.close()
+
+        question = "Who earns the most?"
+        prefix, suffix = self.text_to_sql.build_prompt_parts(question)
+        self.assertEqual(prefix.text + suffix, self.text_to_sql.prompt_template.format(
+            schema=self.text_to_sql.get_database_schema(), question=question))
+        self.assertIs(self.text_to_sql.build_prompt_parts("Another question")[0], prefix)
+
+        schema_hash = self.text_to_sql.get_schema_hash()
+        self.text_to_sql.add_column_metadata("employees", "age", "年龄", "员工年龄")
+        self.assertNotEqual(self.text_to_sql.get_schema_hash(), schema_hash)
+        self.assertNotEqual(self.text_to_sql.build_prompt_parts(question)[0].digest, prefix.digest)
+
+        with self.assertRaises(ValueError):
+            PromptBuilder("{question} with {schema}")
+
+    def test_cached_versus_sent_tokens(self):
+        questions = ["Who earns the most?", "How many departments?", "List employees hired in 2020"]
+        for question in questions:
+            self.text_to_sql.generate_sql(question)
+
+        prefix, _ = self.text_to_sql.build_prompt_parts("")
+        usage = self.text_to_sql.token_usage.snapshot()
+        self.assertEqual(len(self.model.cached_prefixes), 1)
+        self.assertEqual((usage["requests"], usage["cached_requests"]), (3, 2))
+        self.assertEqual(usage["cached_tokens"], 2 * prefix.tokens)
+        self.assertLess(usage["sent_tokens"], 2 * prefix.tokens)
+
+        # Models without a context cache are charged for every prompt
+        plain = TextToSQL(self.text_to_sql.db_path, model=FakeModel(), seed_sample_data=False)
+        plain.generate_sql(questions[0])
+        self.assertEqual(plain.token_usage.snapshot()["cached_tokens"], 0)
+        plain.close()
+
+    def test_gemini_context_cache(self):
+        created = []
+
+        class CachedContent:
+            @staticmethod
+            def create(model, display_name, contents, ttl):
+                created.append((model, contents[0]))
+                return contents[0]
+
+        class GenerativeModel:
+            @staticmethod
+            def from_cached_content(cached_content):
+                return FakeModel("SELECT 'cached'")
+
+        backend = GeminiBackend('gemini-1.5-flash-001', min_cache_tokens=10)
+        backend._model = FakeModel("SELECT 'full'")
+        backend._genai = types.SimpleNamespace(caching=types.SimpleNamespace(CachedContent=CachedContent),
+                                               GenerativeModel=GenerativeModel)
+        text_to_sql = TextToSQL(self.text_to_sql.db_path, model=backend, seed_sample_data=False)
+        self.assertEqual(text_to_sql.generate_sql("Who earns the most?"), "SELECT 'cached'")
+        self.assertEqual(text_to_sql.generate_sql("How many departments?"), "SELECT 'cached'")
+        self.assertEqual(len(created), 1)
+        self.assertEqual(created[0][0], "models/gemini-1.5-flash-001")
+
+        # Prefixes below the provider's minimum are sent whole; so is everything without the caching module
+        backend.min_cache_tokens = 10 ** 6
+        self.assertEqual(text_to_sql.generate_sql("Who earns the most?"), "SELECT 'full'")
+        backend.min_cache_tokens, backend._genai = 10, types.SimpleNamespace()
+        backend._contexts.clear()
+        self.assertEqual(text_to_sql.generate_sql("Who earns the most?"), "SELECT 'full'")
+        text_to_sql.close()
+
+class TestPreview(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.text_to_sql = TextToSQL(os.path.join(self.work_dir, "preview.db"), model=FakeModel())
+        with sqlite3.connect(self.text_to_sql.db_path) as conn:
+            conn.execute("CREATE TABLE readings (id INTEGER PRIMARY KEY, sensor INTEGER, value REAL)")
+            conn.executemany("INSERT INTO readings VALUES (?, ?, ?)",
+                             ((i, i % 4, i * 0.5) for i in range(1, 20001)))
+
+    def tearDown(self):
+        self.text_to_sql.close()
+        shutil.rmtree(self.work_dir)
+
+    def test_first_rows_and_totals(self):
+        with self.text_to_sql.preview("SELECT * FROM readings", rows=10) as preview:
+            self.assertEqual([row["id"] for row in preview.rows], list(range(1, 11)))
+            self.assertTrue(preview.has_more)
+            self.assertEqual(preview.estimate, {"rows": 20000, "method": "rowid"})
+            self.assertEqual(preview.total(timeout=10), 20000)
+            self.assertEqual(len(preview.fetch_all()), 20000)
+            self.assertEqual(len(preview.fetch_all(columnar=True)), 20000)
+
+        with sqlite3.connect(self.text_to_sql.db_path) as conn:
+            conn.execute("ANALYZE")
+        preview = self.text_to_sql.preview("SELECT value FROM readings ORDER BY value DESC", count=False)
+        self.assertEqual(preview.estimate["method"], "stat1")
+        self.assertEqual(preview.rows[0], {"value": 10000.0})
+        preview.close()
+
+        # Filtered: estimated from a rowid sample, then counted exactly
+        preview = self.text_to_sql.preview("SELECT id FROM readings WHERE sensor = 1")
+        self.assertEqual(preview.estimate["method"], "sample")
+        self.assertAlmostEqual(preview.estimate["rows"], 5000, delta=1000)
+        self.assertEqual(preview.total(timeout=10), 5000)
+        self.assertEqual(preview.to_dict()["approximate_total"], 5000)
+        preview.close()
+        self.assertEqual(len(preview.fetch_all()), 5000)
+
+        preview = self.text_to_sql.preview("SELECT * FROM departments")
+        self.assertFalse(preview.has_more)
+        self.assertEqual((preview.approximate_total, preview.estimate["method"]), (3, "exact"))
+
+    def test_cancel_and_errors(self):
+        preview = self.text_to_sql.preview("SELECT a.id FROM readings a, readings b WHERE a.value < b.value", rows=5)
+        self.assertEqual(len(preview.rows), 5)
+        preview.cancel()
+        self.assertIsNone(preview.total(timeout=10))
+        preview._counter.join(10)
+        self.assertFalse(preview._counter.is_alive())
+        preview.close()
+
+        self.text_to_sql.model.sql = "SELECT * FROM missing_table"
+        preview = self.text_to_sql.preview("Show the missing table")
+        self.assertIn("no such table", preview.error)
+        self.assertEqual(preview.to_dict()["results"], [{"error": preview.error}])
+
+        failing = TextToSQL(self.text_to_sql.db_path, model=StubBackend(error=RuntimeError("boom")),
+                            seed_sample_data=False)
+        result = failing.preview("Which sensors report the highest values?").to_dict()
+        self.assertIsNone(result["sql_query"])
+        self.assertTrue(result["error"].startswith("Error generating SQL"))
+        failing.close()
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.model = FakeModel("SELECT name FROM employees WHERE age > 30")
+        self.text_to_sql = TextToSQL(os.path.join(self.work_dir, "trace.db"), model=self.model)
+
+    def tearDown(self):
+        self.text_to_sql.close()
+        shutil.rmtree(self.work_dir)
+
+    def test_statements_attributed_to_stages(self):
+        with Tracer(progress_steps=10) as tracer:
+            result = self.text_to_sql.query("Who is older than 30?")
+            SQLValidator(self.text_to_sql.db_path).validate_query("SELECT * FROM employees")
+        self.assertIsNone(result["error"])
+
+        stages = tracer.summary()
+        self.assertIn("schema/reflect", stages)  # SQLAlchemy reflection PRAGMAs
+        self.assertIn("schema/reflect/metadata", stages)  # column_metadata reads
+        self.assertEqual(stages["execute"]["statements"], 1)
+        self.assertEqual(stages["validate"]["statements"], 1)
+        validated = [record for record in tracer.statements if record.stage == "validate"][0]
+        self.assertEqual(validated.sql, "EXPLAIN SELECT * FROM employees")  # SQLite does not trace EXPLAIN
+        self.assertGreater(stages["schema/reflect"]["wall_ms"], 0)
+
+        executed = [record for record in tracer.statements if record.stage == "execute"][0]
+        self.assertEqual(executed.sql, self.model.sql)
+        self.assertGreater(executed.vm_steps, 0)
+        self.assertGreaterEqual(executed.duration, 0)
+        self.assertTrue(any("PRAGMA" in record.sql for record in tracer.statements
+                            if record.stage == "schema/reflect"))
+
+        top = tracer.top(50, sort_by='calls')
+        self.assertIn(fingerprint(self.model.sql), [entry["fingerprint"] for entry in top])
+
+        # Nothing is recorded once the tracer stops, and pooled connections are released clean
+        count = len(tracer.statements)
+        self.text_to_sql.invalidate_schema_cache()
+        self.text_to_sql.query("Again")
+        self.assertEqual(len(tracer.statements), count)
+
+    def test_stage_nesting_and_threads(self):
+        with Tracer() as tracer:
+            with stage("outer"), stage("inner"):
+                self.text_to_sql.execute_query("SELECT 1")
+            worker = threading.Thread(target=self.text_to_sql.execute_query, args=("SELECT 2",))
+            worker.start()
+            worker.join()
+        stages = {record.sql: record.stage for record in tracer.statements}
+        self.assertEqual(stages["SELECT 1"], "outer/inner/execute")
+        self.assertEqual(stages["SELECT 2"], "execute")  # stages are per thread
+        self.assertEqual(tracer.summary()["outer"]["calls"], 1)
+
+    def test_profile_export_folded(self):
+        with Tracer(profile=True) as tracer:
+            self.text_to_sql.query("Who is older than 30?")
+        path = os.path.join(self.work_dir, "query.folded")
+        self.assertGreater(tracer.export_folded(path), 0)
+        with open(path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        for line in lines:
+            stack, microseconds = line.rsplit(" ", 1)
+            self.assertTrue(stack and int(microseconds) > 0)
+        self.assertTrue(any("get_enhanced_schema" in line and "get_columns" in line for line in lines))
+
+        self.assertEqual(Tracer().folded_stacks(), {})  # profiling is opt-in
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file